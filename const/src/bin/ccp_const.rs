@@ -44,9 +44,35 @@ fn main() {
                     .takes_value(true)
                     .help("The max cwnd, in packets, *only* when setting a rate"),
             )
+            .arg(
+                Arg::with_name("schedule")
+                    .long("schedule")
+                    .takes_value(true)
+                    .help(
+                        "Steps of T_MS:VALUE[,T_MS:VALUE...], from the start of every flow. \
+                         Values are cwnds in packets, or rates in Mbps with --vary=rate",
+                    ),
+            )
+            .arg(
+                Arg::with_name("sweep")
+                    .long("sweep")
+                    .takes_value(true)
+                    .help(
+                        "FROM:TO:BY:DWELL_MS, a staircase of cwnds in packets (or rates in Mbps \
+                         with --vary=rate), each held DWELL_MS",
+                    ),
+            )
+            .arg(
+                Arg::with_name("vary")
+                    .long("vary")
+                    .takes_value(true)
+                    .possible_values(&["cwnd", "rate"])
+                    .default_value("cwnd")
+                    .help("What --schedule or --sweep sets, rate must also specify cwnd_cap"),
+            )
             .group(
                 clap::ArgGroup::with_name("to_set")
-                    .args(&["cwnd", "rate"])
+                    .args(&["cwnd", "rate", "schedule", "sweep"])
                     .required(true),
             )
             .get_matches();
@@ -55,7 +81,45 @@ fn main() {
             return Err(String::from("must supply either cwnd or rate"));
         }
 
-        let const_param = if matches.is_present("rate") {
+        let const_param = if matches.is_present("schedule") || matches.is_present("sweep") {
+            let steps = match matches.value_of("schedule") {
+                Some(s) => ccp_const::parse_schedule(s),
+                None => ccp_const::parse_sweep(matches.value_of("sweep").unwrap()),
+            }?;
+            let cwnd_cap = match (matches.value_of("vary"), matches.value_of("cwnd_cap")) {
+                (Some("rate"), Some(c)) => {
+                    u32::from_str_radix(c, 10).map_err(|e| format!("{:?}", e))? * PKTS_TO_BYTES
+                }
+                (Some("rate"), None) => {
+                    return Err(String::from(
+                        "when varying the rate, must also specify cwnd_cap",
+                    ))
+                }
+                _ => 0,
+            };
+            let steps = steps
+                .into_iter()
+                .map(|(start_us, v)| {
+                    if cwnd_cap == 0 {
+                        ccp_const::Step {
+                            start_us,
+                            cwnd: v * PKTS_TO_BYTES,
+                            rate: 0,
+                        }
+                    } else {
+                        ccp_const::Step {
+                            start_us,
+                            cwnd: cwnd_cap,
+                            rate: v * MBPS_TO_BPS / BITS_TO_BYTES,
+                        }
+                    }
+                })
+                .collect::<Vec<_>>();
+            if steps.is_empty() {
+                return Err(String::from("empty schedule"));
+            }
+            Ok(ccp_const::Constant::Schedule(steps))
+        } else if matches.is_present("rate") {
             let rate = u32::from_str_radix(matches.value_of("rate").unwrap(), 10)
                 .map_err(|e| format!("{:?}", e))?;
             if !matches.is_present("cwnd_cap") {
@@ -4,26 +4,156 @@ extern crate slog;
 use portus::ipc::Ipc;
 use portus::lang::Scope;
 use portus::{CongAlg, Datapath, DatapathInfo, DatapathTrait, Report};
-use slog::debug;
+use slog::{debug, info};
 use std::collections::HashMap;
+use std::time::Instant;
+
+/// Reports at the start of a step that are left out of its stats, while the queue settles to the
+/// new cwnd or rate. There is about one report per RTT
+const SETTLE_REPORTS: u32 = 4;
+
+/// One step of a schedule
+#[derive(Clone, Copy, Debug, PartialEq)]
+pub struct Step {
+    /// Time since the flow started, in microseconds
+    pub start_us: u64,
+    /// Bytes
+    pub cwnd: u32,
+    /// Bytes/sec, 0 to only set cwnd
+    pub rate: u32,
+}
 
 #[derive(Clone)]
 pub enum Constant {
     Cwnd(u32),
     Rate { rate: u32, cwnd_cap: u32 },
+    // Steps sorted by start time, applied to every flow from its start. The last step is held
+    // for the rest of the flow
+    Schedule(Vec<Step>),
 }
+
 pub struct CcpConstAlg {
     pub logger: Option<slog::Logger>,
     pub const_param: Constant,
 }
 
-pub struct CcpConstFlow {
+/// Averages of what one step achieved
+#[derive(Clone, Copy, Debug, Default, PartialEq)]
+pub struct StepStats {
+    n_seen: u32,
+    pub n_reports: u32,
+    sum_rtt: u64,
+    pub min_rtt: u32,
+    pub max_rtt: u32,
+    sum_rin: u64,
+    sum_rout: u64,
+}
+
+impl StepStats {
+    fn add(&mut self, rtt: u32, rin: u32, rout: u32) {
+        self.n_seen += 1;
+        if self.n_seen <= SETTLE_REPORTS {
+            return;
+        }
+        if self.n_reports == 0 || rtt < self.min_rtt {
+            self.min_rtt = rtt;
+        }
+        self.max_rtt = std::cmp::max(self.max_rtt, rtt);
+        self.n_reports += 1;
+        self.sum_rtt += rtt as u64;
+        self.sum_rin += rin as u64;
+        self.sum_rout += rout as u64;
+    }
+
+    fn avg(&self, sum: u64) -> u64 {
+        if self.n_reports == 0 {
+            0
+        } else {
+            sum / self.n_reports as u64
+        }
+    }
+
+    pub fn avg_rtt(&self) -> u64 {
+        self.avg(self.sum_rtt)
+    }
+
+    pub fn avg_rin(&self) -> u64 {
+        self.avg(self.sum_rin)
+    }
+
+    pub fn avg_rout(&self) -> u64 {
+        self.avg(self.sum_rout)
+    }
+}
+
+pub struct CcpConstFlow<I: Ipc> {
     logger: Option<slog::Logger>,
     sc: Scope,
+    control: Datapath<I>,
+    sock_id: u32,
+    /// Empty unless `Constant::Schedule`
+    steps: Vec<Step>,
+    start: Instant,
+    curr_step: usize,
+    stats: StepStats,
+}
+
+/// Index of the step in effect `elapsed_us` after the start
+pub fn step_at(steps: &[Step], elapsed_us: u64) -> usize {
+    steps
+        .iter()
+        .rposition(|s| s.start_us <= elapsed_us)
+        .unwrap_or(0)
+}
+
+/// Values from `from` to `to` (included, in either direction) by `by`
+pub fn staircase(from: u32, to: u32, by: u32) -> Vec<u32> {
+    let by = std::cmp::max(by, 1) as usize;
+    if from <= to {
+        (from..=to).step_by(by).collect()
+    } else {
+        (to..=from).rev().step_by(by).collect()
+    }
+}
+
+/// Parses `T_MS:VALUE[,T_MS:VALUE...]` into (start in microseconds, value), sorted by time
+pub fn parse_schedule(s: &str) -> Result<Vec<(u64, u32)>, String> {
+    let mut steps = s
+        .split(',')
+        .map(|step| {
+            let mut kv = step.splitn(2, ':');
+            match (kv.next(), kv.next()) {
+                (Some(t), Some(v)) => {
+                    let t_ms = t.trim().parse::<u64>().map_err(|e| format!("{:?}", e))?;
+                    let v = v.trim().parse::<u32>().map_err(|e| format!("{:?}", e))?;
+                    Ok((t_ms * 1000, v))
+                }
+                _ => Err(format!("expected T_MS:VALUE, got {}", step)),
+            }
+        })
+        .collect::<Result<Vec<_>, String>>()?;
+    steps.sort_by_key(|&(t, _)| t);
+    Ok(steps)
+}
+
+/// Parses `FROM:TO:BY:DWELL_MS` into the steps of the staircase, `DWELL_MS` apart
+pub fn parse_sweep(s: &str) -> Result<Vec<(u64, u32)>, String> {
+    let v = s
+        .split(':')
+        .map(|v| v.trim().parse::<u32>().map_err(|e| format!("{:?}", e)))
+        .collect::<Result<Vec<_>, String>>()?;
+    if v.len() != 4 {
+        return Err(format!("expected FROM:TO:BY:DWELL_MS, got {}", s));
+    }
+    Ok(staircase(v[0], v[1], v[2])
+        .into_iter()
+        .enumerate()
+        .map(|(i, value)| (i as u64 * v[3] as u64 * 1000, value))
+        .collect())
 }
 
 impl<I: Ipc> CongAlg<I> for CcpConstAlg {
-    type Flow = CcpConstFlow;
+    type Flow = CcpConstFlow<I>;
 
     fn name() -> &'static str {
         "constant"
@@ -41,8 +171,8 @@ impl<I: Ipc> CongAlg<I> for CcpConstAlg {
             ))
             (when true
                 (:= Report.rtt Flow.rtt_sample_us)
-                (:= Report.rin Flow.rate_outgoing)
-                (:= Report.rout Flow.rate_incoming)
+                (:= Report.rin Flow.rate_incoming)
+                (:= Report.rout Flow.rate_outgoing)
                 (fallthrough)
             )
             (when (> Micros Flow.rtt_sample_us)
@@ -56,22 +186,78 @@ impl<I: Ipc> CongAlg<I> for CcpConstAlg {
     }
 
     fn new_flow(&self, mut control: Datapath<I>, info: DatapathInfo) -> Self::Flow {
+        let steps = match self.const_param {
+            Constant::Schedule(ref steps) => steps.clone(),
+            _ => vec![],
+        };
         let params = match self.const_param {
             Constant::Cwnd(c) => vec![("Cwnd", c)],
             Constant::Rate {
                 rate: r,
                 cwnd_cap: c,
             } => vec![("Cwnd", c), ("Rate", r)],
+            Constant::Schedule(_) => step_fields(&steps[0]),
         };
         let sc = control.set_program("constant", Some(&params)).unwrap();
         CcpConstFlow {
             logger: self.logger.clone(),
             sc,
+            control,
+            sock_id: info.sock_id,
+            steps,
+            start: Instant::now(),
+            curr_step: 0,
+            stats: Default::default(),
         }
     }
 }
 
-impl portus::Flow for CcpConstFlow {
+fn step_fields(step: &Step) -> Vec<(&'static str, u32)> {
+    if step.rate == 0 {
+        vec![("Cwnd", step.cwnd)]
+    } else {
+        vec![("Cwnd", step.cwnd), ("Rate", step.rate)]
+    }
+}
+
+impl<I: Ipc> CcpConstFlow<I> {
+    /// Logs what the current step achieved
+    fn log_step(&self) {
+        let step = &self.steps[self.curr_step];
+        let stats = &self.stats;
+        self.logger.as_ref().map(|log| {
+            info!(log, "step";
+                "sock_id" => self.sock_id,
+                "step" => self.curr_step,
+                "start(ms)" => step.start_us / 1000,
+                "cwnd(B)" => step.cwnd,
+                "rate(Bps)" => step.rate,
+                "n_reports" => stats.n_reports,
+                "rtt_avg(us)" => stats.avg_rtt(),
+                "rtt_min(us)" => stats.min_rtt,
+                "rtt_max(us)" => stats.max_rtt,
+                "rin_avg(Bps)" => stats.avg_rin(),
+                "rout_avg(Bps)" => stats.avg_rout(),
+            );
+        });
+    }
+
+    fn follow_schedule(&mut self, rtt: u32, rin: u32, rout: u32) {
+        let elapsed_us = self.start.elapsed().as_micros() as u64;
+        let step = step_at(&self.steps, elapsed_us);
+        if step != self.curr_step {
+            self.log_step();
+            self.curr_step = step;
+            self.stats = Default::default();
+            self.control
+                .update_field(&self.sc, &step_fields(&self.steps[step]))
+                .unwrap();
+        }
+        self.stats.add(rtt, rin, rout);
+    }
+}
+
+impl<I: Ipc> portus::Flow for CcpConstFlow<I> {
     fn on_report(&mut self, _sock_id: u32, m: Report) {
         let rtt = m
             .get_field("Report.rtt", &self.sc)
@@ -90,5 +276,86 @@ impl portus::Flow for CcpConstFlow {
                 "rout(Bps)" => rout,
             );
         });
+
+        if !self.steps.is_empty() {
+            self.follow_schedule(rtt, rin, rout);
+        }
+    }
+}
+
+impl<I: Ipc> Drop for CcpConstFlow<I> {
+    fn drop(&mut self) {
+        // the last step ends with the flow
+        if !self.steps.is_empty() {
+            self.log_step();
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn steps(starts: &[u64]) -> Vec<Step> {
+        starts
+            .iter()
+            .map(|&start_us| Step {
+                start_us,
+                cwnd: 0,
+                rate: 0,
+            })
+            .collect()
+    }
+
+    #[test]
+    fn step_lookup() {
+        let s = steps(&[0, 1000, 5000]);
+        assert_eq!(step_at(&s, 0), 0);
+        assert_eq!(step_at(&s, 999), 0);
+        assert_eq!(step_at(&s, 1000), 1);
+        assert_eq!(step_at(&s, 4999), 1);
+        assert_eq!(step_at(&s, 1_000_000), 2);
+        // before the first step the first one is held
+        assert_eq!(step_at(&steps(&[10]), 0), 0);
+    }
+
+    #[test]
+    fn staircase_both_ways() {
+        assert_eq!(staircase(10, 40, 10), vec![10, 20, 30, 40]);
+        assert_eq!(staircase(10, 35, 10), vec![10, 20, 30]);
+        assert_eq!(staircase(40, 10, 10), vec![40, 30, 20, 10]);
+        assert_eq!(staircase(5, 5, 0), vec![5]);
+    }
+
+    #[test]
+    fn parse() {
+        assert_eq!(
+            parse_schedule("5000:20, 0:10").unwrap(),
+            vec![(0, 10), (5_000_000, 20)]
+        );
+        assert!(parse_schedule("0:10,5000").is_err());
+        assert_eq!(
+            parse_sweep("10:30:10:2000").unwrap(),
+            vec![(0, 10), (2_000_000, 20), (4_000_000, 30)]
+        );
+        assert!(parse_sweep("10:30:10").is_err());
+    }
+
+    #[test]
+    fn stats_skip_settling() {
+        let mut stats = StepStats::default();
+        for _ in 0..SETTLE_REPORTS {
+            stats.add(1_000_000, 1, 1);
+        }
+        assert_eq!(stats.n_reports, 0);
+        assert_eq!(stats.avg_rtt(), 0);
+        stats.add(100, 10, 20);
+        stats.add(300, 30, 40);
+        assert_eq!(stats.n_reports, 2);
+        assert_eq!((stats.min_rtt, stats.max_rtt), (100, 300));
+        assert_eq!(
+            (stats.avg_rtt(), stats.avg_rin(), stats.avg_rout()),
+            (200, 20, 30)
+        );
     }
 }
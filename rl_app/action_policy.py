@@ -0,0 +1,229 @@
+"""
+  Client side policies that pick the action of a step for which no action
+  arrived from the agent in time (a skipped step), and the planner the agent
+  uses to send several actions at once.
+
+  Only numpy is needed, so that the client stays cheap to start.
+"""
+import numpy as np
+
+# Breakout-v0 actions
+NOOP, FIRE, RIGHT, LEFT = 0, 1, 2, 3
+
+# Layout of Breakout on the 84x84 observations the client sends. The ball and
+# the paddle are the only red objects below the bricks between the side walls,
+# on a black background.
+PADDLE_ROWS = (74, 79)
+BALL_ROWS = (38, 74)
+FIELD_COLS = (4, 80)
+# do not move the paddle when the ball lands this close to its center
+PADDLE_MARGIN = 2
+# columns the paddle moves per step when pushed right or left
+PADDLE_SPEED = 2.
+# The resize to 84x84 blends the ball with the background, down to this much
+# red on some frames
+RED_MIN = 20
+
+
+def red_mask(frame):
+  """Pixels of the ball and the paddle in an RGB frame."""
+  red, green, blue = np.moveaxis(frame.astype(np.int32), -1, 0)
+  return (red > RED_MIN) & (red > 2 * green) & (red > 2 * blue)
+
+
+def _center(mask, weight):
+  """(row, col) center of the set pixels, weighted by `weight` so that the
+  pixels the object only partly covers count less. None if there are
+  none."""
+  rows, cols = np.nonzero(mask)
+  if len(rows) == 0:
+    return None
+  w = weight[rows, cols]
+  return np.average(rows, weights=w), np.average(cols, weights=w)
+
+
+def locate(frame):
+  """Returns (paddle col, ball (row, col)) in the frame. Either is None when
+  it is not visible."""
+  # the side walls have red stripes at the height of the paddle
+  field = frame[:, FIELD_COLS[0]:FIELD_COLS[1]]
+  mask = red_mask(field)
+  red = field[:, :, 0]
+  paddle = _center(mask[PADDLE_ROWS[0]:PADDLE_ROWS[1]],
+                   red[PADDLE_ROWS[0]:PADDLE_ROWS[1]])
+  ball = _center(mask[BALL_ROWS[0]:BALL_ROWS[1]],
+                 red[BALL_ROWS[0]:BALL_ROWS[1]])
+  if ball is not None:
+    ball = (ball[0] + BALL_ROWS[0], ball[1] + FIELD_COLS[0])
+  return (None if paddle is None else paddle[1] + FIELD_COLS[0]), ball
+
+
+def ball_motion(obs):
+  """Returns (ball (row, col) in the latest frame, its motion (rows, cols)
+  per frame) from a stacked observation. The ball moves about a pixel per
+  frame, so the motion is measured between the oldest and the newest frames
+  the ball is in, and the position is extrapolated when it is not in the
+  latest one. (None, None) if the ball is in no frame, the motion is None if
+  it is in only one."""
+  n = obs.shape[-1]
+  seen = [(i, locate(obs[:, :, :, i])[1]) for i in range(n)]
+  seen = [(i, ball) for i, ball in seen if ball is not None]
+  if not seen:
+    return None, None
+  (i0, (r0, c0)), (i1, (r1, c1)) = seen[0], seen[-1]
+  if i0 == i1:
+    return (r1, c1), None
+  motion = ((r1 - r0) / (i1 - i0), (c1 - c0) / (i1 - i0))
+  age = n - 1 - i1
+  return (r1 + motion[0] * age, c1 + motion[1] * age), motion
+
+
+def landing_col(ball, motion):
+  """Column where the ball at `ball` moving by `motion` per frame reaches the
+  paddle, bouncing off the side walls. None if the ball moves up."""
+  (r1, c1), (dr, dc) = ball, motion
+  if dr <= 0:
+    return None
+  steps = (PADDLE_ROWS[0] - r1) / dr
+  col = c1 + dc * steps
+  # fold the straight line back into the field
+  lo, hi = FIELD_COLS
+  width = hi - lo
+  col = (col - lo) % (2 * width)
+  if col > width:
+    col = 2 * width - col
+  return lo + col
+
+
+def paddle_action(obs, default):
+  """Action moving the paddle under the point where the ball will land.
+
+    Args:
+        obs: stacked observation of shape (84, 84, 3, FRAME_HISTORY).
+        default: action returned when the ball is not falling.
+  """
+  paddle, _ = locate(obs[:, :, :, -1])
+  if paddle is None:
+    return default
+  ball, motion = ball_motion(obs)
+  if ball is None:
+    # ball out of play, serve it again
+    return FIRE
+  target = landing_col(ball, motion) if motion is not None else None
+  if target is None:
+    # ball going up, follow it
+    target = ball[1]
+  if target > paddle + PADDLE_MARGIN:
+    return RIGHT
+  if target < paddle - PADDLE_MARGIN:
+    return LEFT
+  return NOOP
+
+
+def plan_actions(obs, first_action, plan_len):
+  """Plan of plan_len actions starting with first_action. The following
+  actions keep moving the paddle, simulated at PADDLE_SPEED, under where the
+  ball will land. Pads with first_action when the ball or the paddle cannot
+  be found.
+
+    Args:
+        obs: stacked observation of shape (84, 84, 3, FRAME_HISTORY).
+  """
+  plan = [int(first_action)]
+  paddle, _ = locate(obs[:, :, :, -1])
+  ball, motion = ball_motion(obs)
+  if paddle is None or motion is None:
+    return plan * plan_len
+  for i in range(1, plan_len):
+    if plan[-1] == RIGHT:
+      paddle += PADDLE_SPEED
+    elif plan[-1] == LEFT:
+      paddle -= PADDLE_SPEED
+    paddle = min(max(paddle, FIELD_COLS[0]), FIELD_COLS[1])
+    target = landing_col(ball, motion)
+    if target is None:
+      # ball going up, follow where it will be
+      target = ball[1] + motion[1] * i
+    if target > paddle + PADDLE_MARGIN:
+      plan.append(RIGHT)
+    elif target < paddle - PADDLE_MARGIN:
+      plan.append(LEFT)
+    else:
+      plan.append(NOOP)
+  return plan
+
+
+class RepeatPolicy:
+  """Repeats the last action for `frameskip` skipped steps, then plays the
+  noop action."""
+
+  def __init__(self, frameskip, noop_action):
+    self.frameskip = frameskip
+    self.noop_action = noop_action
+    self.n_default_actions = 0
+    self.reset()
+
+  def reset(self):
+    self._prev_action = self.noop_action
+    self._obs = None
+
+  def observe(self, obs):
+    """Called with the observation of every step."""
+    self._obs = obs
+
+  def on_action(self, act):
+    """Called with every action chosen for a step."""
+    self._prev_action = act
+
+  def default_action(self, skip_count):
+    """Action for a skipped step, skip_count steps after the last action
+    received from the agent."""
+    self.n_default_actions += 1
+    if skip_count < self.frameskip:
+      return self._prev_action
+    return self.noop_action
+
+  def stats(self):
+    return dict(n_default_actions=self.n_default_actions)
+
+
+class LatestActionPolicy(RepeatPolicy):
+  """Repeats the last action for as long as no new action arrives."""
+
+  def default_action(self, skip_count):
+    self.n_default_actions += 1
+    return self._prev_action
+
+
+class PaddlePolicy(RepeatPolicy):
+  """Moves the paddle towards where the ball will land, from the positions of
+  the ball in the stacked frames. Falls back to the latest action when the
+  paddle is not visible."""
+
+  def __init__(self, frameskip, noop_action):
+    super().__init__(frameskip, noop_action)
+    self.n_predicted_actions = 0
+
+  def default_action(self, skip_count):
+    self.n_default_actions += 1
+    if self._obs is None:
+      return self._prev_action
+    self.n_predicted_actions += 1
+    return paddle_action(self._obs, self._prev_action)
+
+  def stats(self):
+    return dict(n_default_actions=self.n_default_actions,
+                n_predicted_actions=self.n_predicted_actions)
+
+
+POLICIES = {
+    'repeat': RepeatPolicy,
+    'latest': LatestActionPolicy,
+    'paddle': PaddlePolicy,
+}
+
+
+def make_policy(name, frameskip, noop_action):
+  if name not in POLICIES:
+    raise Exception('Unknown action policy %s' % name)
+  return POLICIES[name](frameskip, noop_action)
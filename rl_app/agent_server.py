@@ -1,20 +1,23 @@
 import argparse
+import functools
 import os
 import sys
 import time
 from collections import deque
 from threading import Thread, Lock
 
-import gym
 import numpy as np
 import queue
 import tensorflow as tf
 from absl import app
-from rl_app.gameplay import GamePlay
+from rl_app import latency
+from rl_app.action_policy import plan_actions
+from rl_app.frame_codec import decode_obs
 from rl_app.model import Model, STATE_SHAPE, FRAME_HISTORY
 from rl_app.network.network import Receiver, Sender
-from rl_app.util import Timer, put_overwrite
-from scripts.download_model import ENV_TO_FNAME, MODEL_CACHE_DIR
+from rl_app.util import Mailbox, Timer
+from scripts.download_model import (ENV_TO_FNAME, ENV_TO_NUM_ACTIONS,
+                                    MODEL_CACHE_DIR)
 from tensorpack import *
 
 parser = argparse.ArgumentParser()
@@ -26,20 +29,80 @@ parser.add_argument('--model_fname',
                     type=str,
                     default=None,
                     help='Optional string to specify the model weights')
-parser.add_argument('--time', required=True, type=int)
+parser.add_argument('--time',
+                    required=True,
+                    type=int,
+                    help='Max duration of a game session in seconds')
+parser.add_argument('--daemon',
+                    dest='daemon',
+                    action='store_true',
+                    help='Keep the model loaded and serve game sessions '
+                    'one after another instead of exiting after the first')
+parser.add_argument('--plan_len',
+                    type=int,
+                    default=1,
+                    help='Send a plan of this many actions with every action, '
+                    'that the client plays until a fresher action arrives')
+parser.add_argument('--max_frame_age',
+                    type=float,
+                    default=None,
+                    help='Drop frames that waited more than this many ms '
+                    'longer than the youngest frame of the session instead '
+                    'of running inference on them')
 parser.add_argument('--verbose', dest='verbose', action='store_true')
+parser.add_argument('--cc_fallback',
+                    type=str,
+                    default=None,
+                    help='Congestion control to use if ccp is not loaded')
 
 
 def get_num_actions(env_name):
+  if env_name in ENV_TO_NUM_ACTIONS:
+    return ENV_TO_NUM_ACTIONS[env_name]
+  # gym is slow to import and is otherwise not needed by the agent.
+  import gym
   env = gym.make(env_name)
   return env.action_space.n
 
 
 class Agent:
 
-  def __init__(self, env_name, frames_port, action_port, n_cpu, model_fname,
-               time, verbose):
+  def __init__(self,
+               env_name,
+               frames_port,
+               action_port,
+               n_cpu,
+               model_fname,
+               time,
+               verbose,
+               daemon=False,
+               cc_fallback=None,
+               plan_len=1,
+               max_frame_age=None):
 
+    self.pred = self._make_predictor(env_name, model_fname, n_cpu)
+    self.verbose = verbose
+    # frames are tagged with the session they arrived in, so this mailbox
+    # outlives sessions. The rest of the per-session state is set up in
+    # _new_session.
+    self._frames_q = Mailbox()
+    self._actions_q = None
+    self._gameover_q = None
+    self._session_id = 0
+    self.n_cpu = n_cpu
+    self.frames_port = frames_port
+    self.action_port = action_port
+    self.frames_started = False
+    self.time = time
+    self.daemon = daemon
+    self.cc_fallback = cc_fallback
+    self.plan_len = plan_len
+    self.max_frame_age = max_frame_age
+    self.frame_stats = None
+    self.lock = Lock()
+
+  def _make_predictor(self, env_name, model_fname, n_cpu):
+    """Returns a callable mapping a batch of states to [policy]."""
     model_fname = model_fname or os.path.join(MODEL_CACHE_DIR,
                                               ENV_TO_FNAME[env_name])
     num_actions = get_num_actions(env_name)
@@ -48,7 +111,7 @@ class Agent:
           'Download model weights into %s before starting the agent. See Instructions for details.'
           % model_fname)
 
-    self.pred = OfflinePredictor(
+    return OfflinePredictor(
         PredictConfig(
             model=Model(num_actions),
             session_init=SmartInit(model_fname),
@@ -58,44 +121,84 @@ class Agent:
                 config=tf.ConfigProto(intra_op_parallelism_threads=n_cpu,
                                       inter_op_parallelism_threads=n_cpu))))
 
-    self.verbose = verbose
-    self._actions_q = queue.Queue(1)
-    self._frames_q = queue.Queue(1)
-    self.n_cpu = n_cpu
-    self.frames_port = frames_port
-    self.action_port = action_port
-    self._gameover_q = queue.Queue(1)
-    self.frames_started = False
-    self.time = time
-    self.lock = Lock()
-
   def start(self):
     self._warmup()
+    self._process_thread = Thread(target=self._process)
+    self._process_thread.daemon = True
+    self._process_thread.start()
+    while True:
+      self._run_session()
+      if not self.daemon:
+        break
+      print('')
+      print('Session %d over. Waiting for the next game...' % self._session_id)
+    print('Agent server exiting...')
+
+  def _new_session(self):
+    """Resets the per-session state before accepting a new game."""
+    with self.lock:
+      self._session_id += 1
+      self._frames_q.clear()
+      self._frames_overwritten = self._frames_q.n_overwritten
+      self._actions_q = Mailbox()
+      self._gameover_q = queue.Queue(1)
+      self.frames_started = False
+      # frames overwritten in the mailbox by a newer one, dropped for being
+      # too old and run through the network
+      self.frame_stats = dict(n_received=0,
+                              n_coalesced=0,
+                              n_stale=0,
+                              n_inferred=0)
+      # smallest age of a frame seen this session, so that the clock offset
+      # between client and agent cancels out of the age
+      self._min_frame_age = float('inf')
+      self._last_infer_t = 0
+
+  def _run_session(self):
+    self._new_session()
     self._frames_socket = Receiver(host='0.0.0.0',
                                    port=self.frames_port,
                                    bind=True,
-                                   verbose=self.verbose)
+                                   verbose=self.verbose,
+                                   cc_fallback=self.cc_fallback)
     self._actions_socket = Sender(host='0.0.0.0',
                                   port=self.action_port,
-                                  bind=True)
+                                  bind=True,
+                                  cc_fallback=self.cc_fallback)
     self._frames_socket.start_loop(
-        self.record_frame,
+        functools.partial(self.record_frame, session_id=self._session_id),
         new_connection_callback=self._traffic_frames_started,
         blocking=False)
     self._actions_socket.start_loop(self._put_action, blocking=False)
-    self._process_thread = Thread(target=self._process)
-    self._process_thread.daemon = True
-    self._process_thread.start()
-    start_t = time.time()
-    while time.time() < start_t + self.time + 5:
-      if self.frames_started and self._frames_socket.connected:
+    end_t = time.time() + self.time + 5
+    while time.time() < end_t:
+      if not self.frames_started:
+        if self.daemon:
+          # the session clock only starts once a client shows up.
+          end_t = time.time() + self.time + 5
+      elif not self._frames_socket.connected:
+        break
+      else:
         try:
           self._gameover_q.get_nowait()
           break
         except queue.Empty:
           pass
       time.sleep(.5)
-    print('Agent server exiting...')
+    self._end_session()
+
+  def _end_session(self):
+    self.frame_stats['n_coalesced'] = (self._frames_q.n_overwritten -
+                                       self._frames_overwritten)
+    print('')
+    print('Session %d frames: %s' % (self._session_id, ', '.join(
+        ['%s=%d' % kv for kv in sorted(self.frame_stats.items())])))
+    actions_q = self._actions_q
+    self._frames_socket.close()
+    self._actions_socket.close()
+    # wakes up the action sender in case it is blocked on an empty mailbox.
+    with self.lock:
+      actions_q.put(None)
 
   def _warmup(self):
     # warmup tensorflow
@@ -105,41 +208,81 @@ class Agent:
   def _traffic_frames_started(self, *args):
     self.frames_started = True
 
-  def _wrap_action(self, act, frame_metadata):
-    act = dict(action=act, **frame_metadata)
+  def _wrap_action(self, act, frame_metadata, plan=None):
+    act = dict(action=act, agent_boot_id=latency.boot_id(), **frame_metadata)
+    if plan is not None:
+      act['plan'] = plan
     return act
 
   def _unwrap_frame(self, frame):
-    obs = GamePlay.decode_obs(frame['encoded_obs'])
+    obs = decode_obs(frame['encoded_obs'])
     del frame['encoded_obs']
     return obs, frame
 
+  def _is_stale(self, frame):
+    """Whether the frame waited more than max_frame_age longer than the
+    youngest frame of the session. Frames are never dropped for longer than
+    max_frame_age in a row, so that a constantly late link still gets
+    actions."""
+    if self.max_frame_age is None:
+      return False
+    now = time.time()
+    age = now - frame['frame_timestamp']
+    self._min_frame_age = min(self._min_frame_age, age)
+    if (age - self._min_frame_age) * 1e3 <= self.max_frame_age:
+      return False
+    return (now - self._last_infer_t) * 1e3 < self.max_frame_age
+
   def _process(self):
     """deques the frames and runs prediction network on them."""
     while True:
       with Timer() as data_timer:
-        frame = self._frames_q.get()
+        session_id, frame = self._frames_q.get()
+
+      with self.lock:
+        if session_id != self._session_id:
+          continue
+        if self._is_stale(frame):
+          self.frame_stats['n_stale'] += 1
+          continue
+        self.frame_stats['n_inferred'] += 1
+        self._last_infer_t = time.time()
 
       with Timer() as agent_timer:
+        latency.stamp(frame, 'infer_start')
         s, frame_metadata = self._unwrap_frame(frame)
         s = np.expand_dims(s, 0)  # batch
         act = self.pred(s)[0][0].argmax()
-        put_overwrite(self._actions_q, self._wrap_action(act, frame_metadata))
+        plan = None
+        if self.plan_len > 1:
+          plan = plan_actions(s[0], act, self.plan_len)
+        latency.stamp(frame_metadata, 'infer_end')
+        with self.lock:
+          # drop actions computed for a session that has since ended.
+          if session_id == self._session_id:
+            self._actions_q.put(self._wrap_action(act, frame_metadata, plan))
 
       print('.', end='', flush=True)
       if self.verbose:
         print('Avg data wait time: %.3f' % data_timer.time())
         print('Avg agent neural net eval time: %.3f' % agent_timer.time())
 
-  def record_frame(self, frame):
+  def record_frame(self, frame, session_id):
     if frame is None:
       self._gameover_q.put(1)
       return
 
-    put_overwrite(self._frames_q, frame, key='frame_q')
+    latency.stamp(frame, 'agent_recv')
+    # a frame still waiting for inference is superseded by the newer one
+    self._frames_q.put((session_id, frame))
+    with self.lock:
+      if session_id == self._session_id:
+        self.frame_stats['n_received'] += 1
 
   def _put_action(self):
-    return self._actions_q.get()
+    act = self._actions_q.get()
+    latency.stamp(act, 'action_send')
+    return act
 
 
 def main(argv):
@@ -150,7 +293,11 @@ def main(argv):
                 n_cpu=args.n_cpu,
                 model_fname=args.model_fname,
                 time=args.time,
-                verbose=args.verbose)
+                verbose=args.verbose,
+                daemon=args.daemon,
+                cc_fallback=args.cc_fallback,
+                plan_len=args.plan_len,
+                max_frame_age=args.max_frame_age)
   agent.start()
 
 
@@ -0,0 +1,228 @@
+"""
+  Loads the time series a game leaves in its results directory (ping.txt,
+  tcp_info_*.npy, cwnd.json, game_stats.json and latency_breakdown.csv) into
+  numpy arrays on a common clock and summarizes them into percentiles.
+
+  The client only calls `update_results` after the game. Plots are drawn in a
+  separate process, e.g.
+  python3 -m rl_app.analysis --plot /tmp/base/test/game_results
+"""
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+from rl_app import latency
+
+PERCENTILES = [50, 90, 95, 99]
+# with `ping -D`, every reply is prefixed by [unix time]
+PING_RE = re.compile(r'^(?:\[([\d.]+)\] )?\d+ bytes from .*time=([\d.]+) ms',
+                     re.MULTILINE)
+PING_INTERVAL = .2
+
+parser = argparse.ArgumentParser()
+parser.add_argument('results_dir', type=str, nargs='+')
+parser.add_argument('--plot', dest='plot', action='store_true')
+parser.add_argument('--no_summary',
+                    dest='summary',
+                    action='store_false',
+                    help='Do not add the summary to results.json')
+
+
+def load_ping(fname):
+  """Returns (timestamps, rtt in ms) of the ping replies. Without `ping -D`
+  the timestamps count from 0 at the ping interval."""
+  if not os.path.exists(fname):
+    return np.zeros(0), np.zeros(0)
+  with open(fname) as f:
+    matches = PING_RE.findall(f.read())
+  if not matches:
+    return np.zeros(0), np.zeros(0)
+  t, rtt = np.array(matches).T
+  rtt = rtt.astype(np.float64)
+  if t[0]:
+    t = t.astype(np.float64)
+  else:
+    t = np.arange(len(rtt)) * PING_INTERVAL
+  return t, rtt
+
+
+def load_cwnd(fname):
+  """Returns (timestamps, cwnd in bytes) sampled by the client."""
+  if not os.path.exists(fname):
+    return np.zeros(0), np.zeros(0)
+  with open(fname) as f:
+    l = json.load(f)
+  arr = np.array(l, dtype=np.float64).reshape(-1, 2)
+  return arr[:, 0], arr[:, 1]
+
+
+def load_tcp_info(fname):
+  """Returns the samples of rl_app.network.tcp_info.TcpInfoSampler, with
+  the fields of struct tcp_info and the sample time `t`."""
+  if not os.path.exists(fname):
+    return None
+  return np.load(fname)
+
+
+def load_game_stats(fname):
+  """Returns a dict of arrays, one per GameStat field. Fields that are None
+  for skipped actions are NaN."""
+  with open(fname) as f:
+    l = json.load(f)
+  ret = {}
+  for k in (l[0].keys() if l else []):
+    ret[k] = np.array([s[k] for s in l], dtype=np.float64)
+  if 'is_skip_action' in ret:
+    ret['is_skip_action'] = ret['is_skip_action'].astype(bool)
+  return ret
+
+
+def align(t_ref, t, y):
+  """Value of the series (t, y) last sampled at or before each t_ref. NaN
+  before the first sample."""
+  if len(t) == 0:
+    return np.full(len(t_ref), np.nan)
+  idx = np.searchsorted(t, t_ref, side='right') - 1
+  ret = y[np.maximum(idx, 0)].astype(np.float64)
+  ret[idx < 0] = np.nan
+  return ret
+
+
+def load_run(results_dir):
+  """Game stats with the ping rtt, the cwnd and the tcp_info of the frames
+  socket aligned to every step. Steps are on the `time` axis, in seconds from
+  the first step."""
+  stats = load_game_stats(os.path.join(results_dir, 'game_stats.json'))
+  ping_t, rtt = load_ping(os.path.join(results_dir, 'ping.txt'))
+  cwnd_t, cwnd = load_cwnd(os.path.join(results_dir, 'cwnd.json'))
+  tcp_info = load_tcp_info(os.path.join(results_dir, 'tcp_info_frames.npy'))
+  if 'timestamp' not in stats:
+    return stats
+  t = stats['timestamp']
+  stats['time'] = t - t[0] if len(t) else t
+  stats['cwnd'] = align(t, cwnd_t, cwnd)
+  # only timestamped pings share the clock of the game
+  if len(ping_t) and ping_t[0] > 0:
+    stats['rtt_ms'] = align(t, ping_t, rtt)
+  if tcp_info is not None:
+    for k, name in [('rtt', 'srtt'), ('rttvar', 'rttvar'), ('min_rtt', 'min_rtt')]:
+      stats['%s_ms' % name] = align(t, tcp_info['t'], tcp_info[k] / 1e3)
+    for k in ['delivery_rate', 'pacing_rate', 'notsent_bytes', 'total_retrans']:
+      stats[k] = align(t, tcp_info['t'], tcp_info[k])
+  return stats
+
+
+def skip_bursts(is_skip):
+  """Lengths of the runs of consecutive skipped actions."""
+  padded = np.concatenate([[False], is_skip, [False]]).astype(np.int8)
+  edges = np.diff(padded)
+  return np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+
+
+def _percentiles(name, x):
+  x = x[~np.isnan(x)]
+  ret = {}
+  for q in PERCENTILES:
+    ret['%s_p%d' % (name, q)] = float(np.percentile(x, q)) if len(x) else None
+  ret['%s_max' % name] = float(x.max()) if len(x) else None
+  return ret
+
+
+def summarize(results_dir):
+  """Percentiles of the rtt, the action lag, its breakdown and the skip
+  bursts."""
+  stats = load_game_stats(os.path.join(results_dir, 'game_stats.json'))
+  _, rtt = load_ping(os.path.join(results_dir, 'ping.txt'))
+  tcp_info = load_tcp_info(os.path.join(results_dir, 'tcp_info_frames.npy'))
+  summary = {}
+  summary.update(_percentiles('rtt_ms', rtt))
+  if tcp_info is not None:
+    # the kernel reports 0 until the first rtt sample
+    srtt = tcp_info['rtt'][tcp_info['rtt'] > 0] / 1e3
+    summary.update(_percentiles('srtt_ms', srtt))
+    summary.update(
+        _percentiles('notsent_bytes', tcp_info['notsent_bytes'].astype(float)))
+    summary['total_retrans'] = int(
+        tcp_info['total_retrans'][-1]) if len(tcp_info) else None
+  if stats:
+    summary.update(_percentiles('lag_time_ms', stats['lag_time'] * 1e3))
+    summary.update(_percentiles('lag_n_frames', stats['lag_n_frames']))
+    bursts = skip_bursts(stats['is_skip_action'])
+    summary.update(_percentiles('skip_burst', bursts.astype(np.float64)))
+    summary['n_skip_bursts'] = len(bursts)
+  segments = latency.load_breakdown(
+      os.path.join(results_dir, latency.BREAKDOWN_FNAME))
+  if segments is not None:
+    for name, _, _ in latency.SEGMENTS:
+      summary.update(
+          _percentiles('latency_%s_ms' % name, segments[name + '_ms']))
+  return summary
+
+
+def update_results(results_dir):
+  """Adds the summary to results.json under `metrics`."""
+  fname = os.path.join(results_dir, 'results.json')
+  with open(fname) as f:
+    results = json.load(f)
+  results['metrics'] = summarize(results_dir)
+  with open(fname, 'w') as f:
+    json.dump(results, f, indent=4, sort_keys=True)
+  return results['metrics']
+
+
+def plot_results(results_dir):
+  import matplotlib as mpl
+  mpl.use('Agg')
+  import matplotlib.pyplot as plt
+
+  ping_t, rtt = load_ping(os.path.join(results_dir, 'ping.txt'))
+  if len(rtt):
+    plt.figure()
+    plt.plot(rtt)
+    plt.ylabel('milli seconds')
+    plt.savefig(fname=os.path.join(results_dir, 'ping.png'))
+    plt.close()
+
+  tcp_info = load_tcp_info(os.path.join(results_dir, 'tcp_info_frames.npy'))
+  if tcp_info is not None and len(tcp_info):
+    plt.figure()
+    plt.plot(tcp_info['t'] - tcp_info['t'][0], tcp_info['rtt'] / 1e3)
+    plt.xlabel('seconds')
+    plt.ylabel('srtt (ms)')
+    plt.savefig(fname=os.path.join(results_dir, 'srtt.png'))
+    plt.close()
+
+  cwnd_t, cwnd = load_cwnd(os.path.join(results_dir, 'cwnd.json'))
+  if len(cwnd):
+    plt.figure()
+    plt.plot(cwnd_t - cwnd_t[0], cwnd)
+    plt.xlabel('seconds')
+    plt.ylabel('cwnd')
+    plt.savefig(fname=os.path.join(results_dir, 'cwnd.png'))
+    plt.close()
+
+  stats = load_game_stats(os.path.join(results_dir, 'game_stats.json'))
+  if 'timestamp' in stats:
+    t = stats['timestamp'] - stats['timestamp'][0]
+    plt.figure()
+    plt.plot(t, stats['lag_time'] * 1e3, '.', markersize=2)
+    plt.xlabel('seconds')
+    plt.ylabel('action lag (ms)')
+    plt.savefig(fname=os.path.join(results_dir, 'lag.png'))
+    plt.close()
+
+
+def main():
+  args = parser.parse_args()
+  for results_dir in args.results_dir:
+    if args.summary:
+      metrics = update_results(results_dir)
+      print(json.dumps(metrics, indent=4, sort_keys=True))
+    if args.plot:
+      plot_results(results_dir)
+
+
+if __name__ == '__main__':
+  main()
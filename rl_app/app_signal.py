@@ -0,0 +1,104 @@
+"""
+  Side channel from the game client to the congestion controller, so that
+  the controller can size cwnd and rate to what the game actually sends
+  instead of probing for capacity it never uses.
+
+  Every `interval` seconds the client sends one datagram on a unix socket
+  with the stats of the frames socket over that interval. The datagram is
+  40 bytes, little endian:
+
+  magic 'APPS', version u32, t f64 (unix time), src_port u32 (local port of
+  the frames socket, to match the flow of the controller), sps f32 (frames
+  sent per second), frame_bytes f32 (mean frame size), lag_ms f32 (mean
+  action lag), app_limited f32 (fraction of the times the socket could take
+  more data but no frame was ready), demand f32 (bytes/s the game sends,
+  sps * frame_bytes)
+
+  The controller binds the socket and reads it: AppSignalReader in
+  your_code/newcc.py, AppSignals in your_code/newcc/src/app_signal.rs. Both
+  keep the latest signal of every src_port and ignore signals older than a
+  second. Datagrams are dropped while nobody is listening.
+"""
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_PATH = '/tmp/ccp_app_signal.sock'
+MAGIC = b'APPS'
+VERSION = 1
+MESSAGE = struct.Struct('<4sIdIfffff')
+assert MESSAGE.size == 40
+
+class AppSignalPublisher:
+  """Collects the stats of one game and publishes them every `interval`
+  seconds in a background thread."""
+
+  def __init__(self, src_port, path=DEFAULT_PATH, interval=.1):
+    self.src_port = src_port
+    self.path = path
+    self.interval = interval
+    self.n_published = 0
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self._sock.setblocking(False)
+    self._stop = threading.Event()
+    self._thread = None
+    # totals, updated by the game threads
+    self._n_frames = 0
+    self._n_frame_bytes = 0
+    self._n_lags = 0
+    self._sum_lag = 0.
+    self._n_sends = 0
+    self._n_app_limited = 0
+
+  def on_frame(self, frame_size):
+    self._n_frame_bytes += frame_size
+    self._n_frames += 1
+
+  def on_action(self, lag_time):
+    self._sum_lag += lag_time
+    self._n_lags += 1
+
+  def on_send(self, app_limited):
+    """Called every time the frames socket could take more data."""
+    self._n_app_limited += int(app_limited)
+    self._n_sends += 1
+
+  def start(self):
+    self._thread = threading.Thread(target=self._loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+    self._sock.close()
+
+  def _totals(self):
+    return (self._n_frames, self._n_frame_bytes, self._n_lags, self._sum_lag,
+            self._n_sends, self._n_app_limited)
+
+  def _loop(self):
+    prev, prev_t = self._totals(), time.time()
+    while not self._stop.wait(self.interval):
+      cur, t = self._totals(), time.time()
+      n_frames, n_bytes, n_lags, sum_lag, n_sends, n_app_limited = [
+          c - p for c, p in zip(cur, prev)
+      ]
+      prev, elapsed, prev_t = cur, t - prev_t, t
+      sps = n_frames / elapsed
+      frame_bytes = n_bytes / n_frames if n_frames else 0.
+      self._send(
+          MESSAGE.pack(MAGIC, VERSION, t, self.src_port, sps, frame_bytes,
+                       sum_lag / n_lags * 1e3 if n_lags else 0.,
+                       n_app_limited / n_sends if n_sends else 0.,
+                       sps * frame_bytes))
+
+  def _send(self, msg):
+    try:
+      self._sock.sendto(msg, self.path)
+      self.n_published += 1
+    except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+      # no controller listening, or it is not keeping up
+      pass
@@ -0,0 +1,158 @@
+"""
+  Reads the telemetry ring file the congestion controllers (your_code/newcc.py
+  and your_code/newcc, with --telemetry) write, and aligns it with what the
+  game and mahimahi logged.
+
+  The file is a 24 byte header followed by `capacity` records of 48 bytes,
+  all little endian:
+
+  header   magic 'CCTL', version u32, record size u32, capacity u32,
+           number of records written u64
+  record   t f64 (unix time the controller handled the report), now u64
+           (datapath time of the report, us), sock_id u32, cwnd u32
+           (bytes), rate u32 (bytes/s), rtt u32 (us), min_rtt u32 (us),
+           acked u32 (bytes), loss u32 (packets), inflight u32 (packets)
+
+  Record i is stored at slot i % capacity, so once the file is full it holds
+  the last `capacity` reports.
+
+  Example invokation:
+  python3 -m rl_app.cc_telemetry /tmp/newcc_telemetry.bin --results_dir /tmp/base/test/game_results --mm_log /tmp/base/test/mm_uplink.log --csv /tmp/aligned.csv
+"""
+import argparse
+import os
+import struct
+
+import numpy as np
+from rl_app import analysis
+
+MAGIC = b'CCTL'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQ')
+RECORD_DTYPE = np.dtype([
+    ('t', '<f8'),
+    ('now', '<u8'),
+    ('sock_id', '<u4'),
+    ('cwnd', '<u4'),
+    ('rate', '<u4'),
+    ('rtt', '<u4'),
+    ('min_rtt', '<u4'),
+    ('acked', '<u4'),
+    ('loss', '<u4'),
+    ('inflight', '<u4'),
+])
+assert RECORD_DTYPE.itemsize == 48
+
+parser = argparse.ArgumentParser()
+parser.add_argument('telemetry', type=str)
+parser.add_argument('--results_dir',
+                    type=str,
+                    default=None,
+                    help='game_results directory of the same run')
+parser.add_argument('--mm_log',
+                    type=str,
+                    default=None,
+                    help='mahimahi uplink log of the same run')
+parser.add_argument('--csv', type=str, default=None, help='Write the table here')
+
+
+def load_telemetry(fname):
+  """Returns the records of the ring file, oldest first."""
+  with open(fname, 'rb') as f:
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+      raise Exception('Truncated telemetry file %s' % fname)
+    magic, version, record_size, capacity, n_written = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+      raise Exception('Not a telemetry file %s' % fname)
+    if record_size != RECORD_DTYPE.itemsize:
+      raise Exception('Unexpected record size %d' % record_size)
+    records = np.fromfile(f, dtype=RECORD_DTYPE, count=capacity)
+  if n_written <= capacity:
+    return records[:n_written]
+  start = n_written % capacity
+  return np.concatenate([records[start:], records[:start]])
+
+
+def parse_mahimahi_delays(lines):
+  """Returns (unix time in ms, queueing delay in ms) of every departure in
+  the lines of a mahimahi log. mm-link logs times in ms since
+  `# init timestamp:` (unix ms). `# base timestamp:` is relative to it too,
+  so it is not used.
+
+  >>> parse_mahimahi_delays([
+  ...     '# mahimahi mm-link (Uplink) [12mbps.log] > mm_uplink.log',
+  ...     '# command line: mm-link --uplink-queue=droptail 12mbps.log 100mbps.log',
+  ...     '# queue: droptail [packets=100]',
+  ...     '# init timestamp: 1590000000000',
+  ...     '# base timestamp: 37',
+  ...     '37 # 1500',
+  ...     '40 + 1448',
+  ...     '1041 - 1448 20',
+  ... ])
+  ([1590000001041], [20])
+  """
+  init_ms = None
+  t, delay = [], []
+  for line in lines:
+    if line.startswith('# init timestamp:'):
+      init_ms = int(line.split(':')[1])
+    elif not line.startswith('#'):
+      l = line.split()
+      if len(l) == 4 and l[1] == '-':
+        t.append(int(l[0]))
+        delay.append(int(l[3]))
+  if init_ms is None:
+    raise Exception('No init timestamp in the mahimahi log')
+  return [init_ms + x for x in t], delay
+
+
+def load_mahimahi_delays(fname):
+  """Returns (unix time in s, queueing delay in ms) of every departure in a
+  mahimahi log."""
+  with open(fname) as f:
+    t, delay = parse_mahimahi_delays(f)
+  return np.array(t, dtype=np.float64) / 1e3, np.array(delay,
+                                                       dtype=np.float64)
+
+
+def align_run(telemetry_fname, results_dir=None, mm_log=None):
+  """The records of the controller as a dict of arrays, with what was last
+  logged by the game and mahimahi at the time of every record:
+  client_cwnd (cwnd.json), lag_time and frame_size (game_stats.json), and
+  mm_delay_ms (the queueing delay of the last departure)."""
+  records = load_telemetry(telemetry_fname)
+  t = records['t']
+  ret = {k: records[k] for k in RECORD_DTYPE.names}
+  if results_dir is not None:
+    cwnd_t, cwnd = analysis.load_cwnd(os.path.join(results_dir, 'cwnd.json'))
+    ret['client_cwnd'] = analysis.align(t, cwnd_t, cwnd)
+    stats = analysis.load_game_stats(
+        os.path.join(results_dir, 'game_stats.json'))
+    if 'timestamp' in stats:
+      for k in ['lag_time', 'frame_size']:
+        ret[k] = analysis.align(t, stats['timestamp'], stats[k])
+  if mm_log is not None:
+    mm_t, delay = load_mahimahi_delays(mm_log)
+    ret['mm_delay_ms'] = analysis.align(t, mm_t, delay)
+  return ret
+
+
+def main():
+  args = parser.parse_args()
+  table = align_run(args.telemetry, args.results_dir, args.mm_log)
+  print('%d records over %.1f s' %
+        (len(table['t']),
+         table['t'][-1] - table['t'][0] if len(table['t']) else 0))
+  if args.csv:
+    names = list(table.keys())
+    np.savetxt(args.csv,
+               np.stack([table[k].astype(np.float64) for k in names], axis=1),
+               delimiter=',',
+               header=','.join(names),
+               comments='',
+               fmt='%.6f')
+
+
+if __name__ == '__main__':
+  main()
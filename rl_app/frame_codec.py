@@ -0,0 +1,27 @@
+"""
+PNG encoding of stacked observations exchanged between GamePlay and Agent.
+
+Kept free of gym/tensorpack so that both ends can import it cheaply.
+"""
+import cv2
+import numpy as np
+
+FRAME_HISTORY = 4
+
+
+def encode_obs(obs):
+  encoded = []
+  for i in range(FRAME_HISTORY):
+    success, enc = cv2.imencode('.png', obs[:, :, :, i])
+    if not success:
+      raise Exception('Error encountered on encoding function')
+    encoded.append(enc)
+  return encoded
+
+
+def decode_obs(data):
+  assert len(data) == FRAME_HISTORY
+  frames = []
+  for enc_frame in data:
+    frames.append(cv2.imdecode(enc_frame, cv2.IMREAD_UNCHANGED))
+  return np.stack(frames, axis=-1)
@@ -3,6 +3,7 @@ import json
 import subprocess
 import sys
 import os
+import signal
 import threading
 import time
 
@@ -11,17 +12,16 @@ import gym
 import numpy as np
 import queue
 from absl import app
+from rl_app import analysis, latency
+from rl_app.action_policy import POLICIES, make_policy
+from rl_app.app_signal import AppSignalPublisher
 from rl_app.atari_wrapper import (FireResetEnv, FrameStack, LimitLength,
                                   MapState, Monitor)
+from rl_app.frame_codec import FRAME_HISTORY, decode_obs, encode_obs
 from rl_app.network.network import Receiver, Sender
-from rl_app.util import Clock, put_overwrite
-from rl_app.plt_util import parse_mahimahi_out, parse_ping
-from tensorpack import *
+from rl_app.network.tcp_info import TcpInfoSampler, cwnd_bytes
+from rl_app.util import Clock, Mailbox
 from collections import namedtuple
-from rl_app.network.serializer import pa_serialize
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-mpl.use('Agg')
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--env_name', type=str, required=True)
@@ -39,16 +39,60 @@ parser.add_argument('--results_dir',
 parser.add_argument('--time', type=int, default=60)
 parser.add_argument('--use_latest_act_as_default',
                     dest='use_latest_act_as_default',
-                    action='store_true')
+                    action='store_true',
+                    help='Same as --action_policy=latest')
+parser.add_argument('--action_policy',
+                    type=str,
+                    default='repeat',
+                    choices=sorted(POLICIES.keys()),
+                    help='How to pick the action of steps for which no '
+                    'action arrived from the agent')
 parser.add_argument('--use_iperf', dest='use_iperf', action='store_true')
 parser.add_argument('--use_', dest='use_iperf', action='store_true')
 parser.add_argument('--verbose', dest='verbose', action='store_true')
+parser.add_argument('--use_ping',
+                    dest='use_ping',
+                    action='store_true',
+                    help='Also measure the rtt with ping')
+parser.add_argument('--tcp_info_hz',
+                    type=int,
+                    default=100,
+                    help='Sample tcp_info of the game sockets this often')
+parser.add_argument('--plot',
+                    dest='plot',
+                    action='store_true',
+                    help='Plot ping, cwnd and lag in a separate process '
+                    'after the game')
+parser.add_argument('--n_games',
+                    type=int,
+                    default=1,
+                    help='Play this many games at once. Game i talks to the '
+                    'agent on the frames/action ports + 2i and writes to '
+                    'results_dir/game_i')
+parser.add_argument('--n_procs',
+                    type=int,
+                    default=1,
+                    help='Spread the games over this many processes')
+parser.add_argument('--cc_fallback',
+                    type=str,
+                    default=None,
+                    help='Congestion control to use if ccp is not loaded')
+parser.add_argument('--app_signal',
+                    type=str,
+                    default=None,
+                    help='Publish the frame rate, frame size and lag of the '
+                    'game to the congestion controller on this unix socket, '
+                    'see rl_app/app_signal.py')
+parser.add_argument('--pace_frames',
+                    action='store_true',
+                    help='Spread every frame over the frame interval instead '
+                    'of writing it to the socket in one burst')
 
 NEW_GAME_PENALTY = 10
 IMAGE_SIZE = (84, 84)
-FRAME_HISTORY = 4
-GameStat = namedtuple(
-    'GameStat', ['is_skip_action', 'lag_n_frames', 'lag_time', 'frame_size'])
+GameStat = namedtuple('GameStat', [
+    'is_skip_action', 'lag_n_frames', 'lag_time', 'frame_size', 'timestamp'
+])
 
 
 class GamePlay:
@@ -66,7 +110,14 @@ class GamePlay:
                frameskip=1,
                use_latest_act_as_default=False,
                use_iperf=False,
-               verbose=False):
+               verbose=False,
+               cc_fallback=None,
+               plot=False,
+               use_ping=False,
+               tcp_info_hz=100,
+               action_policy='repeat',
+               app_signal=None,
+               pace_frames=False):
 
     self.max_steps = sps * time_limit
     self.sps = sps
@@ -81,44 +132,91 @@ class GamePlay:
     self.env_name = env_name
     self.dump_video = dump_video
     self.render = render
-    self.use_latest_act_as_default = use_latest_act_as_default
     if use_latest_act_as_default:
-      raise Exception('Not supported for now..')
+      action_policy = 'latest'
+    self.action_policy = action_policy
+    self._policy = make_policy(action_policy, frameskip,
+                               self._get_noop_action())
     self.lock = threading.Lock()
-    self._latest_action = None
-    self._frames_q = queue.Queue(1)
+    self._latest_action = Mailbox()
+    self._frames_q = Mailbox()
     self._game_stats = []
+    self._latency_records = []
     self.game_id = None
     self.skip_count = None
+    # plan of actions that came with the latest action, and the frame it was
+    # planned from (plan[k] is for frame _plan_start + k)
+    self._plan = None
+    self._plan_start = None
+    self.n_plan_actions = 0
+    self.score = None
     self.verbose = verbose
     self.use_iperf = use_iperf
+    self.cc_fallback = cc_fallback
+    self.plot = plot
+    self.use_ping = use_ping
+    self.tcp_info_hz = tcp_info_hz
+    self.app_signal = app_signal
+    self._app_signal = None
+    self.pace_frames = pace_frames
 
   def start(self):
+    self.begin()
+    self._process()
+    self.finish()
+
+  def begin(self):
+    """Connects to the agent and starts the first game."""
+    pace_interval = 1. / self.sps if self.pace_frames else None
     self._frames_socket = Sender(host=self.server_ip,
                                  port=self.frames_port,
                                  bind=False,
-                                 verbose=self.verbose)
+                                 verbose=self.verbose,
+                                 cc_fallback=self.cc_fallback,
+                                 pace_interval=pace_interval)
     self._actions_socket = Receiver(host=self.server_ip,
                                     port=self.action_port,
                                     bind=False,
-                                    verbose=self.verbose)
+                                    verbose=self.verbose,
+                                    cc_fallback=self.cc_fallback)
     self._frames_socket.start_loop(self.push_frames, blocking=False)
     self._actions_socket.start_loop(self._receive_actions, blocking=False)
-    proc = self._start_ping()
-    self._start_cwnd_monitor()
-    if self.use_iperf:
-      proc2 = self._start_iperf_client()
-
-    self._process()
-
-    if proc.poll() is None:
-      proc.kill()
-
-    if self.use_iperf:
-      if proc2.poll() is None:
-        proc2.kill()
-
-    self._plot_results()
+    self._ping_proc = self._start_ping() if self.use_ping else None
+    self._start_tcp_info_sampler()
+    if self.app_signal:
+      self._app_signal = AppSignalPublisher(
+          self._frames_socket.socket.getsockname()[1], self.app_signal)
+      self._app_signal.start()
+    self._iperf_proc = self._start_iperf_client() if self.use_iperf else None
+
+    self._env, self._obs = self._new_game()
+    self.sum_r = 0
+    self.n_steps = 0
+    self._info = None
+    self.new_game_last_step = False
+
+  def finish(self):
+    """Ends the session with the agent and writes the results."""
+    self._end_games()
+
+    proc = self._ping_proc
+    if proc is not None and proc.poll() is None:
+      # SIGINT makes ping flush its output before exiting
+      proc.send_signal(signal.SIGINT)
+      try:
+        proc.wait(timeout=2)
+      except subprocess.TimeoutExpired:
+        proc.kill()
+
+    if self._iperf_proc is not None and self._iperf_proc.poll() is None:
+      self._iperf_proc.kill()
+
+    if self._app_signal is not None:
+      self._app_signal.stop()
+
+    analysis.update_results(self.results_dir)
+    if self.plot:
+      self._plot_results()
 
   def _make_env(self, env_number=0):
     env = gym.make(self.env_name, frameskip=1, repeat_action_probability=0.)
@@ -141,72 +239,73 @@ class GamePlay:
     return proc
 
   def _start_ping(self):
-    proc = subprocess.Popen('exec ping %s -w %s -i 0.2 > %s' %
+    proc = subprocess.Popen('exec ping -D %s -w %s -i %s > %s' %
                             (self.server_ip, self.time_limit + 4,
+                             analysis.PING_INTERVAL,
                              os.path.join(self.results_dir, 'ping.txt')),
                             stderr=sys.stderr,
                             stdout=sys.stdout,
                             shell=True)
     return proc
 
-  def _start_cwnd_monitor(self):
-
-    def _collect_cwnd():
-      while True:
-        cwnd = self._frames_socket.get_cwnd()
-        with self.lock:
-          self.cwnds.append([time.time(), cwnd])
-        time.sleep(.250)
-
-    self.cwnds = []
-    self._cwnd_thread = threading.Thread(target=_collect_cwnd)
-    self._cwnd_thread.daemon = True
-    self._cwnd_thread.start()
+  def _start_tcp_info_sampler(self):
+    self._tcp_info = TcpInfoSampler(
+        {
+            'frames': self._frames_socket.socket,
+            'actions': self._actions_socket.socket
+        },
+        hz=self.tcp_info_hz,
+        duration=self.time_limit + 30)
+    self._tcp_info.start()
 
   def _receive_actions(self, act):
-    with self.lock:
-      self._latest_action = [time.time(), act]
+    latency.stamp(act, 'client_recv')
+    self._latest_action.put([time.time(), act])
 
   def push_frames(self):
     try:
-      return self._frames_q.get_nowait()
+      frame = self._frames_q.get(block=False)
+      app_limited = False
     except queue.Empty:
-      # print('App limited!...')
-      pass
-    return self._frames_q.get()
+      # the socket could send more, but the game has nothing to send
+      frame = self._frames_q.get()
+      app_limited = True
+    if self._app_signal is not None:
+      self._app_signal.on_send(app_limited)
+    latency.stamp(frame, 'send')
+    return frame
 
   def _encode_obs(self, obs):
-    encoded = []
-    for i in range(FRAME_HISTORY):
-      success, enc = cv2.imencode('.png', obs[:, :, :, i])
-      if not success:
-        raise Exception('Error encountered on encoding function')
-      encoded.append(enc)
-    return encoded
+    return encode_obs(obs)
 
   @staticmethod
   def decode_obs(data):
-    assert len(data) == FRAME_HISTORY
-    frames = []
-    for enc_frame in data:
-      frames.append(cv2.imdecode(enc_frame, cv2.IMREAD_UNCHANGED))
-    return np.stack(frames, axis=-1)
+    return decode_obs(data)
 
   def _get_noop_action(self):
     return 1
 
   def _get_default_action(self):
-    if self.skip_count < self.frameskip:
-      act = self._prev_action
-    else:
-      act = self._get_noop_action()
-    return act
+    return self._policy.default_action(self.skip_count)
+
+  def _get_plan_action(self, step_number):
+    """Action the agent planned for this step, None if there is none.
+    plan[k] is for frame plan_start + k, so the entries for the steps that
+    passed while the action was on its way are skipped."""
+    if self._plan is None:
+      return None
+    i = step_number - self._plan_start
+    if i < 0 or i >= len(self._plan):
+      return None
+    self.n_plan_actions += 1
+    return self._plan[i]
 
   def _unwrap_action(self, act, step_number):
     game_stat = GameStat(is_skip_action=False,
                          lag_n_frames=None,
                          lag_time=None,
-                         frame_size=None)
+                         frame_size=None,
+                         timestamp=time.time())
 
     # drop actions destined for the previous game.
     if act:
@@ -215,18 +314,30 @@ class GamePlay:
 
     if act is None:
       game_stat = game_stat._replace(is_skip_action=True)
-      act = self._get_default_action()
+      act = self._get_plan_action(step_number)
+      if act is None:
+        act = self._get_default_action()
       self.skip_count += 1
     else:
       self.skip_count = 0
       t, act = act
+      self._plan = act.get('plan')
+      self._plan_start = act['frame_id']
       game_stat = game_stat._replace(lag_time=t - act['frame_timestamp'],
                                      lag_n_frames=step_number -
                                      act['frame_id'],
                                      frame_size=act['frame_size'])
+      if self._app_signal is not None:
+        self._app_signal.on_action(game_stat.lag_time)
+      if 'stamps' in act:
+        self._latency_records.append(
+            dict(frame_id=act['frame_id'],
+                 game_id=act['game_id'],
+                 agent_boot_id=act.get('agent_boot_id'),
+                 **act['stamps']))
       act = act['action']
 
-    self._prev_action = act
+    self._policy.on_action(act)
     self._game_stats.append(game_stat)
     return act
 
@@ -236,62 +347,79 @@ class GamePlay:
     else:
       self.game_id += 1
     self.skip_count = 0
-    self._prev_action = self._get_noop_action()
+    self._plan = None
+    self._policy.reset()
     env = self._make_env(self.game_id)
     obs = env.reset()
     return env, obs
 
   def _wrap_frame(self, step_number, obs):
+    enc_start = time.monotonic()
     encoded_obs = self._encode_obs(obs)
     frame = dict(frame_id=step_number,
                  frame_timestamp=time.time(),
                  frame_size=sum([sys.getsizeof(img) for img in encoded_obs]),
                  encoded_obs=encoded_obs,
-                 game_id=self.game_id)
+                 game_id=self.game_id,
+                 stamps=dict(enc_start=enc_start, enc_end=time.monotonic()))
     return frame
 
+  def done(self):
+    return self.n_steps >= self.max_steps
+
+  def send_frame(self):
+    """First half of a step: sends the current observation to the agent."""
+    self._policy.observe(self._obs)
+    frame = self._wrap_frame(self.n_steps, self._obs)
+    if self._app_signal is not None:
+      self._app_signal.on_frame(frame['frame_size'])
+    self._frames_q.put(frame)
+
+  def apply_action(self):
+    """Second half of a step: plays the latest action that came back, or a
+    default one."""
+    try:
+      act = self._latest_action.get(block=False)
+    except queue.Empty:
+      act = None
+
+    act = self._unwrap_action(act, self.n_steps)
+    self._obs, r, isOver, self._info = self._env.step(act)
+    if self.render:
+      self._env.render()
+
+    if isOver:
+      self._env, self._obs = self._new_game()
+      self.new_game_last_step = True
+    else:
+      self.new_game_last_step = False
+
+    self.sum_r += r
+    self.n_steps += 1
+
   def _process(self):
-    env, obs = self._new_game()
-    sum_r = 0
-    n_steps = 0
-    isOver = False
     clock = Clock()
     clock.reset()
-    new_game_last_step = False
 
     # while not isOver:
-    while n_steps < self.max_steps:
-      put_overwrite(self._frames_q, self._wrap_frame(n_steps, obs))
+    while not self.done():
+      self.send_frame()
 
       t = self._step_sleep_time - clock.time_elapsed()
       if -t > 1e-3:
-        if not new_game_last_step:
+        if not self.new_game_last_step:
           print('sps too high for the current gameserver.... %.3f' % t)
       else:
         time.sleep(max(0, t))
       clock.reset()
 
-      with self.lock:
-        act = self._latest_action
-        self._latest_action = None
-
-      act = self._unwrap_action(act, n_steps)
-      obs, r, isOver, info = env.step(act)
-      if self.render:
-        env.render()
-
-      if isOver:
-        env, obs = self._new_game()
-        new_game_last_step = True
-      else:
-        new_game_last_step = False
-
+      self.apply_action()
       print('.', end='', flush=True)
-      sum_r += r
-      n_steps += 1
 
+  def _end_games(self):
+    sum_r, n_steps, info = self.sum_r, self.n_steps, self._info
     n_skipped_actions = sum(map(lambda k: k.is_skip_action, self._game_stats))
-    put_overwrite(self._frames_q, None)
+    self._frames_q.put(None)
     print('')
     print('# of steps elapsed: ', n_steps)
     print('# of skipped actions: ', n_skipped_actions)
@@ -303,53 +431,141 @@ class GamePlay:
       print('Gameover - No lives left!!')
     score = sum_r - (self.game_id * NEW_GAME_PENALTY)
     print('Score: ', score)
+    self.score = score
     self._log_results(
         **dict(n_steps=n_steps,
                sum_reward=sum_r,
                score=score,
                lives_remaining=info['ale.lives'],
                n_skipped_actions=n_skipped_actions,
-               total_games=self.game_id + 1))
+               total_games=self.game_id + 1,
+               action_policy=self.action_policy,
+               n_plan_actions=self.n_plan_actions,
+               **self._policy.stats()))
 
   def _log_results(self, **kwargs):
+    self._tcp_info.stop()
+    self._tcp_info.save(self.results_dir)
+    samples = self._tcp_info.get('frames')
     with open(os.path.join(self.results_dir, 'cwnd.json'), 'w') as f:
-      with self.lock:
-        l = list(self.cwnds)
+      l = list(zip(samples['t'].tolist(), cwnd_bytes(samples).tolist()))
       if l:
         json.dump(l, f, indent=2, sort_keys=True)
 
     with open(os.path.join(self.results_dir, 'results.json'), 'w') as f:
       json.dump(kwargs, f, indent=4, sort_keys=True)
 
+    latency.write_breakdown(self.results_dir, self._latency_records)
+
     with open(os.path.join(self.results_dir, 'game_stats.json'), 'w') as f:
       game_stats = list(
           map(lambda game_stat: game_stat._asdict(), self._game_stats))
       json.dump(game_stats, f, indent=2, sort_keys=True)
 
   def _plot_results(self):
-    ping_data = parse_ping(os.path.join(self.results_dir, 'ping.txt'))
-    plt.figure()
-    plt.plot(ping_data)
-    plt.ylabel('milli seconds')
-    plt.savefig(fname=os.path.join(self.results_dir, 'ping.png'))
-
-    with open(os.path.join(self.results_dir, 'cwnd.json'), 'r') as f:
-      l = json.load(f)
-
-    if l:
-      times = [i[0] for i in l]
-      y = [i[1] for i in l]
-      times = [t - times[0] for t in times]
-      plt.figure()
-      plt.plot(times, y)
-      plt.xlabel('seconds')
-      plt.ylabel('cwnd')
-      plt.savefig(fname=os.path.join(self.results_dir, 'cwnd.png'))
+    # plotting runs in its own process so that the client exits right after
+    # the game.
+    subprocess.Popen(
+        [sys.executable, '-m', 'rl_app.analysis', '--no_summary', '--plot',
+         self.results_dir],
+        start_new_session=True)
+
+
+class MultiGamePlay:
+  """Plays several GamePlay games from one thread. A shared scheduler sends
+  the frames of all games, sleeps once per step and then applies all their
+  actions, so that every game costs little more than its env step and frame
+  encoding."""
+
+  def __init__(self, game_ids, frames_port, action_port, results_dir,
+               **kwargs):
+    self.games = [
+        GamePlay(frames_port=frames_port + 2 * i,
+                 action_port=action_port + 2 * i,
+                 results_dir=os.path.join(results_dir, 'game_%d' % i),
+                 **kwargs) for i in game_ids
+    ]
+    self.game_ids = list(game_ids)
+    self._step_sleep_time = 1.0 / kwargs['sps']
+
+  def start(self):
+    for game in self.games:
+      game.begin()
+
+    clock = Clock()
+    clock.reset()
+    start_t = time.time()
+    n_late = 0
+    while not all([game.done() for game in self.games]):
+      for game in self.games:
+        if not game.done():
+          game.send_frame()
+
+      t = self._step_sleep_time - clock.time_elapsed()
+      if -t > 1e-3:
+        n_late += 1
+      else:
+        time.sleep(max(0, t))
+      clock.reset()
+
+      for game in self.games:
+        if not game.done():
+          game.apply_action()
+      print('.', end='', flush=True)
+    elapsed = time.time() - start_t
+
+    print('')
+    print('%d steps late out of %d' % (n_late, self.games[0].n_steps))
+    scores = {}
+    for i, game in zip(self.game_ids, self.games):
+      print('Game %d:' % i)
+      game.finish()
+      scores[i] = dict(score=game.score,
+                       sps=game.n_steps / elapsed,
+                       results_dir=game.results_dir)
+    return scores
+
+
+def _run_multi_game(game_ids, kwargs, scores_q):
+  scores_q.put(MultiGamePlay(game_ids, **kwargs).start())
+
+
+def run_multi_game(n_games, n_procs, results_dir, **kwargs):
+  """Plays n_games games over n_procs processes and writes a summary of all
+  games to results_dir/multi_results.json"""
+  import multiprocessing
+  kwargs['results_dir'] = results_dir
+  if n_procs <= 1:
+    scores = MultiGamePlay(range(n_games), **kwargs).start()
+  else:
+    scores_q = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=_run_multi_game,
+                                args=(range(i, n_games, n_procs), kwargs,
+                                      scores_q)) for i in range(n_procs)
+    ]
+    for proc in procs:
+      proc.start()
+    scores = {}
+    for _ in procs:
+      scores.update(scores_q.get())
+    for proc in procs:
+      proc.join()
+
+  summary = dict(
+      games=[scores[i] for i in sorted(scores)],
+      mean_score=sum([s['score'] for s in scores.values()]) / len(scores),
+      total_sps=sum([s['sps'] for s in scores.values()]))
+  os.system('mkdir -p %s' % results_dir)
+  with open(os.path.join(results_dir, 'multi_results.json'), 'w') as f:
+    json.dump(summary, f, indent=4, sort_keys=True)
+  print('Mean score: %.2f, total sps: %.1f' %
+        (summary['mean_score'], summary['total_sps']))
 
 
 def main(argv):
   args = parser.parse_args(argv[1:])
-  game_play = GamePlay(
+  kwargs = dict(
       env_name=args.env_name,
       sps=args.sps,
       agent_server_ip=args.server_ip,
@@ -361,9 +577,19 @@ def main(argv):
       render=args.render,
       frameskip=args.frameskip,
       use_latest_act_as_default=args.use_latest_act_as_default,
+      action_policy=args.action_policy,
       use_iperf=args.use_iperf,
-      verbose=args.verbose)
-  game_play.start()
+      verbose=args.verbose,
+      cc_fallback=args.cc_fallback,
+      plot=args.plot,
+      use_ping=args.use_ping,
+      tcp_info_hz=args.tcp_info_hz,
+      app_signal=args.app_signal,
+      pace_frames=args.pace_frames)
+  if args.n_games > 1:
+    run_multi_game(args.n_games, args.n_procs, **kwargs)
+  else:
+    GamePlay(**kwargs).start()
 
 
 if __name__ == '__main__':
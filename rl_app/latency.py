@@ -0,0 +1,118 @@
+"""
+  Per-frame latency breakdown. Frames carry a `stamps` dict that the client
+  and the agent fill with time.monotonic() at every stage, and the action
+  brings it back to the client:
+
+  enc_start, enc_end   client encodes the observation
+  send                 client's frame sender dequeues the frame
+  agent_recv           agent receives the frame
+  infer_start          agent's inference thread dequeues it
+  infer_end            the action is computed (decoding included)
+  action_send          agent's action sender dequeues the action
+  client_recv          client receives the action
+
+  Stamps of the agent are moved onto the client clock. When both run on the
+  same kernel (same boot_id, e.g. inside mahimahi) the monotonic clocks are
+  the same. Otherwise the offset is estimated NTP-style from the frame with
+  the smallest round trip.
+"""
+import csv
+import os
+import time
+
+import numpy as np
+
+# (name, from stamp, to stamp)
+SEGMENTS = [
+    ('encode', 'enc_start', 'enc_end'),
+    ('sender_queue', 'enc_end', 'send'),
+    ('uplink', 'send', 'agent_recv'),
+    ('agent_queue', 'agent_recv', 'infer_start'),
+    ('inference', 'infer_start', 'infer_end'),
+    ('action_queue', 'infer_end', 'action_send'),
+    ('downlink', 'action_send', 'client_recv'),
+    ('total', 'enc_start', 'client_recv'),
+]
+AGENT_STAMPS = ['agent_recv', 'infer_start', 'infer_end', 'action_send']
+BREAKDOWN_FNAME = 'latency_breakdown.csv'
+
+_boot_id = None
+
+
+def boot_id():
+  """Identifies the running kernel, and so its monotonic clock."""
+  global _boot_id
+  if _boot_id is None:
+    try:
+      with open('/proc/sys/kernel/random/boot_id') as f:
+        _boot_id = f.read().strip()
+    except OSError:
+      _boot_id = ''
+  return _boot_id
+
+
+def stamp(msg, key):
+  """Records the current time under msg['stamps'][key], if msg has stamps."""
+  if msg is not None and 'stamps' in msg:
+    msg['stamps'][key] = time.monotonic()
+
+
+def estimate_offset(stamps):
+  """Agent clock minus client clock, from the round trip of every frame.
+
+    Args:
+        stamps: dict from stamp name to an array with one entry per frame.
+  """
+  t1, t2 = stamps['send'], stamps['agent_recv']
+  t3, t4 = stamps['action_send'], stamps['client_recv']
+  rtt = (t4 - t1) - (t3 - t2)
+  if np.all(np.isnan(rtt)):
+    # the agent did not stamp the frames
+    return 0.
+  i = np.nanargmin(rtt)
+  return ((t2[i] - t1[i]) + (t3[i] - t4[i])) / 2
+
+
+def breakdown(records, same_clock):
+  """Returns (frame ids, game ids, {segment: durations in s}) of the frames
+  whose action came back.
+
+    Args:
+        records: list of dicts holding frame_id, game_id and the stamps.
+        same_clock: whether the agent stamps are on the client clock.
+  """
+  names = set([s[1] for s in SEGMENTS] + [s[2] for s in SEGMENTS])
+  stamps = {
+      k: np.array([r.get(k, np.nan) for r in records], dtype=np.float64)
+      for k in names
+  }
+  if not same_clock and len(records):
+    offset = estimate_offset(stamps)
+    for k in AGENT_STAMPS:
+      stamps[k] -= offset
+  segments = {name: stamps[end] - stamps[start] for name, start, end in SEGMENTS}
+  frame_ids = np.array([r['frame_id'] for r in records], dtype=np.int64)
+  game_ids = np.array([r['game_id'] for r in records], dtype=np.int64)
+  return frame_ids, game_ids, segments
+
+
+def write_breakdown(results_dir, records):
+  """Writes one row per acted-on frame with the time spent in every segment,
+  in ms."""
+  agent_boot_ids = set([r.get('agent_boot_id') for r in records])
+  same_clock = agent_boot_ids == set([boot_id()]) and boot_id() != ''
+  frame_ids, game_ids, segments = breakdown(records, same_clock)
+  with open(os.path.join(results_dir, BREAKDOWN_FNAME), 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(['frame_id', 'game_id'] + [s[0] + '_ms' for s in SEGMENTS])
+    for i in range(len(frame_ids)):
+      writer.writerow([frame_ids[i], game_ids[i]] +
+                      ['%.3f' % (segments[s[0]][i] * 1e3) for s in SEGMENTS])
+
+
+def load_breakdown(fname):
+  """Returns {column: array} of a latency_breakdown.csv"""
+  if not os.path.exists(fname):
+    return None
+  arr = np.genfromtxt(fname, delimiter=',', names=True, ndmin=1)
+  return {k: arr[k] for k in arr.dtype.names}
@@ -1,12 +1,16 @@
 import socket
 from rl_app.network.serializer import get_serializer, get_deserializer, int_from_bytes, int_to_bytes
+from rl_app.network.tcp_info import cwnd_bytes, read_tcp_info
 from rl_app.util import Timer
 import time
 from threading import Thread
-import fcntl, array, struct
+import fcntl, array
 
 READ_SIZE = 8192
 MTU = 1500
+# a paced frame is written in chunks of this many bytes, about a packet each:
+# frames are only a few packets long on the slow links pacing is for
+PACE_CHUNK_BYTES = MTU
 
 
 class Receiver:
@@ -18,24 +22,40 @@ class Receiver:
                serializer='pyarrow',
                deserializer='pyarrow',
                data_unsent_thresold=MTU,
-               verbose=False):
+               verbose=False,
+               congestion_control='ccp',
+               cc_fallback=None,
+               pace_interval=None):
+    """
+      Args:
+          congestion_control: TCP congestion control algorithm of the socket.
+          cc_fallback: algorithm to use instead when congestion_control is
+              not available on this machine (e.g. the ccp kernel module is
+              not loaded). None to raise an error instead.
+          pace_interval: Sender only. Spread every message evenly over
+              this many seconds (the frame interval) instead of writing it
+              in one burst. None to not pace.
+    """
     self._thread = None
     self.host = host
     self.port = port
     self._data_unsent_thresold = data_unsent_thresold
+    self._pace_interval = pace_interval
     self._serializer = get_serializer(serializer)
     self._deserializer = get_deserializer(deserializer)
     self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     self.socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
     self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-    self.socket.setsockopt(socket.SOL_TCP, socket.TCP_CONGESTION, b'ccp')
+    self._set_congestion_control(congestion_control, cc_fallback)
     # self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 20000)
     # self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 9000)
 
     self.bind = bind
     self.connected = False
     self.verbose = verbose
+    self._stopped = False
+    self._conn = None
     if bind:
       self.socket.bind((host, port))
     else:
@@ -50,6 +70,18 @@ class Receiver:
           time.sleep(.2)
           print('connect to %s:%d failed. Retrying in 200ms' % (host, port))
 
+  def _set_congestion_control(self, congestion_control, cc_fallback):
+    try:
+      self.socket.setsockopt(socket.SOL_TCP, socket.TCP_CONGESTION,
+                             congestion_control.encode())
+    except OSError:
+      if cc_fallback is None:
+        raise
+      print('Congestion control %s is not available. Falling back to %s' %
+            (congestion_control, cc_fallback))
+      self.socket.setsockopt(socket.SOL_TCP, socket.TCP_CONGESTION,
+                             cc_fallback.encode())
+
   def start_loop(self, handler, new_connection_callback=None, blocking=False):
     """
       Args:
@@ -79,22 +111,42 @@ class Receiver:
         print('server %s:%d waiting to accept new connections' %
               (self.host, self.port))
         conn, addr = self.socket.accept()
+        self._conn = conn
         self.connected = True
         if new_connection_callback:
           new_connection_callback(conn, addr)
         print('Connection accepted to client ', addr)
         with conn:
           self._loop(conn, handler)
+        self.connected = False
       else:
         self._loop(self.socket, handler)
     except ConnectionResetError:
       self.connected = False
+    except OSError:
+      # close() tears down the sockets underneath a running loop.
+      self.connected = False
+      if not self._stopped:
+        raise
+
+  def close(self):
+    """Stops the loop and releases the sockets so that the port can be
+    bound again by a new Receiver/Sender."""
+    self._stopped = True
+    for sock in [self._conn, self.socket]:
+      if sock is None:
+        continue
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+      sock.close()
+
+  def get_tcp_info(self):
+    return read_tcp_info(self.socket)
 
   def get_cwnd(self):
-    fmt = "B" * 7 + "I" * 24  #+ "Q" * 4 + "I" * 6 + "Q" * 3
-    tcp_info = struct.unpack(
-        fmt, self.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104))
-    return int(tcp_info[25] * tcp_info[20])
+    return int(cwnd_bytes(self.get_tcp_info()))
 
   def _read_n_bytes(self, conn, n_bytes):
     msg = bytearray()
@@ -146,18 +198,39 @@ class Sender(Receiver):
       print('not yet sent (SIOCOUTQNSD): ', val)
     return val
 
+  def _wait_data_sent(self, fno):
+    while self._get_data_not_sent(fno) > self._data_unsent_thresold:
+      time.sleep(.0005)
+
+  def _send_all(self, conn, msg):
+    while len(msg) > 0:
+      sent = conn.send(msg)
+      msg = msg[sent:]
+
+  def _send_paced(self, conn, fno, msg):
+    """Writes msg in chunks, the i-th of n at i / n of the pace interval,
+    so that a frame reaches the link at about its share of the frame rate
+    instead of as a burst of a whole cwnd."""
+    n_chunks = max(1, -(-len(msg) // PACE_CHUNK_BYTES))
+    chunk_size = -(-len(msg) // n_chunks)
+    start = time.time()
+    for i in range(n_chunks):
+      delay = start + i * self._pace_interval / n_chunks - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      self._wait_data_sent(fno)
+      self._send_all(conn, msg[i * chunk_size:(i + 1) * chunk_size])
+
   def _loop(self, conn, handler):
     fno = conn.fileno()
     while True:
-      while True:
-        data_not_sent = self._get_data_not_sent(fno)
-        if data_not_sent <= self._data_unsent_thresold:
-          break
-        else:
-          time.sleep(.0005)
+      self._wait_data_sent(fno)
       data = handler()
+      if self._stopped:
+        return
       msg = self._serializer(data)
       msg = self._add_header(msg)
-      while len(msg) > 0:
-        sent = conn.send(msg)
-        msg = msg[sent:]
+      if self._pace_interval:
+        self._send_paced(conn, fno, memoryview(msg))
+      else:
+        self._send_all(conn, msg)
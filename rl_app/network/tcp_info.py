@@ -0,0 +1,152 @@
+"""
+  Reads the kernel's `struct tcp_info` (linux/tcp.h) of a socket into named
+  numpy fields, and samples it periodically into a preallocated array.
+"""
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+# struct tcp_info as of linux 5.x. Older kernels return a prefix of it, the
+# rest is left zero.
+TCP_INFO_DTYPE = np.dtype([
+    ('state', 'u1'),
+    ('ca_state', 'u1'),
+    ('retransmits', 'u1'),
+    ('probes', 'u1'),
+    ('backoff', 'u1'),
+    ('options', 'u1'),
+    ('wscale', 'u1'),  # snd_wscale : 4, rcv_wscale : 4
+    ('app_limited', 'u1'),  # delivery_rate_app_limited : 1, ...
+    ('rto', 'u4'),  # us
+    ('ato', 'u4'),
+    ('snd_mss', 'u4'),
+    ('rcv_mss', 'u4'),
+    ('unacked', 'u4'),
+    ('sacked', 'u4'),
+    ('lost', 'u4'),
+    ('retrans', 'u4'),
+    ('fackets', 'u4'),
+    ('last_data_sent', 'u4'),
+    ('last_ack_sent', 'u4'),
+    ('last_data_recv', 'u4'),
+    ('last_ack_recv', 'u4'),
+    ('pmtu', 'u4'),
+    ('rcv_ssthresh', 'u4'),
+    ('rtt', 'u4'),  # smoothed rtt in us
+    ('rttvar', 'u4'),  # us
+    ('snd_ssthresh', 'u4'),
+    ('snd_cwnd', 'u4'),  # packets
+    ('advmss', 'u4'),
+    ('reordering', 'u4'),
+    ('rcv_rtt', 'u4'),
+    ('rcv_space', 'u4'),
+    ('total_retrans', 'u4'),
+    ('pacing_rate', 'u8'),  # bytes/s
+    ('max_pacing_rate', 'u8'),
+    ('bytes_acked', 'u8'),
+    ('bytes_received', 'u8'),
+    ('segs_out', 'u4'),
+    ('segs_in', 'u4'),
+    ('notsent_bytes', 'u4'),
+    ('min_rtt', 'u4'),  # us
+    ('data_segs_in', 'u4'),
+    ('data_segs_out', 'u4'),
+    ('delivery_rate', 'u8'),  # bytes/s
+    ('busy_time', 'u8'),  # us
+    ('rwnd_limited', 'u8'),
+    ('sndbuf_limited', 'u8'),
+    ('delivered', 'u4'),
+    ('delivered_ce', 'u4'),
+    ('bytes_sent', 'u8'),
+    ('bytes_retrans', 'u8'),
+    ('dsack_dups', 'u4'),
+    ('reord_seen', 'u4'),
+    ('rcv_ooopack', 'u4'),
+    ('snd_wnd', 'u4'),
+])
+assert TCP_INFO_DTYPE.itemsize == 232
+
+# one sample of the sampler: the time it was taken followed by the struct
+SAMPLE_DTYPE = np.dtype([('t', 'f8')] + TCP_INFO_DTYPE.descr)
+
+
+def read_tcp_info(sock):
+  """Returns the tcp_info of sock as a numpy record, e.g. info['rtt']."""
+  buf = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO,
+                        TCP_INFO_DTYPE.itemsize)
+  return np.frombuffer(buf.ljust(TCP_INFO_DTYPE.itemsize, b'\0'),
+                       dtype=TCP_INFO_DTYPE)[0]
+
+
+def cwnd_bytes(info):
+  return info['snd_cwnd'] * info['pmtu']
+
+
+class TcpInfoSampler:
+  """Samples the tcp_info of a few sockets `hz` times a second, for at most
+  `duration` seconds, in a background thread."""
+
+  def __init__(self, sockets, hz=100, duration=600):
+    """
+      Args:
+          sockets: dict from a name to the socket to sample.
+    """
+    self.sockets = dict(sockets)
+    self.hz = hz
+    self.capacity = int(hz * duration) + 1
+    self.samples = {
+        name: np.zeros(self.capacity, dtype=SAMPLE_DTYPE)
+        for name in self.sockets
+    }
+    self.n_samples = 0
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+
+  def _loop(self):
+    size = TCP_INFO_DTYPE.itemsize
+    offset = SAMPLE_DTYPE.fields['state'][1]
+    # byte views of the sample arrays, so that the struct is copied in place
+    raw = {
+        name: samples.view(np.uint8).reshape(self.capacity, -1)
+        for name, samples in self.samples.items()
+    }
+    next_t = time.time()
+    while not self._stop.is_set() and self.n_samples < self.capacity:
+      i = self.n_samples
+      t = time.time()
+      for name, sock in self.sockets.items():
+        try:
+          buf = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, size)
+        except OSError:
+          # socket closed under us
+          return
+        raw[name][i, offset:offset + len(buf)] = np.frombuffer(buf, np.uint8)
+        self.samples[name]['t'][i] = t
+      self.n_samples += 1
+      next_t += 1. / self.hz
+      self._stop.wait(max(0., next_t - time.time()))
+    if self.n_samples == self.capacity:
+      print('tcp_info sampler full after %d samples' % self.n_samples)
+
+  def get(self, name):
+    """Samples of the socket taken so far."""
+    return self.samples[name][:self.n_samples]
+
+  def save(self, results_dir):
+    """Writes the samples of every socket to tcp_info_<name>.npy"""
+    for name in self.samples:
+      np.save(os.path.join(results_dir, 'tcp_info_%s.npy' % name),
+              self.get(name))
@@ -1,20 +1,78 @@
+import itertools
 import queue
+import threading
 import time
+from collections import deque
 
 
 def put_overwrite(q, item, key=''):
   """Put item into queue without blocking.
     If full, remove an item out of the queue.
-    Guaranteed not to block."""
+    Guaranteed not to block.
+    Returns whether an item was discarded."""
   try:
     q.put_nowait(item)
+    return False
   except queue.Full:
     # discard an item out of the queue
+    discarded = True
     try:
       q.get_nowait()
     except queue.Empty:
-      pass
+      discarded = False
     q.put_nowait(item)
+    return discarded
+
+
+class Mailbox:
+  """Single slot holding the latest item put into it. put never blocks and
+    replaces the item if it was not taken yet, with one atomic append to a
+    deque(maxlen=1). Items are numbered, so the consumer counts how many
+    were overwritten before it got to them."""
+
+  def __init__(self):
+    self._slot = deque(maxlen=1)
+    self._nonempty = threading.Event()
+    # next() on itertools.count is atomic
+    self._seq = itertools.count(1)
+    self._last_seq = 0
+    self.n_overwritten = 0
+
+  def put(self, item):
+    self._slot.append((next(self._seq), item))
+    self._nonempty.set()
+
+  def get(self, block=True, timeout=None):
+    """Takes the item out. Raises queue.Empty if there is none after
+      `timeout` seconds, or right away if not block."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      try:
+        seq, item = self._slot.popleft()
+        break
+      except IndexError:
+        pass
+      if not block:
+        raise queue.Empty
+      self._nonempty.clear()
+      # a put between the popleft and the clear must not be missed
+      if self._slot:
+        continue
+      remaining = None if deadline is None else deadline - time.time()
+      if remaining is not None and remaining <= 0:
+        raise queue.Empty
+      self._nonempty.wait(remaining)
+    # concurrent producers may append out of seq order
+    self.n_overwritten += max(0, seq - self._last_seq - 1)
+    self._last_seq = max(seq, self._last_seq)
+    return item
+
+  def clear(self):
+    """Discards the item, if any."""
+    try:
+      self.get(block=False)
+    except queue.Empty:
+      pass
 
 
 class Timer(object):
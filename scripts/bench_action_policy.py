@@ -0,0 +1,179 @@
+"""
+  Reproducible offline comparison of the action policies for skipped steps
+  (rl_app/action_policy.py). Plays the games of rl_app/gameplay.py step by
+  step in one process, without sockets or real time, so that the score and
+  the skip counts only depend on the seeds:
+  - the action for the frame of step t reaches the client at step t + --lag;
+  - a step gets no new action with probability --skip_rate, in bursts of
+    --burst steps on average (a skipped step);
+  - the agent plays the paddle heuristic of rl_app/action_policy.py on the
+    frame it got (--agent=heuristic), or random actions.
+
+  The defaults are what bench_loopback.py measures on a 2 Mbps link with a
+  100 ms rtt: 3 to 4 frames of lag and about 30% skipped steps, almost all
+  alone between two actions.
+
+  Example invokation:
+  python3 scripts/bench_action_policy.py --burst 1 3 6 --n_seeds=5
+"""
+import argparse
+import itertools
+import json
+import tempfile
+
+import numpy as np
+
+from rl_app.action_policy import POLICIES, paddle_action
+from rl_app.gameplay import NEW_GAME_PENALTY, GamePlay
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--env_name', type=str, default='Breakout-v0')
+parser.add_argument('--sps', type=int, default=30)
+parser.add_argument('--frameskip', type=int, default=3)
+parser.add_argument('--time', type=int, default=60, help='Game seconds')
+parser.add_argument('--policies',
+                    type=str,
+                    nargs='+',
+                    default=sorted(POLICIES))
+parser.add_argument('--agent',
+                    type=str,
+                    default='heuristic',
+                    choices=['heuristic', 'random'])
+parser.add_argument('--lag', type=int, default=4, help='in steps')
+parser.add_argument('--skip_rate', type=float, default=.3)
+parser.add_argument('--burst',
+                    type=float,
+                    nargs='+',
+                    default=[1.],
+                    help='Mean number of skipped steps in a row')
+parser.add_argument('--n_seeds', type=int, default=5)
+parser.add_argument('--out', type=str, default=None, help='Write a json here')
+
+
+def skip_pattern(n_steps, skip_rate, burst, rand):
+  """Whether each step is skipped: a two state Markov chain that stays
+  skipping for `burst` steps on average, and skips skip_rate of the steps."""
+  p_end = 1. / burst
+  p_start = min(skip_rate * p_end / (1. - skip_rate), 1.)
+  skipped = np.zeros(n_steps, dtype=bool)
+  skipping = False
+  for i in range(n_steps):
+    skipping = rand.rand() < (1. - p_end if skipping else p_start)
+    skipped[i] = skipping
+  return skipped
+
+
+class OfflineGamePlay(GamePlay):
+  """GamePlay whose agent answers every frame after a fixed number of steps,
+  through the same mailbox of actions as the network."""
+
+  def __init__(self, seed, lag, skipped, agent, **kwargs):
+    super().__init__(agent_server_ip=None,
+                     frames_port=None,
+                     action_port=None,
+                     **kwargs)
+    self.seed = seed
+    self.lag = lag
+    self.skipped = skipped
+    self.agent = agent
+    # (step, game_id, observation) of the frames on their way
+    self._sent = []
+
+  def _make_env(self, env_number=0):
+    env = super()._make_env(env_number)
+    env.seed(self.seed * 1000 + env_number)
+    return env
+
+  def begin(self):
+    self._env, self._obs = self._new_game()
+    self.sum_r = 0
+    self.n_steps = 0
+    self._info = None
+    self.new_game_last_step = False
+
+  def send_frame(self):
+    self._policy.observe(self._obs)
+    self._sent.append((self.n_steps, self.game_id, self._obs))
+
+  def apply_action(self):
+    # answers older than the lag were superseded by later ones
+    due = [f for f in self._sent if f[0] <= self.n_steps - self.lag]
+    self._sent = self._sent[len(due):]
+    if due and not self.skipped[self.n_steps]:
+      frame_id, game_id, obs = due[-1]
+      self._latest_action.put([
+          self.n_steps / self.sps,
+          dict(action=self.agent(obs),
+               frame_id=frame_id,
+               frame_timestamp=frame_id / self.sps,
+               frame_size=0,
+               game_id=game_id)
+      ])
+    super().apply_action()
+
+  def _process(self):
+    while not self.done():
+      self.send_frame()
+      self.apply_action()
+
+  def summary(self):
+    return dict(score=self.sum_r - self.game_id * NEW_GAME_PENALTY,
+                total_games=self.game_id + 1,
+                n_skipped_actions=sum(s.is_skip_action
+                                      for s in self._game_stats),
+                **self._policy.stats())
+
+
+def make_agent(name, noop_action, rand):
+  if name == 'heuristic':
+    return lambda obs: paddle_action(obs, noop_action)
+  return lambda obs: rand.randint(4)
+
+
+def run(args, policy, burst, seed):
+  rand = np.random.RandomState(seed)
+  n_steps = args.sps * args.time
+  game = OfflineGamePlay(seed=seed,
+                         lag=args.lag,
+                         skipped=skip_pattern(n_steps, args.skip_rate, burst,
+                                              rand),
+                         agent=None,
+                         env_name=args.env_name,
+                         sps=args.sps,
+                         time_limit=args.time,
+                         results_dir=tempfile.mkdtemp(prefix='bench_policy'),
+                         frameskip=args.frameskip,
+                         action_policy=policy)
+  game.agent = make_agent(args.agent, game._get_noop_action(), rand)
+  game.begin()
+  game._process()
+  return game.summary()
+
+
+def main():
+  args = parser.parse_args()
+  rows = []
+  print('%-8s %6s %16s %10s %8s' %
+        ('policy', 'burst', 'score', 'skipped', 'games'))
+  for burst, policy in itertools.product(args.burst, args.policies):
+    runs = [run(args, policy, burst, seed) for seed in range(args.n_seeds)]
+    scores = [r['score'] for r in runs]
+    row = dict(policy=policy,
+               burst=burst,
+               score_mean=float(np.mean(scores)),
+               score_std=float(np.std(scores)),
+               n_skipped_actions=float(
+                   np.mean([r['n_skipped_actions'] for r in runs])),
+               total_games=float(np.mean([r['total_games'] for r in runs])),
+               runs=runs)
+    rows.append(row)
+    print('%-8s %6.1f %8.1f +- %5.1f %10.1f %8.1f' %
+          (policy, burst, row['score_mean'], row['score_std'],
+           row['n_skipped_actions'], row['total_games']))
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(rows, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
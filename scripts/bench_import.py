@@ -0,0 +1,100 @@
+"""
+  Measures the import-time cost of the client and agent entry points using
+  `python3 -X importtime`.
+
+  Example invokation:
+  python3 scripts/bench_import.py --repeat=5 --top=15
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+MODULES = {
+    'client': 'rl_app.gameplay',
+    'agent': 'rl_app.agent_server',
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--targets',
+                    type=str,
+                    nargs='+',
+                    default=sorted(MODULES.keys()),
+                    choices=sorted(MODULES.keys()))
+parser.add_argument('--repeat',
+                    type=int,
+                    default=3,
+                    help='Number of fresh interpreters to average over')
+parser.add_argument('--top',
+                    type=int,
+                    default=10,
+                    help='Show the N most expensive imports')
+parser.add_argument('--depth',
+                    type=int,
+                    default=1,
+                    help='Only report imports nested at most this deep. '
+                    '1 = modules imported directly by the entry point')
+
+
+def parse_importtime(stderr, max_depth):
+  """Returns {module: (self_us, cumulative_us)} for imports nested at most
+  max_depth levels deep."""
+  ret = {}
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    self_us, cumulative_us, name = line[len('import time:'):].split('|')
+    # nested imports are indented by two spaces per level.
+    depth = (len(name) - len(name.lstrip()) - 1) // 2
+    if depth > max_depth:
+      continue
+    ret[name.strip()] = (int(self_us), int(cumulative_us))
+  return ret
+
+
+def run_once(module, max_depth):
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(
+      filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+  start_t = time.time()
+  proc = subprocess.run(
+      [sys.executable, '-X', 'importtime', '-c',
+       'import %s' % module],
+      stderr=subprocess.PIPE,
+      universal_newlines=True,
+      env=env)
+  wall_time = time.time() - start_t
+  if proc.returncode != 0:
+    raise Exception('Failed to import %s:\n%s' % (module, proc.stderr))
+  return wall_time, parse_importtime(proc.stderr, max_depth)
+
+
+def bench(target, repeat, top, max_depth):
+  module = MODULES[target]
+  wall_times = []
+  per_module = {}
+  for _ in range(repeat):
+    wall_time, imports = run_once(module, max_depth)
+    wall_times.append(wall_time)
+    for name, (_, cumulative_us) in imports.items():
+      per_module.setdefault(name, []).append(cumulative_us)
+
+  print('%s (%s): %.3f s wall (min %.3f s over %d runs)' %
+        (target, module, np.mean(wall_times), np.min(wall_times), repeat))
+  ranked = sorted(per_module.items(), key=lambda kv: -np.mean(kv[1]))
+  for name, times in ranked[:top]:
+    print('  %10.1f ms  %s' % (np.mean(times) / 1e3, name))
+  return np.mean(wall_times)
+
+
+def main():
+  args = parser.parse_args()
+  for target in args.targets:
+    bench(target, args.repeat, args.top, args.depth)
+
+
+if __name__ == '__main__':
+  main()
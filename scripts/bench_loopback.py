@@ -0,0 +1,195 @@
+"""
+  Runs GamePlay and Agent in one process over loopback TCP, optionally
+  through the userspace link emulator, and reports frame-to-action latency,
+  achieved sps, the skipped-action rate and the score. Needs neither root,
+  mahimahi nor the ccp kernel module.
+
+  Compare the action policies for skipped steps on a slow link with e.g.
+  for p in repeat latest paddle; do python3 scripts/bench_loopback.py --trace=mm_traces/2mbps.log --rtt=100 --action_policy=$p; done
+  The run to run variation of a live run is large, see
+  scripts/bench_action_policy.py for a reproducible offline comparison.
+
+  Example invokation:
+  python3 scripts/bench_loopback.py --time=30 --sps=30 --agent=stub --trace=mm_traces/2mbps.log --rtt=20 --queue_size=20
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from rl_app.agent_server import Agent, get_num_actions
+from rl_app.gameplay import GamePlay
+from scripts.link_emulator import LinkEmulator, load_trace
+
+INF_TRACE = 'mm_traces/100mbps.log'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--env_name', type=str, default='Breakout-v0')
+parser.add_argument('--sps', type=int, default=30)
+parser.add_argument('--frameskip', type=int, default=3)
+parser.add_argument('--time', type=int, default=30)
+parser.add_argument('--agent',
+                    type=str,
+                    default='model',
+                    choices=['model', 'stub'],
+                    help='stub replaces the neural net by a random policy '
+                    'with a fixed inference time')
+parser.add_argument('--stub_infer_ms', type=float, default=5.)
+parser.add_argument('--model_fname', type=str, default=None)
+parser.add_argument('--n_cpu', type=int, default=4)
+parser.add_argument('--action_port', type=int, default=10000)
+parser.add_argument('--frames_port', type=int, default=10001)
+parser.add_argument('--cc_fallback',
+                    type=str,
+                    default='cubic',
+                    help='Congestion control to use if ccp is not loaded')
+parser.add_argument('-T',
+                    '--trace',
+                    type=str,
+                    default=None,
+                    help='Emulate a link with this mahimahi uplink trace. '
+                    'Plain loopback if not given')
+parser.add_argument('-r', '--rtt', type=int, default=0, help='in ms')
+parser.add_argument('--queue_size', type=int, default=10, help='in packets')
+parser.add_argument('--emulator_port_offset',
+                    type=int,
+                    default=100,
+                    help='The emulator listens on the game ports + this')
+parser.add_argument('--action_policy',
+                    type=str,
+                    default='repeat',
+                    help='Policy for skipped steps, see rl_app/action_policy.py')
+parser.add_argument('--plan_len',
+                    type=int,
+                    default=1,
+                    help='Number of actions the agent plans per frame')
+parser.add_argument('--max_frame_age',
+                    type=float,
+                    default=None,
+                    help='Agent drops frames this many ms older than usual')
+parser.add_argument('--results_dir', type=str, default=None)
+
+
+class LoopbackGamePlay(GamePlay):
+  """GamePlay without the ping process."""
+
+  def _start_ping(self):
+    return None
+
+  def _process(self):
+    start_t = time.time()
+    super()._process()
+    self.elapsed = time.time() - start_t
+
+
+class StubAgent(Agent):
+  """Agent whose neural net is replaced by a random policy that takes
+  infer_ms to evaluate."""
+
+  def __init__(self, infer_ms, **kwargs):
+    self._infer_s = infer_ms / 1e3
+    super().__init__(**kwargs)
+
+  def _make_predictor(self, env_name, model_fname, n_cpu):
+    num_actions = get_num_actions(env_name)
+
+    def pred(s):
+      time.sleep(self._infer_s)
+      return [np.random.dirichlet(np.ones(num_actions), size=len(s))]
+
+    return pred
+
+
+def summarize(game, agent):
+  with open(os.path.join(game.results_dir, 'results.json')) as f:
+    results = json.load(f)
+  stats = game._game_stats
+  acted = [s for s in stats if not s.is_skip_action]
+  lag_ms = np.array([s.lag_time for s in acted]) * 1e3
+  lag_frames = np.array([s.lag_n_frames for s in acted])
+  n_steps = len(stats)
+  summary = dict(n_steps=n_steps,
+                 sps=n_steps / game.elapsed,
+                 target_sps=game.sps,
+                 skipped_action_rate=1 - len(acted) / max(n_steps, 1),
+                 score=results['score'],
+                 total_games=results['total_games'],
+                 action_policy=game.action_policy,
+                 n_plan_actions=game.n_plan_actions)
+  summary.update(
+      {'agent_%s' % k: v for k, v in (agent.frame_stats or {}).items()})
+  for q in [50, 90, 99]:
+    summary['lag_ms_p%d' % q] = np.percentile(lag_ms, q) if acted else None
+    summary['lag_n_frames_p%d' %
+            q] = np.percentile(lag_frames, q) if acted else None
+  summary['lag_ms_max'] = float(lag_ms.max()) if acted else None
+  return summary
+
+
+def main():
+  args = parser.parse_args()
+  results_dir = args.results_dir or tempfile.mkdtemp(prefix='bench_loopback')
+
+  agent_kwargs = dict(env_name=args.env_name,
+                      frames_port=args.frames_port,
+                      action_port=args.action_port,
+                      n_cpu=args.n_cpu,
+                      model_fname=args.model_fname,
+                      time=args.time + 20,
+                      verbose=False,
+                      cc_fallback=args.cc_fallback,
+                      plan_len=args.plan_len,
+                      max_frame_age=args.max_frame_age)
+  if args.agent == 'stub':
+    agent = StubAgent(args.stub_infer_ms, **agent_kwargs)
+  else:
+    agent = Agent(**agent_kwargs)
+  agent_thread = threading.Thread(target=agent.start)
+  agent_thread.daemon = True
+  agent_thread.start()
+
+  frames_port, action_port = args.frames_port, args.action_port
+  if args.trace:
+    if args.rtt % 2 != 0:
+      raise Exception('Specify even number for rtt value')
+    frames_port += args.emulator_port_offset
+    action_port += args.emulator_port_offset
+    emulator = LinkEmulator(load_trace(args.trace),
+                            load_trace(INF_TRACE),
+                            delay_ms=args.rtt // 2,
+                            queue_packets=args.queue_size,
+                            port_map={
+                                frames_port: ('127.0.0.1', args.frames_port),
+                                action_port: ('127.0.0.1', args.action_port),
+                            })
+    emulator.start()
+
+  game = LoopbackGamePlay(env_name=args.env_name,
+                          sps=args.sps,
+                          agent_server_ip='127.0.0.1',
+                          frames_port=frames_port,
+                          action_port=action_port,
+                          time_limit=args.time,
+                          results_dir=results_dir,
+                          frameskip=args.frameskip,
+                          cc_fallback=args.cc_fallback,
+                          action_policy=args.action_policy)
+  game.start()
+  agent_thread.join(timeout=10)
+
+  summary = summarize(game, agent)
+  print('')
+  for k in sorted(summary):
+    v = summary[k]
+    print('%-22s %s' % (k, '%.3f' % v if isinstance(v, float) else v))
+  with open(os.path.join(results_dir, 'bench.json'), 'w') as f:
+    json.dump(summary, f, indent=4, sort_keys=True)
+  print('Results in %s' % results_dir)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+"""
+  Compares rl_app.util.Mailbox with put_overwrite on a queue.Queue(1), the
+  latest-value slot the client and the agent used before, under contention:
+  producer threads put items as fast as they can while one consumer takes
+  them.
+
+  Example invokation:
+  python3 scripts/bench_mailbox.py --producers=2 --n_items=200000
+"""
+import argparse
+import queue
+import threading
+import time
+
+import numpy as np
+
+from rl_app.util import Mailbox, put_overwrite
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--producers', type=int, default=2)
+parser.add_argument('--n_items',
+                    type=int,
+                    default=100000,
+                    help='Items put by every producer')
+parser.add_argument('--repeat', type=int, default=3)
+
+
+class QueueSlot:
+  """queue.Queue(1) driven through put_overwrite, with Mailbox's API."""
+
+  def __init__(self):
+    self._q = queue.Queue(1)
+    self.n_full_errors = 0
+
+  def put(self, item):
+    try:
+      put_overwrite(self._q, item)
+    except queue.Full:
+      # another producer refilled the queue between get_nowait and
+      # put_nowait
+      self.n_full_errors += 1
+
+  def get(self, block=True, timeout=None):
+    return self._q.get(block=block, timeout=timeout)
+
+
+def run_once(slot, n_producers, n_items):
+  """Returns (puts per second, consumer latencies in us, items taken)."""
+  done = threading.Event()
+  latencies = []
+
+  def produce():
+    for _ in range(n_items):
+      slot.put(time.perf_counter())
+
+  def consume():
+    while True:
+      try:
+        t = slot.get(timeout=.1)
+      except queue.Empty:
+        if done.is_set():
+          return
+        continue
+      latencies.append(time.perf_counter() - t)
+
+  consumer = threading.Thread(target=consume)
+  consumer.start()
+  producers = [threading.Thread(target=produce) for _ in range(n_producers)]
+  start_t = time.perf_counter()
+  for p in producers:
+    p.start()
+  for p in producers:
+    p.join()
+  elapsed = time.perf_counter() - start_t
+  done.set()
+  consumer.join()
+  return n_producers * n_items / elapsed, np.array(latencies) * 1e6
+
+
+def main():
+  args = parser.parse_args()
+  for name, make_slot in [('put_overwrite', QueueSlot), ('Mailbox', Mailbox)]:
+    rates, latencies = [], []
+    n_taken, n_errors, n_overwritten = 0, 0, 0
+    for _ in range(args.repeat):
+      slot = make_slot()
+      rate, lat = run_once(slot, args.producers, args.n_items)
+      rates.append(rate)
+      latencies.append(lat)
+      n_taken += len(lat)
+      n_errors += getattr(slot, 'n_full_errors', 0)
+      n_overwritten += getattr(slot, 'n_overwritten', 0)
+    lat = np.concatenate(latencies)
+    print('%-14s %9.0f puts/s  get latency p50=%6.1fus p99=%8.1fus  '
+          'taken=%d full_errors=%d overwritten=%d' %
+          (name, np.mean(rates), np.percentile(lat, 50),
+           np.percentile(lat, 99), n_taken, n_errors, n_overwritten))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,505 @@
+"""
+  Discrete-event simulation of one CCP flow over a mahimahi trace, for
+  iterating on a congestion control algorithm without running the game.
+
+  The link is modelled like mm-delay + mm-link: a fixed one-way delay in
+  both directions and a droptail queue drained by the delivery
+  opportunities of the trace (1500 bytes each). Acks drive a stand-in for
+  the CCP datapath that runs the "half_rtt" program of your_code/newcc.py
+  and hands the same Report fields (acked, sacked, loss, inflight, timeout,
+  rtt, minrtt, numpkts, now) to the flow's on_report. Cwnd and Rate set by
+  the flow limit the sender.
+
+  Example invokation:
+  python3 scripts/cc_sim.py -T mm_traces/12mbps.log --rtt=20 --queue_size=50 --time=120 --plot=/tmp/cc_sim.png
+
+  Frames of the game, paced by the controller, logged for
+  scripts/compare_pacing.py:
+  python3 scripts/cc_sim.py -T mm_traces/2mbps.log --rtt=100 --queue_size=100 --app_mbps=1 --app_fps=30 --alg_args pacing=true --log=/tmp/paced.log
+"""
+import argparse
+import contextlib
+import heapq
+import importlib
+import json
+import math
+import os
+import sys
+import time
+import types
+from collections import deque, namedtuple
+
+import numpy as np
+
+from scripts.link_emulator import MTU_BYTES, MahimahiLog, load_trace
+
+MSS = 1448
+# Linux does not retransmit on timeout sooner than this
+MIN_RTO_MS = 200.
+
+# rin and rout are only filled by the "on_change" program
+Report = namedtuple('Report', [
+    'acked', 'sacked', 'loss', 'inflight', 'timeout', 'rtt', 'minrtt',
+    'numpkts', 'now', 'rin', 'rout'
+])
+DatapathInfo = namedtuple('DatapathInfo', [
+    'sock_id', 'init_cwnd', 'mss', 'src_ip', 'src_port', 'dst_ip', 'dst_port'
+])
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-T', '--trace', type=str, required=True)
+parser.add_argument('-r', '--rtt', type=int, default=20, help='in ms')
+parser.add_argument('--queue_size', type=int, default=50, help='in packets')
+parser.add_argument('--time', type=float, default=60, help='in seconds')
+parser.add_argument('--alg',
+                    type=str,
+                    default='your_code.newcc:NewCC',
+                    help='module:class of the portus algorithm to simulate')
+parser.add_argument('--alg_args',
+                    type=str,
+                    nargs='*',
+                    default=[],
+                    help='key=value arguments of the algorithm class, e.g. '
+                    'program=on_change')
+parser.add_argument('--app_mbps',
+                    type=float,
+                    default=None,
+                    help='Application sending rate. Backlogged if not given')
+parser.add_argument('--app_fps',
+                    type=float,
+                    default=None,
+                    help='The application writes --app_mbps in this many '
+                    'frames per second, each at once like the game. A '
+                    'steady stream if not given')
+parser.add_argument('--log',
+                    type=str,
+                    default=None,
+                    help='Write a mahimahi uplink log of the bottleneck here')
+parser.add_argument('--plot', type=str, default=None, help='Plot to this file')
+parser.add_argument('--verbose',
+                    dest='verbose',
+                    action='store_true',
+                    help='Show what the algorithm prints')
+
+
+def load_alg(spec):
+  """Returns the portus.AlgBase subclass named module:class. Uses a minimal
+  stand-in for the portus module if the real bindings are not installed,
+  since the algorithm only needs it as a base class."""
+  module_name, cls_name = spec.split(':')
+  try:
+    import portus
+  except ImportError:
+    portus = types.ModuleType('portus')
+    portus.AlgBase = type('AlgBase', (object, ), {})
+    sys.modules['portus'] = portus
+  return getattr(importlib.import_module(module_name), cls_name)
+
+
+def parse_alg_args(alg_args):
+  """{key: value} of key=value strings. Values are parsed as JSON when they
+  can be, e.g. numbers."""
+  kwargs = {}
+  for arg in alg_args:
+    key, _, value = arg.partition('=')
+    try:
+      kwargs[key] = json.loads(value)
+    except ValueError:
+      kwargs[key] = value
+  return kwargs
+
+
+class SimDatapath:
+  """Stands in for the datapath handle portus gives to a flow. Runs the
+  datapath programs of your_code/newcc.py on every ack: accumulate into the
+  Report and send it on loss or timeout, or
+  - "half_rtt": once half a base rtt has passed since the last report.
+  - "on_change": once a base rtt has passed, or min_report_interval_us has
+    passed and the rtt moved by more than 1/8 since the last report."""
+
+  def __init__(self, flow_factory, min_report_interval_us=0):
+    self.fields = dict(Cwnd=10 * MSS, Rate=0)
+    self.program = None
+    self.min_report_interval_us = min_report_interval_us
+    self.n_reports = 0
+    # cpu time spent in the flow's on_report
+    self.report_cpu_s = 0.
+    self._basertt = float('inf')
+    self._last_report_us = 0
+    self._last_rtt = 0
+    self._sent_bytes = 0
+    self._reset_report()
+    self.info = DatapathInfo(sock_id=1,
+                             init_cwnd=10 * MSS,
+                             mss=MSS,
+                             src_ip=0,
+                             src_port=0,
+                             dst_ip=0,
+                             dst_port=0)
+    self.flow = flow_factory(self, self.info)
+
+  # the datapath API used by the flows
+  def set_program(self, name, fields):
+    self.program = name
+    self.fields.update(dict(fields))
+
+  def update_field(self, name, value):
+    self.fields[name] = value
+
+  def update_fields(self, fields):
+    self.fields.update(dict(fields))
+
+  def _reset_report(self):
+    self._report = dict(acked=0,
+                        sacked=0,
+                        loss=0,
+                        inflight=0,
+                        timeout=0,
+                        rtt=0,
+                        minrtt=float('inf'),
+                        numpkts=0,
+                        now=0,
+                        rin=0,
+                        rout=0)
+    self._sent_bytes = 0
+
+  def on_send(self, n_bytes):
+    self._sent_bytes += n_bytes
+
+  def on_ack(self, now_us, bytes_acked, inflight, rtt_us, lost, timeout):
+    r = self._report
+    r['acked'] += bytes_acked
+    r['inflight'] = inflight
+    if rtt_us is not None:
+      r['rtt'] = rtt_us
+      r['minrtt'] = min(r['minrtt'], rtt_us)
+      self._basertt = min(self._basertt, rtt_us)
+    r['loss'] = lost
+    r['timeout'] = int(timeout)
+    r['now'] = now_us
+    micros = now_us - self._last_report_us
+    if timeout or lost > 0:
+      self._send_report(now_us)
+    elif self.program == 'on_change':
+      rtt_moved = abs(r['rtt'] - self._last_rtt) > self._last_rtt / 8
+      if micros > self._basertt or (micros > self.min_report_interval_us and
+                                    rtt_moved):
+        self._last_rtt = r['rtt']
+        self._send_report(now_us)
+    elif micros > self._basertt / 2:
+      self._send_report(now_us)
+
+  def _send_report(self, now_us):
+    if self.program == 'on_change' and now_us > self._last_report_us:
+      # what Flow.rate_incoming and Flow.rate_outgoing would measure
+      elapsed_s = (now_us - self._last_report_us) / 1e6
+      self._report['rin'] = int(self._report['acked'] / elapsed_s)
+      self._report['rout'] = int(self._sent_bytes / elapsed_s)
+    self._last_report_us = now_us
+    self.n_reports += 1
+    r = Report(**self._report)
+    self._reset_report()
+    start = time.process_time()
+    self.flow.on_report(r)
+    self.report_cpu_s += time.process_time() - start
+
+
+class Simulation:
+  """One flow from a sender to a receiver through a trace-driven droptail
+  bottleneck. Times are in ms."""
+
+  def __init__(self,
+               trace,
+               rtt_ms,
+               queue_packets,
+               alg,
+               app_mbps=None,
+               app_fps=None,
+               log=None):
+    self.trace = trace
+    self.delay_ms = rtt_ms / 2.
+    self.queue_packets = queue_packets
+    self.app_mbps = app_mbps
+    self.app_fps = app_fps
+    self.log = log
+    self.datapath = SimDatapath(
+        alg.new_flow, getattr(alg, 'min_report_interval_us', 0))
+
+    self._events = []
+    self._n_events = 0
+    # sender
+    self._next_seq = 0
+    self._outstanding = deque()  # (seq, send time)
+    self._next_send_ms = 0.
+    self._send_scheduled = False
+    self._rto_deadline = None
+    self._min_rtt_ms = float('inf')
+    # bottleneck
+    self._queue = deque()  # (seq, arrival time)
+    self._op_idx = 0
+    self._op_scheduled = False
+    self._n_logged_ops = 0
+    # what happened, for the metrics
+    self.departures = []  # (time, queueing delay)
+    self.arrivals = []
+    self.n_drops = 0
+    self.n_timeouts = 0
+    self.cwnds = []  # (time, cwnd)
+
+  def _push(self, t_ms, kind, *args):
+    # the counter keeps events of the same time in insertion order
+    self._n_events += 1
+    heapq.heappush(self._events, (t_ms, self._n_events, kind, args))
+
+  def _op_time(self, i):
+    n = len(self.trace)
+    return self.trace[i % n] + (i // n) * self.trace[-1]
+
+  def _log_ops_until(self, t_ms):
+    while self._op_time(self._n_logged_ops) <= t_ms:
+      self.log.opportunity(self._op_time(self._n_logged_ops))
+      self._n_logged_ops += 1
+
+  def run(self, duration_s):
+    end_ms = duration_s * 1e3
+    self._try_send(0.)
+    while self._events and self._events[0][0] <= end_ms:
+      t, _, kind, args = heapq.heappop(self._events)
+      if self.log is not None:
+        self._log_ops_until(t)
+      getattr(self, '_on_' + kind)(t, *args)
+    self.duration_ms = end_ms
+    n_loops, rest_ms = divmod(end_ms, self.trace[-1])
+    self.n_capacity_ops = int(n_loops) * len(self.trace) + int(
+        np.searchsorted(self.trace, rest_ms, side='right'))
+
+  # sender
+  def _window_open(self):
+    cwnd = max(self.datapath.fields['Cwnd'], 2 * MSS)
+    return (len(self._outstanding) + 1) * MSS <= cwnd
+
+  def _try_send(self, now):
+    while self._window_open():
+      wait_until = now
+      rate = self.datapath.fields['Rate']
+      if rate > 0:
+        wait_until = max(wait_until, self._next_send_ms)
+      if self.app_mbps:
+        wait_until = max(wait_until, self._app_ready_ms(self._next_seq))
+      if wait_until > now:
+        if not self._send_scheduled:
+          self._send_scheduled = True
+          self._push(wait_until, 'send')
+        return
+      seq = self._next_seq
+      self._next_seq += 1
+      self._outstanding.append((seq, now))
+      self.datapath.on_send(MSS)
+      self._push(now + self.delay_ms, 'arrival', seq)
+      if rate > 0:
+        self._next_send_ms = max(now, self._next_send_ms) + MTU_BYTES / rate * 1e3
+      if self._rto_deadline is None:
+        self._arm_rto(now)
+
+  def _app_ready_ms(self, seq):
+    """When the application has produced the bytes of packet seq: it
+    produces (app rate * now) bytes so far, or with app_fps, a frame of them
+    at the start of every frame interval."""
+    t = (seq + 1) * MSS * 8 / (self.app_mbps * 1e3)
+    if not self.app_fps:
+      return t
+    frame_ms = 1e3 / self.app_fps
+    return (math.ceil(t / frame_ms) - 1) * frame_ms
+
+  def _on_send(self, now):
+    self._send_scheduled = False
+    self._try_send(now)
+
+  def _rto_ms(self):
+    if self._min_rtt_ms == float('inf'):
+      return 1e3
+    return max(MIN_RTO_MS, 3 * self._min_rtt_ms)
+
+  def _arm_rto(self, now):
+    self._rto_deadline = now + self._rto_ms()
+    self._push(self._rto_deadline, 'rto', self._rto_deadline)
+
+  def _on_rto(self, now, deadline):
+    if deadline != self._rto_deadline:
+      # re-armed since
+      return
+    self._rto_deadline = None
+    if not self._outstanding:
+      return
+    lost = len(self._outstanding)
+    self._outstanding.clear()
+    self.n_timeouts += 1
+    self.datapath.on_ack(int(now * 1e3), 0, 0, None, lost, True)
+    self.cwnds.append((now, self.datapath.fields['Cwnd']))
+    self._try_send(now)
+
+  def _on_ack(self, now, seq):
+    # the bottleneck is fifo, so unacked packets sent before seq were dropped
+    lost = 0
+    while self._outstanding and self._outstanding[0][0] < seq:
+      self._outstanding.popleft()
+      lost += 1
+    rtt_us = None
+    if self._outstanding and self._outstanding[0][0] == seq:
+      _, send_ms = self._outstanding.popleft()
+      self._min_rtt_ms = min(self._min_rtt_ms, now - send_ms)
+      rtt_us = int((now - send_ms) * 1e3)
+    else:
+      # acks a packet already given up on by a timeout
+      return
+    self.datapath.on_ack(int(now * 1e3), MSS, len(self._outstanding), rtt_us,
+                         lost, False)
+    self.cwnds.append((now, self.datapath.fields['Cwnd']))
+    self._rto_deadline = None
+    if self._outstanding:
+      self._arm_rto(now)
+    self._try_send(now)
+
+  # bottleneck
+  def _on_arrival(self, now, seq):
+    if len(self._queue) >= self.queue_packets:
+      self.n_drops += 1
+      return
+    self.arrivals.append(now)
+    if self.log is not None:
+      self.log.arrival(int(now), MTU_BYTES)
+    self._queue.append((seq, now))
+    self._schedule_op(now)
+
+  def _schedule_op(self, now):
+    if self._op_scheduled or not self._queue:
+      return
+    # opportunities while the queue was empty went unused
+    while self._op_time(self._op_idx) < now:
+      self._op_idx += 1
+    self._op_scheduled = True
+    self._push(self._op_time(self._op_idx), 'op')
+
+  def _on_op(self, now):
+    self._op_scheduled = False
+    self._op_idx += 1
+    seq, arrival_ms = self._queue.popleft()
+    self.departures.append((now, now - arrival_ms))
+    if self.log is not None:
+      self.log.departure(int(now), MTU_BYTES, int(now - arrival_ms))
+    self._push(now + self.delay_ms, 'ack', seq)
+    self._schedule_op(now)
+
+
+def summarize(sim):
+  """Throughput and delay metrics of the bottleneck, like plot_mahimahi."""
+  duration_s = sim.duration_ms / 1e3
+  departures = np.array(sim.departures, dtype=np.float64).reshape(-1, 2)
+  queueing_ms = departures[:, 1]
+  capacity = sim.n_capacity_ops * MTU_BYTES * 8 / duration_s / 1e6
+  throughput = len(departures) * MTU_BYTES * 8 / duration_s / 1e6
+  n_arrivals = len(sim.arrivals) + sim.n_drops
+  summary = dict(capacity_mbps=capacity,
+                 throughput_mbps=throughput,
+                 utilization=throughput / capacity if capacity else None,
+                 loss_rate=sim.n_drops / n_arrivals if n_arrivals else 0.,
+                 n_drops=sim.n_drops,
+                 n_timeouts=sim.n_timeouts,
+                 n_reports=sim.datapath.n_reports,
+                 reports_per_s=sim.datapath.n_reports / duration_s,
+                 report_cpu_ms=sim.datapath.report_cpu_s * 1e3)
+  for q in [50, 95, 99]:
+    summary['queueing_delay_ms_p%d' %
+            q] = float(np.percentile(queueing_ms, q)) if len(departures) else None
+    summary['delay_ms_p%d' % q] = (summary['queueing_delay_ms_p%d' % q] +
+                                   sim.delay_ms) if len(departures) else None
+  return summary
+
+
+def binned_mbps(t_ms, duration_ms, ms_per_bin):
+  """Mbps of 1500 byte packets at times t_ms, per bin of ms_per_bin."""
+  counts = np.bincount((np.asarray(t_ms) // ms_per_bin).astype(np.int64),
+                       minlength=int(duration_ms // ms_per_bin) + 1)
+  y = counts * MTU_BYTES * 8. / ms_per_bin / 1e3
+  x = np.arange(len(y)) * ms_per_bin / 1e3
+  return x, y
+
+
+def plot(sim, fname, ms_per_bin=200):
+  import matplotlib as mpl
+  mpl.use('Agg')
+  import matplotlib.pyplot as plt
+
+  ops = [sim._op_time(i) for i in range(sim.n_capacity_ops)]
+  departures = np.array(sim.departures, dtype=np.float64).reshape(-1, 2)
+  cwnds = np.array(sim.cwnds, dtype=np.float64).reshape(-1, 2)
+  fig, axes = plt.subplots(3, 1, sharex=True, figsize=(8, 9))
+  for label, t in [('Capacity', ops), ('Ingress', sim.arrivals),
+                   ('Egress', departures[:, 0])]:
+    x, y = binned_mbps(t, sim.duration_ms, ms_per_bin)
+    axes[0].plot(x, y, label='%s-%.3f' % (label, np.mean(y)))
+  axes[0].set_ylabel('Mbps')
+  axes[0].legend()
+  axes[1].plot(departures[:, 0] / 1e3, departures[:, 1] + sim.delay_ms)
+  axes[1].set_ylabel('one-way delay (ms)')
+  axes[2].plot(cwnds[:, 0] / 1e3, cwnds[:, 1])
+  axes[2].set_ylabel('cwnd (bytes)')
+  axes[2].set_xlabel('sec')
+  plt.savefig(fname=fname)
+
+
+def simulate(trace,
+             rtt_ms,
+             queue_packets,
+             alg,
+             duration_s,
+             alg_kwargs=None,
+             app_mbps=None,
+             app_fps=None,
+             log=None,
+             verbose=False):
+  """Runs the flow of the algorithm class `alg`, constructed with
+  alg_kwargs, and returns the Simulation."""
+  with contextlib.ExitStack() as stack:
+    if not verbose:
+      devnull = stack.enter_context(open(os.devnull, 'w'))
+      stack.enter_context(contextlib.redirect_stdout(devnull))
+    sim = Simulation(trace,
+                     rtt_ms,
+                     queue_packets,
+                     alg(**(alg_kwargs or {})),
+                     app_mbps=app_mbps,
+                     app_fps=app_fps,
+                     log=log)
+    sim.run(duration_s)
+  return sim
+
+
+def main():
+  args = parser.parse_args()
+  if args.rtt % 2 != 0:
+    raise Exception('Specify even number for rtt value')
+  log = None
+  if args.log:
+    log = MahimahiLog(args.log, 0, 'packets=%d' % args.queue_size,
+                      ' '.join(sys.argv))
+  sim = simulate(load_trace(args.trace),
+                 args.rtt,
+                 args.queue_size,
+                 load_alg(args.alg),
+                 args.time,
+                 alg_kwargs=parse_alg_args(args.alg_args),
+                 app_mbps=args.app_mbps,
+                 app_fps=args.app_fps,
+                 log=log,
+                 verbose=args.verbose)
+  if log is not None:
+    log.close()
+  summary = summarize(sim)
+  print(json.dumps(summary, indent=4, sort_keys=True))
+  if args.plot:
+    plot(sim, args.plot)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,118 @@
+"""
+  Scores a CCP algorithm in scripts/cc_sim.py over many link scenarios drawn
+  from the ranges of scripts/eval.py: a cellular trace renormalized to
+  0.5-2 Mbps, an rtt of 4-14 ms and a queue of 1-51 BDPs. Scenarios run in
+  a process pool. Writes one CSV row per scenario and prints a summary.
+
+  Example invokation:
+  python3 scripts/cc_sweep.py --n_scenarios=1000 --time=30 --out=/tmp/cc_sweep.csv
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+from scripts import cc_sim
+from scripts.link_emulator import load_trace
+from scripts.traces import TRACEFILES, renormalize_trace, trace_path
+
+COLUMNS = [
+    'name', 'trace', 'avg_tpt', 'rtt', 'queue', 'utilization',
+    'throughput_mbps', 'queueing_delay_ms_p95', 'delay_ms_p95', 'loss_rate',
+    'n_timeouts', 'n_reports'
+]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--traces',
+                    type=str,
+                    nargs='+',
+                    default=[trace_path(t + '.up') for t in TRACEFILES],
+                    help='Trace files to draw from')
+parser.add_argument('--n_scenarios', type=int, default=1000)
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--time', type=float, default=30, help='in seconds')
+parser.add_argument('--alg', type=str, default='your_code.newcc:NewCC')
+parser.add_argument('--n_procs', type=int, default=os.cpu_count())
+parser.add_argument('--out', type=str, default='cc_sweep.csv')
+
+
+def make_scenarios(traces, n, seed):
+  """Draws n scenarios the way scripts/eval.py picks its experiments."""
+  rand = random.Random(seed)
+  scenarios = []
+  for _ in range(n):
+    trace = traces[rand.randint(0, len(traces) - 1)]
+    avg_tpt = 0.5 + 1.5 * rand.random()
+    rtt = 2 * int(2.5 + 5 * rand.random())
+    queue_size_factor = 1 + 50 * rand.random()
+    queue = int(queue_size_factor * (1.0e6 * avg_tpt / (1500. * 8)) *
+                (rtt / 1000.))
+    name = '%s-%.2f-%.2f-%d' % (os.path.basename(trace), avg_tpt, rtt, queue)
+    scenarios.append(
+        dict(name=name, trace=trace, avg_tpt=avg_tpt, rtt=rtt, queue=queue))
+  return scenarios
+
+
+_traces = {}
+_alg = None
+
+
+def _init_worker(alg):
+  global _alg
+  _alg = cc_sim.load_alg(alg)
+
+
+def run_scenario(args):
+  scenario, duration_s = args
+  if scenario['trace'] not in _traces:
+    _traces[scenario['trace']] = load_trace(scenario['trace'])
+  trace = renormalize_trace(_traces[scenario['trace']], scenario['avg_tpt'])
+  # a queue under one packet would drop everything
+  sim = cc_sim.simulate(trace, scenario['rtt'], max(1, scenario['queue']),
+                        _alg, duration_s)
+  row = dict(scenario)
+  row.update(cc_sim.summarize(sim))
+  return row
+
+
+def print_summary(rows):
+  print('%-50s %6s %10s %8s' % ('scenario', 'util', 'q_p95_ms', 'loss'))
+  for row in sorted(rows, key=lambda r: r['utilization']):
+    print('%-50s %6.3f %10.1f %8.4f' %
+          (row['name'], row['utilization'], row['queueing_delay_ms_p95'],
+           row['loss_rate']))
+  util = np.array([r['utilization'] for r in rows])
+  delay = np.array([r['queueing_delay_ms_p95'] for r in rows])
+  loss = np.array([r['loss_rate'] for r in rows])
+  print('%d scenarios: utilization mean %.3f min %.3f, p95 queueing delay '
+        'median %.1f ms max %.1f ms, loss mean %.4f' %
+        (len(rows), util.mean(), util.min(), np.median(delay), delay.max(),
+         loss.mean()))
+
+
+def main():
+  args = parser.parse_args()
+  scenarios = make_scenarios(args.traces, args.n_scenarios, args.seed)
+  with multiprocessing.Pool(args.n_procs,
+                            initializer=_init_worker,
+                            initargs=(args.alg, )) as pool:
+    rows = []
+    for i, row in enumerate(
+        pool.imap_unordered(run_scenario, [(s, args.time) for s in scenarios])):
+      rows.append(row)
+      if (i + 1) % 50 == 0:
+        print('%d/%d scenarios done' % (i + 1, len(scenarios)))
+  rows.sort(key=lambda r: r['name'])
+  with open(args.out, 'w') as f:
+    writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+  print_summary(rows)
+  print('Wrote %s' % args.out)
+
+
+if __name__ == '__main__':
+  main()
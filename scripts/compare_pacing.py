@@ -0,0 +1,81 @@
+"""
+  Compares the queue occupancy of the bottleneck between a run that writes
+  every frame in one burst and one that paces it (gameplay --pace_frames,
+  and a controller that sets a pacing rate, e.g. your_code/newcc --pacing).
+  Reads the mahimahi uplink logs of the two runs with
+  rl_app.plt_util.get_q_size_mahimahi, prints the occupancy percentiles and
+  optionally plots it over time and its CDF.
+
+  Example invokation:
+  python3 scripts/run_exp.py -n unpaced --results_dir=/tmp/base ...
+  python3 scripts/run_exp.py -n paced --results_dir=/tmp/base ... -- --pace_frames
+  python3 scripts/compare_pacing.py /tmp/base/unpaced/mm_uplink.log /tmp/base/paced/mm_uplink.log --plot=/tmp/pacing.png
+"""
+import argparse
+
+import matplotlib as mpl
+mpl.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+from rl_app.plt_util import get_q_size_mahimahi
+
+PERCENTILES = [50, 95, 99]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('unpaced', type=str, help='mahimahi uplink log')
+parser.add_argument('paced', type=str, help='mahimahi uplink log')
+parser.add_argument('--ms_per_bin', type=int, default=10)
+parser.add_argument('--skip_s',
+                    type=float,
+                    default=1.,
+                    help='Ignore the start of the runs')
+parser.add_argument('--plot', type=str, default=None, help='Save a plot here')
+
+
+def queue_stats(q):
+  """Mean, percentiles and max of the queue occupancy, in packets."""
+  ret = dict(mean=np.mean(q) if len(q) else 0., max=np.max(q) if len(q) else 0.)
+  for p in PERCENTILES:
+    ret['p%d' % p] = np.percentile(q, p) if len(q) else 0.
+  return ret
+
+
+def load_queue(fname, ms_per_bin, skip_s):
+  x, y = get_q_size_mahimahi(fname, ms_per_bin=ms_per_bin)
+  x, y = np.asarray(x), np.asarray(y)
+  return x[x >= skip_s], y[x >= skip_s]
+
+
+def plot(queues, fname):
+  fig, (ax_t, ax_cdf) = plt.subplots(1, 2, figsize=(12, 4))
+  for label, (x, y) in queues.items():
+    ax_t.plot(x, y, label=label)
+    q = np.sort(y)
+    ax_cdf.plot(q, np.arange(1, len(q) + 1) / max(len(q), 1), label=label)
+  ax_t.set_xlabel('sec')
+  ax_t.set_ylabel('queue (packets)')
+  ax_cdf.set_xlabel('queue (packets)')
+  ax_cdf.set_ylabel('CDF')
+  ax_t.legend()
+  ax_cdf.legend()
+  fig.savefig(fname)
+
+
+def main():
+  args = parser.parse_args()
+  queues = {
+      label: load_queue(fname, args.ms_per_bin, args.skip_s)
+      for label, fname in [('unpaced', args.unpaced), ('paced', args.paced)]
+  }
+  keys = ['mean'] + ['p%d' % p for p in PERCENTILES] + ['max']
+  print('queue (packets)  ' + ''.join(['%8s' % k for k in keys]))
+  for label, (_, y) in queues.items():
+    stats = queue_stats(y)
+    print('%-16s ' % label + ''.join(['%8.1f' % stats[k] for k in keys]))
+  if args.plot:
+    plot(queues, args.plot)
+
+
+if __name__ == '__main__':
+  main()
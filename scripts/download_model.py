@@ -6,6 +6,9 @@ ENV_TO_URL = {
     'Breakout-v0': 'http://models.tensorpack.com/OpenAIGym/Breakout-v0.npz'
 }
 ENV_TO_FNAME = {'Breakout-v0': 'Breakout-v0.npz'}
+# Size of the action space of each env, so that the agent does not need to
+# import gym just to look it up.
+ENV_TO_NUM_ACTIONS = {'Breakout-v0': 4}
 
 
 def download_pretrained_weights(env_name):
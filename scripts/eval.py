@@ -1,52 +1,39 @@
 import argparse
 import glob
-import numpy as np
+import hashlib
+import io
+import json
 import os
 import random
 import shutil
 import subprocess
 import tarfile
 
+from scripts.run_exp import get_server_cmd, parser as run_exp_parser
+from scripts.traces import TRACEFILES, renormalize_trace_file, trace_path
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--run', dest='run', action='store_true')
 parser.add_argument('--upload', dest='upload', action='store_true')
 parser.add_argument('--results_dir', help='Directory to store results in/upload results from', default='eval_results/', type=str)
+parser.add_argument('--server', help='Leaderboard server to upload to', default='http://6829fa18.csail.mit.edu', type=str)
 parser.add_argument('--team', help='Registered team name', default='', type=str)
 parser.add_argument('--seed', default=1, type=int, help='Pick a different seed for evaluation. Note, you should upload only experiments with the default seed to the leaderboard')
 parser.add_argument('--dry_run', dest='dry_run', action='store_true')
+parser.add_argument('--fresh_agent', dest='fresh_agent', action='store_true', help='Start a new agent for every experiment instead of reusing one agent daemon')
+parser.add_argument('--bundle', default='results', choices=['results', 'full'], help='Upload only what the leaderboard reads, or the whole results directory')
+parser.add_argument('--with_summaries', dest='with_summaries', action='store_true', help='With --bundle=results, also upload the game_results/*.json summaries and the plots')
+parser.add_argument('--force_upload', dest='force_upload', action='store_true', help='Upload every experiment, even those unchanged since the last upload')
+parser.add_argument('--compress_threads', default=os.cpu_count(), type=int, help='Compress with this many pigz threads, if pigz is installed')
 args = parser.parse_args()
 
-def renormalize_trace_file(ifname, ofname, tpt):
-    ''' Read trace file `ifname` and output to `ofname` a trace file with an
-    average of `tpt` Mbit/s '''
-
-    # Read the file
-    trace = []
-    with open(ifname, 'r') as f:
-        for line in f.readlines():
-            trace.append(int(line))
-    trace = np.asarray(trace, dtype=np.float64)
-
-    # Average throughput of the input trace file (in bits/s)
-    in_tpt = 1500 * 8 * len(trace) / (1e-3 * trace[-1])
-
-    # Renormalize
-    trace *= in_tpt / (tpt * 1e6)
-
-    # Remove any gaps greater than a threshold and output into new trace file
-    # Previous timestamp and maximum gap between packets
-    prev, gap_thresh = 0, 2000
-    # How much do we subtract off samples to remove gaps?
-    cur_offset = 0
-    with open(ofname, 'w') as f:
-        for t in trace:
-            t -= cur_offset
-            diff = t - prev
-            if diff > gap_thresh:
-                cur_offset += diff - gap_thresh
-                t -= diff - gap_thresh
-            prev = t
-            f.write(str(int(t)) + '\n')
+# Remembers what was uploaded for each team, to skip unchanged experiments
+UPLOAD_MANIFEST = '.upload_manifest.json'
+
+# The defaults of scripts/run_exp.py, which the experiments run with. The
+# agent daemon serves them on the same ports, with the same model and time
+RUN_EXP_ARGS = run_exp_parser.parse_args(['--name', 'agent_daemon'])
+AGENT_DAEMON_CMD = get_server_cmd(RUN_EXP_ARGS, daemon=True)
 
 def run():
     # Check if the results directory is already there
@@ -58,18 +45,27 @@ def run():
         shutil.rmtree(args.results_dir)
     os.mkdir(args.results_dir)
 
-    # List of all the trace files (without the .up)
-    tracefiles = ["ATT-LTE-driving-2016", "ATT-LTE-driving",
-    "TMobile-LTE-driving", "TMobile-LTE-short", "TMobile-UMTS-driving",
-    "Verizon-EVDO-driving", "Verizon-LTE-driving", "Verizon-LTE-short"]
-
     # So we can find 'rl_app' module
     os.environ['PYTHONPATH'] = os.getcwd()
 
+    # Load the model once and let every experiment reuse the same agent
+    agent = None
+    if not args.fresh_agent:
+        print(AGENT_DAEMON_CMD)
+        if not args.dry_run:
+            agent = subprocess.Popen(AGENT_DAEMON_CMD, shell=True)
+
+    try:
+        run_configs(not args.fresh_agent)
+    finally:
+        if agent is not None:
+            agent.kill()
+
+def run_configs(reuse_agent):
     # Pick some random configurations and run them
     random.seed(args.seed)
     for _ in range(5):
-        tracefile = "/usr/share/mahimahi/traces/" + tracefiles[random.randint(0, len(tracefiles)-1)]
+        tracefile = trace_path(TRACEFILES[random.randint(0, len(TRACEFILES)-1)])
         # In mbps
         avg_tpt = 0.5 + 1.5 * random.random()
         # In ms
@@ -83,14 +79,71 @@ def run():
         renormalize_trace_file(tracefile + '.up', '/tmp/trace.up', avg_tpt)
 
         # Run
-        cmd = 'python3 scripts/run_exp.py -n {name} --results_dir {results_dir} -r {rtt} -T /tmp/trace.up --queue_size {queue}'\
+        cmd = 'python3 scripts/run_exp.py -n {name} --results_dir {results_dir} -r {rtt} -T /tmp/trace.up --queue_size {queue} --frames_port {frames_port} --action_port {action_port}'\
         .format(
-            name=name, results_dir=args.results_dir, rtt=rtt, queue=queue
+            name=name, results_dir=args.results_dir, rtt=rtt, queue=queue,
+            frames_port=RUN_EXP_ARGS.frames_port, action_port=RUN_EXP_ARGS.action_port
         )
+        if reuse_agent:
+            cmd += ' --reuse_agent'
         print(cmd)
         if not args.dry_run:
             subprocess.run(cmd, shell=True)
 
+def list_experiments():
+    ''' Returns {expt_name: [file names to upload]} for every experiment in
+    the results directory '''
+    expts = {}
+    for fname in sorted(glob.glob(os.path.join(args.results_dir, '*', 'game_results', 'results.json'))):
+        expt_dir = os.path.dirname(os.path.dirname(fname))
+        if args.bundle == 'full':
+            files = [os.path.join(root, f) for root, _, fs in os.walk(expt_dir) for f in fs]
+        elif args.with_summaries:
+            files = glob.glob(os.path.join(expt_dir, 'game_results', '*.json'))
+            files += glob.glob(os.path.join(expt_dir, '*.png'))
+            files += glob.glob(os.path.join(expt_dir, 'game_results', '*.png'))
+        else:
+            files = [fname]
+        expts[os.path.basename(expt_dir)] = sorted(files)
+    return expts
+
+def hash_files(fnames):
+    ''' sha256 of the names and contents of the given files '''
+    sha = hashlib.sha256()
+    for fname in fnames:
+        sha.update(os.path.relpath(fname, args.results_dir).encode() + b'\0')
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def write_tarball(tfname, fnames, manifest):
+    ''' Writes fnames and the manifest into the tarball tfname, with the
+    results directory as the top-level directory. Compresses with pigz on
+    several threads if it is installed, else with gzip '''
+    root = os.path.basename(os.path.normpath(args.results_dir))
+    manifest = json.dumps(dict(experiments=manifest), indent=4, sort_keys=True).encode()
+
+    def add_files(tar):
+        for fname in fnames:
+            tar.add(fname, arcname=os.path.join(root, os.path.relpath(fname, args.results_dir)))
+        info = tarfile.TarInfo(os.path.join(root, 'manifest.json'))
+        info.size = len(manifest)
+        tar.addfile(info, io.BytesIO(manifest))
+
+    pigz = shutil.which('pigz')
+    if pigz is None or args.compress_threads <= 1:
+        with tarfile.open(tfname, 'x:gz') as tar:
+            add_files(tar)
+        return
+    with open(tfname, 'xb') as f:
+        proc = subprocess.Popen([pigz, '-p', str(args.compress_threads), '-c'], stdin=subprocess.PIPE, stdout=f)
+        with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+            add_files(tar)
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise Exception('pigz failed')
+
 def upload():
     import requests
 
@@ -108,18 +161,39 @@ def upload():
     if os.path.exists(tfname):
         os.remove(tfname)
 
-    # Put folder into a tarball
+    # Hash every experiment and leave out those the server already has
+    expts = list_experiments()
+    if len(expts) == 0:
+        print("No experiments found in '%s'" % args.results_dir)
+        return
+    manifest = {expt: hash_files(fnames) for expt, fnames in expts.items()}
+    uploaded_fname = os.path.join(args.results_dir, UPLOAD_MANIFEST)
+    uploaded = {}
+    if os.path.exists(uploaded_fname):
+        with open(uploaded_fname) as f:
+            uploaded = json.load(f)
+    prev = {} if args.force_upload else uploaded.get(args.team, {})
+    changed = [expt for expt in sorted(expts) if prev.get(expt) != manifest[expt]]
+    if len(changed) == 0 and set(prev) == set(manifest):
+        print("No experiment changed since the last upload. Use '--force_upload' to upload anyway")
+        return
+    print("Uploading %d of %d experiments" % (len(changed), len(expts)))
+
+    # Put experiments into a tarball
     print("Writing tarfile...")
-    tar = tarfile.open(tfname, 'x:gz')
-    tar.add(args.results_dir)
-    tar.close()
+    write_tarball(tfname, sum([expts[expt] for expt in changed], []), manifest)
 
     with open(tfname, 'rb') as f:
         files = {"results": f}
         data = {"team": args.team}
-        r = requests.post('http://6829fa18.csail.mit.edu/upload_file', data=data, files=files)
+        r = requests.post(args.server + '/upload_file', data=data, files=files)
         print(r.content.decode())
 
+    if r.status_code == 200:
+        uploaded[args.team] = manifest
+        with open(uploaded_fname, 'w') as f:
+            json.dump(uploaded, f, indent=4, sort_keys=True)
+
     # Example using curl
     # curl localhost:8888/upload_file -Fteam=myteam2 -Fresults='@eval_results/results.tar.gz'
 
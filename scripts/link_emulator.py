@@ -0,0 +1,478 @@
+"""
+  Userspace emulation of `mm-delay D mm-link UP DOWN` for TCP connections.
+
+  The emulator accepts connections on its listen ports and proxies each of
+  them to a target address. Bytes sent by the client (the side that would be
+  inside the mahimahi shell) cross the uplink, bytes sent back by the server
+  cross the downlink. Logs are written in the mm-link format, so they can be
+  read by rl_app/plt_util.py.
+
+  Example invokation (same link as run_exp.py with --rtt=20 --thr=2):
+  python3 scripts/link_emulator.py 10 mm_traces/2mbps.log mm_traces/100mbps.log --uplink-queue-args="packets=20" --uplink-log=/tmp/mm_uplink.log --forward 11001:127.0.0.1:10001 --forward 11000:127.0.0.1:10000
+"""
+import argparse
+import collections
+import errno
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+
+MTU_BYTES = 1500
+READ_SIZE = 65536
+# flush the logs once this many lines are buffered
+LOG_BATCH = 4096
+# a target that refuses a connection may still be starting up, it is tried
+# again after CONNECT_RETRY_MS, at most CONNECT_ATTEMPTS times
+CONNECT_RETRY_MS = 100
+CONNECT_ATTEMPTS = 50
+
+
+def parse_queue_args(queue_args):
+  """Parses mm-link droptail queue args ("packets=N" or "bytes=N") into a
+  queue size in packets. None or "" means an unbounded queue."""
+  if not queue_args:
+    return None
+  key, _, value = queue_args.partition('=')
+  if key == 'packets':
+    return int(value)
+  elif key == 'bytes':
+    return max(1, int(value) // MTU_BYTES)
+  raise Exception('Unknown queue args %s' % queue_args)
+
+
+class MahimahiLog:
+  """Writes link events in the format of mm-link --uplink-log."""
+
+  def __init__(self, fname, start_ms, queue_args, command_line):
+    self._f = open(fname, 'w')
+    self._start_ms = start_ms
+    self._lines = []
+    init_ms = int(time.time() * 1e3)
+    self._f.write('# mm-link (userspace link_emulator.py)\n')
+    self._f.write('# command line: %s\n' % command_line)
+    self._f.write('# queue: droptail [%s]\n' % (queue_args or ''))
+    self._f.write('# init timestamp: %d\n' % init_ms)
+    # like mm-link, event times are in ms since the init timestamp
+    self._f.write('# base timestamp: 0\n')
+
+  def arrival(self, t_ms, n_bytes):
+    self._lines.append('%d + %d\n' % (t_ms - self._start_ms, n_bytes))
+
+  def opportunity(self, t_ms):
+    self._lines.append('%d # %d\n' % (t_ms - self._start_ms, MTU_BYTES))
+
+  def departure(self, t_ms, n_bytes, delay_ms):
+    self._lines.append('%d - %d %d\n' %
+                       (t_ms - self._start_ms, n_bytes, delay_ms))
+    if len(self._lines) >= LOG_BATCH:
+      self.flush()
+
+  def flush(self):
+    self._f.write(''.join(self._lines))
+    self._lines = []
+
+  def close(self):
+    self.flush()
+    self._f.close()
+
+
+def load_trace(fname):
+  """Reads the packet delivery opportunities (in ms) of a mahimahi trace."""
+  with open(fname) as f:
+    trace = [int(line) for line in f if line.strip()]
+  if not trace or trace[-1] <= 0:
+    raise Exception('Invalid mahimahi trace file %s' % fname)
+  return trace
+
+
+class TraceLink:
+  """One direction of an emulated link.
+
+    Bytes wait in a droptail queue of `queue_packets` MTUs (unbounded if
+    None) and are drained MTU_BYTES at a time at the delivery opportunities
+    of the trace, which repeats once it runs out (like mm-link). Drained
+    bytes reach their destination `delay_ms` later.
+
+    A TCP proxy can not drop bytes of the stream. Instead, a full queue stops
+    the emulator from reading the sender, so that TCP flow control pushes
+    back on it.
+  """
+
+  def __init__(self, trace, delay_ms, queue_packets, start_ms, log=None):
+    self._trace = trace
+    self._period_ms = trace[-1]
+    self._idx = 0
+    self._base_ms = start_ms
+    self.delay_ms = delay_ms
+    if queue_packets is None:
+      self.queue_limit = float('inf')
+    else:
+      self.queue_limit = queue_packets * MTU_BYTES
+    self.queue_bytes = 0
+    self.log = log
+    # entries are [arrival_ms, pipe, data]
+    self._queue = collections.deque()
+    # entries are (due_ms, pipe, data)
+    self._delayed = collections.deque()
+
+  def room(self):
+    return self.queue_limit - self.queue_bytes
+
+  def enqueue(self, now_ms, pipe, data):
+    for i in range(0, len(data), MTU_BYTES):
+      packet = data[i:i + MTU_BYTES]
+      self._queue.append([now_ms, pipe, packet])
+      if self.log:
+        self.log.arrival(now_ms, len(packet))
+    self.queue_bytes += len(data)
+    pipe.in_link += len(data)
+
+  def _next_opportunity_ms(self):
+    return self._base_ms + self._trace[self._idx]
+
+  def _use_opportunity(self, t_ms):
+    if self.log:
+      self.log.opportunity(t_ms)
+    budget = MTU_BYTES
+    while budget > 0 and self._queue:
+      entry = self._queue[0]
+      arrival_ms, pipe, data = entry
+      if len(data) <= budget:
+        self._queue.popleft()
+      else:
+        entry[2] = data[budget:]
+        data = data[:budget]
+      budget -= len(data)
+      self.queue_bytes -= len(data)
+      if self.log:
+        self.log.departure(t_ms, len(data), t_ms - arrival_ms)
+      self._delayed.append((t_ms + self.delay_ms, pipe, data))
+
+  def advance(self, now_ms):
+    """Uses up the delivery opportunities until now_ms and returns the
+    (pipe, data) whose delay has elapsed by then."""
+    while self._next_opportunity_ms() <= now_ms:
+      self._use_opportunity(self._next_opportunity_ms())
+      self._idx += 1
+      if self._idx == len(self._trace):
+        self._idx = 0
+        self._base_ms += self._period_ms
+
+    due = []
+    while self._delayed and self._delayed[0][0] <= now_ms:
+      _, pipe, data = self._delayed.popleft()
+      due.append((pipe, data))
+    return due
+
+  def next_event_ms(self):
+    t = float('inf')
+    if self._queue:
+      t = self._next_opportunity_ms()
+    if self._delayed:
+      t = min(t, self._delayed[0][0])
+    return t
+
+
+class _Pipe:
+  """One direction of a proxied connection."""
+
+  def __init__(self, src, dst, link):
+    self.src = src
+    self.dst = dst
+    self.link = link
+    # bytes that crossed the link but are not yet written to dst
+    self.out = bytearray()
+    # bytes inside the link
+    self.in_link = 0
+    self.eof = False
+    self.closed = False
+
+  def drained(self):
+    return self.eof and self.in_link == 0 and not self.out
+
+
+class _PendingConnect:
+  """An accepted connection whose connection to the target is in progress,
+  or waits for the next attempt at `retry_ms`."""
+
+  def __init__(self, conn, target):
+    self.conn = conn
+    self.target = target
+    self.server = None
+    self.n_attempts = 0
+    self.retry_ms = None
+
+
+class LinkEmulator:
+  """
+    Args:
+        uplink_trace, downlink_trace: delivery opportunities as returned by
+            load_trace.
+        delay_ms: one-way delay added in each direction (mm-delay).
+        queue_packets: droptail queue size of the uplink, in MTUs. None for
+            an unbounded queue.
+        port_map: {listen_port: (target_host, target_port)}
+        downlink_queue_packets: same as queue_packets for the downlink.
+        uplink_log, downlink_log: optional files to write mm-link style
+            logs to.
+  """
+
+  def __init__(self,
+               uplink_trace,
+               downlink_trace,
+               delay_ms,
+               queue_packets,
+               port_map,
+               listen_host='127.0.0.1',
+               downlink_queue_packets=None,
+               uplink_log=None,
+               downlink_log=None):
+    self._start_ms = self._now_ms()
+    self._logs = []
+    for fname, queue_size in [(uplink_log, queue_packets),
+                              (downlink_log, downlink_queue_packets)]:
+      if fname:
+        queue_args = '' if queue_size is None else 'packets=%d' % queue_size
+        self._logs.append(
+            MahimahiLog(fname, self._start_ms, queue_args,
+                        ' '.join(sys.argv)))
+      else:
+        self._logs.append(None)
+    self.uplink = TraceLink(uplink_trace, delay_ms, queue_packets,
+                            self._start_ms, self._logs[0])
+    self.downlink = TraceLink(downlink_trace, delay_ms,
+                              downlink_queue_packets, self._start_ms,
+                              self._logs[1])
+    self._sel = selectors.DefaultSelector()
+    self._interest = {}
+    self._stopped = False
+    self._thread = None
+    # sock -> (pipe it feeds, pipe it is fed by)
+    self._pipes = {}
+    # connections waiting to try their target again
+    self._retries = []
+    for listen_port, target in port_map.items():
+      lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      lsock.bind((listen_host, listen_port))
+      lsock.listen(8)
+      lsock.setblocking(False)
+      self._sel.register(lsock, selectors.EVENT_READ, target)
+
+  @staticmethod
+  def _now_ms():
+    return time.monotonic() * 1e3
+
+  def start(self):
+    self._thread = threading.Thread(target=self.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    return self._thread
+
+  def stop(self):
+    self._stopped = True
+    if self._thread:
+      self._thread.join()
+
+  def serve_forever(self):
+    links = [self.uplink, self.downlink]
+    try:
+      while not self._stopped:
+        now_ms = self._now_ms()
+        for link in links:
+          for pipe, data in link.advance(now_ms):
+            pipe.in_link -= len(data)
+            pipe.out += data
+        self._retry_connects(now_ms)
+        self._update_interest()
+
+        next_ms = min([link.next_event_ms() for link in links] +
+                      [p.retry_ms for p in self._retries])
+        timeout = min(max(next_ms - self._now_ms(), 0) / 1e3, .05)
+        for key, mask in self._sel.select(timeout):
+          if isinstance(key.data, _PendingConnect):
+            self._on_connect(key.data)
+          elif key.data is not None:
+            self._accept(key.fileobj, key.data)
+          else:
+            self._handle(key.fileobj, mask)
+    finally:
+      for log in self._logs:
+        if log:
+          log.close()
+
+  def _accept(self, lsock, target):
+    conn, _ = lsock.accept()
+    self._connect(_PendingConnect(conn, target))
+
+  def _connect(self, pending):
+    """Starts connecting to the target without blocking, the selector tells
+    when it is done. Other connections keep going in the meantime."""
+    pending.n_attempts += 1
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setblocking(False)
+    err = server.connect_ex(pending.target)
+    if err not in (0, errno.EINPROGRESS):
+      server.close()
+      self._schedule_retry(pending)
+      return
+    pending.server = server
+    self._sel.register(server, selectors.EVENT_WRITE, pending)
+
+  def _on_connect(self, pending):
+    server = pending.server
+    self._sel.unregister(server)
+    pending.server = None
+    if server.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+      server.close()
+      self._schedule_retry(pending)
+      return
+    self._add_connection(pending.conn, server)
+
+  def _schedule_retry(self, pending):
+    if pending.n_attempts >= CONNECT_ATTEMPTS:
+      print('link emulator: %s:%d refused the connection' % pending.target)
+      pending.conn.close()
+      return
+    pending.retry_ms = self._now_ms() + CONNECT_RETRY_MS
+    self._retries.append(pending)
+
+  def _retry_connects(self, now_ms):
+    due = [p for p in self._retries if p.retry_ms <= now_ms]
+    self._retries = [p for p in self._retries if p.retry_ms > now_ms]
+    for pending in due:
+      self._connect(pending)
+
+  def _add_connection(self, conn, server):
+    for sock in [conn, server]:
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      sock.setblocking(False)
+    up = _Pipe(conn, server, self.uplink)
+    down = _Pipe(server, conn, self.downlink)
+    self._pipes[conn] = (up, down)
+    self._pipes[server] = (down, up)
+    for sock in [conn, server]:
+      self._interest[sock] = 0
+
+  def _update_interest(self):
+    for sock, (feeds, fed_by) in list(self._pipes.items()):
+      mask = 0
+      if not feeds.eof and feeds.link.room() > 0:
+        mask |= selectors.EVENT_READ
+      if fed_by.out:
+        mask |= selectors.EVENT_WRITE
+      if mask == self._interest[sock]:
+        continue
+      if self._interest[sock] == 0:
+        self._sel.register(sock, mask)
+      elif mask == 0:
+        self._sel.unregister(sock)
+      else:
+        self._sel.modify(sock, mask)
+      self._interest[sock] = mask
+
+  def _handle(self, sock, mask):
+    feeds, fed_by = self._pipes[sock]
+    try:
+      # interest is set once per select() round, another connection on the
+      # same link may have filled it since. recv(0) would look like EOF
+      room = feeds.link.room()
+      if mask & selectors.EVENT_READ and room > 0:
+        data = sock.recv(min(READ_SIZE, room))
+        if data:
+          feeds.link.enqueue(self._now_ms(), feeds, data)
+        else:
+          feeds.eof = True
+      if mask & selectors.EVENT_WRITE and fed_by.out:
+        sent = sock.send(fed_by.out)
+        del fed_by.out[:sent]
+    except (ConnectionError, OSError):
+      self._close(sock)
+      return
+
+    for pipe in [feeds, fed_by]:
+      if pipe.drained() and not pipe.closed:
+        pipe.closed = True
+        try:
+          pipe.dst.shutdown(socket.SHUT_WR)
+        except OSError:
+          pass
+    if feeds.closed and fed_by.closed:
+      self._close(sock)
+
+  def _close(self, sock):
+    if sock not in self._pipes:
+      return
+    feeds, _ = self._pipes[sock]
+    for s in [feeds.src, feeds.dst]:
+      del self._pipes[s]
+      if self._interest.pop(s):
+        self._sel.unregister(s)
+      s.close()
+
+
+def parse_forward(forward):
+  """Parses LISTEN_PORT:HOST:PORT."""
+  listen_port, host, port = forward.split(':')
+  return int(listen_port), (host, int(port))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('delay', type=int, help='one-way delay in ms')
+  parser.add_argument('uplink_trace', type=str)
+  parser.add_argument('downlink_trace', type=str)
+  parser.add_argument('--uplink-queue',
+                      dest='uplink_queue',
+                      default='droptail',
+                      choices=['droptail', 'infinite'])
+  parser.add_argument('--uplink-queue-args',
+                      dest='uplink_queue_args',
+                      default='',
+                      help='e.g. packets=100 or bytes=150000')
+  parser.add_argument('--downlink-queue',
+                      dest='downlink_queue',
+                      default='droptail',
+                      choices=['droptail', 'infinite'])
+  parser.add_argument('--downlink-queue-args',
+                      dest='downlink_queue_args',
+                      default='')
+  parser.add_argument('--uplink-log', dest='uplink_log', default=None)
+  parser.add_argument('--downlink-log', dest='downlink_log', default=None)
+  parser.add_argument('--listen_host', type=str, default='127.0.0.1')
+  parser.add_argument('--forward',
+                      type=str,
+                      action='append',
+                      required=True,
+                      help='LISTEN_PORT:HOST:PORT. Can be repeated')
+  args = parser.parse_args()
+
+  uplink_queue = None
+  if args.uplink_queue == 'droptail':
+    uplink_queue = parse_queue_args(args.uplink_queue_args)
+  downlink_queue = None
+  if args.downlink_queue == 'droptail':
+    downlink_queue = parse_queue_args(args.downlink_queue_args)
+
+  emulator = LinkEmulator(load_trace(args.uplink_trace),
+                          load_trace(args.downlink_trace),
+                          delay_ms=args.delay,
+                          queue_packets=uplink_queue,
+                          port_map=dict(map(parse_forward, args.forward)),
+                          listen_host=args.listen_host,
+                          downlink_queue_packets=downlink_queue,
+                          uplink_log=args.uplink_log,
+                          downlink_log=args.downlink_log)
+  # exit through serve_forever's cleanup so that the logs get flushed.
+  signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+  try:
+    emulator.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
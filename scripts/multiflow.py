@@ -0,0 +1,325 @@
+"""
+  Runs N flows through one mahimahi bottleneck for every N of --n_flows,
+  and reports per-flow throughput, Jain's fairness index, rtt and queueing
+  delay percentiles, and the CPU time of the CCP userspace agent.
+
+  Flows are either iperf3 flows or games (gameplay.py --n_games N, with one
+  agent_server.py per game). The agent (--ccp_cmd) is restarted for every N,
+  so its CPU time covers exactly that run.
+
+  Per-flow throughput and rtt come from iperf3 -J, or from the tcp_info
+  samples of every game. The queueing delay is that of all the packets in
+  the uplink log.
+
+  There is no scripts/link_emulator.py mode: it terminates TCP and never
+  drops packets, so the flows under test would only be held back by flow
+  control on loopback and never see the loss or delay of the bottleneck.
+
+  Example invokation:
+  python3 scripts/multiflow.py -n fairness --results_dir=/tmp/base --kind=iperf --n_flows 1 2 4 8 --thr=12 --rtt=20 --queue_size=100 --time=30 --ccp_cmd="sudo your_code/newcc/target/debug/newcc"
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from rl_app import analysis
+from rl_app.cc_telemetry import load_mahimahi_delays
+
+INF_TRACE = 'mm_traces/100mbps.log'
+IPERF_PORT = 5201
+# expanded inside the mahimahi shell, not by the outer shell
+MAHIMAHI_BASE = "`echo '$MAHIMAHI_BASE'`"
+PERCENTILES = [50, 95, 99]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--name',
+                    '-n',
+                    type=str,
+                    required=True,
+                    help='Assign a name to this experiment.')
+parser.add_argument('--results_dir', default='results/', type=str)
+parser.add_argument('--kind', choices=['iperf', 'game'], default='iperf')
+parser.add_argument('--n_flows', type=int, nargs='+', default=[1, 2, 4, 8])
+parser.add_argument('-r', '--rtt', type=int, help='min rtt in milliseconds.')
+parser.add_argument('-t',
+                    '--thr',
+                    type=str,
+                    required=False,
+                    help='Bottleneck Throughput (in mbps)')
+parser.add_argument('-T',
+                    '--trace',
+                    type=str,
+                    required=False,
+                    help='Bottleneck Throughput Trace File')
+parser.add_argument('--queue_size', type=int, default=10)
+parser.add_argument('--time',
+                    type=int,
+                    default=30,
+                    help='time of every run in seconds')
+parser.add_argument('--cc',
+                    type=str,
+                    default='ccp',
+                    help='Congestion control of the iperf flows')
+parser.add_argument('--ccp_cmd',
+                    type=str,
+                    default=None,
+                    help='Command that starts the CCP userspace agent, e.g. '
+                    'your_code/newcc/target/debug/newcc. None if the agent '
+                    'is already running (its CPU time is then not reported)')
+parser.add_argument('--sps', type=int, default=30)
+parser.add_argument('--env_name', type=str, default='Breakout-v0')
+parser.add_argument('--model_cache_dir',
+                    type=str,
+                    default='./model_cache_dir/')
+parser.add_argument('--action_port', type=int, default=10000)
+parser.add_argument('--frames_port', type=int, default=10001)
+parser.add_argument('--dry_run', dest='dry_run', action='store_true')
+
+
+def jain_index(x):
+  """(sum x)^2 / (n sum x^2): 1 when all flows get the same, 1/n when one
+  flow gets everything."""
+  x = np.asarray(x, dtype=np.float64)
+  if not len(x) or not np.any(x):
+    return 0.
+  return float(np.sum(x)**2 / (len(x) * np.sum(x**2)))
+
+
+def _proc_stats():
+  """pid -> (ppid, cpu seconds) of every process."""
+  clk_tck = os.sysconf('SC_CLK_TCK')
+  ret = {}
+  for pid in os.listdir('/proc'):
+    if not pid.isdigit():
+      continue
+    try:
+      with open('/proc/%s/stat' % pid) as f:
+        stat = f.read()
+    except OSError:
+      continue
+    # the command name may contain spaces, the fields after it do not
+    fields = stat[stat.rfind(')') + 2:].split()
+    ret[int(pid)] = (int(fields[1]),
+                     (int(fields[11]) + int(fields[12])) / clk_tck)
+  return ret
+
+
+def process_tree_cpu_s(pid):
+  """User and system CPU seconds of pid and all its descendants, e.g. the
+  agent under sudo or a shell."""
+  stats = _proc_stats()
+  children = {}
+  for p, (ppid, _) in stats.items():
+    children.setdefault(ppid, []).append(p)
+  total, todo = 0., [pid]
+  while todo:
+    p = todo.pop()
+    if p in stats:
+      total += stats[p][1]
+    todo.extend(children.get(p, []))
+  return total
+
+
+def _percentiles(name, x):
+  ret = {}
+  for p in PERCENTILES:
+    ret['%s_p%d' % (name, p)] = float(np.percentile(x, p)) if len(x) else None
+  return ret
+
+
+def get_uplink_trace(args):
+  if args.trace is not None:
+    thr_file = args.trace
+  elif args.thr is not None:
+    thr_file = './mm_traces/%smbps.log' % args.thr
+  else:
+    raise Exception(
+        "Neither --trace or --thr arguments given. Specify exactly one.")
+  if not os.path.isfile(thr_file):
+    raise Exception('Throughput file not found at %s' % thr_file)
+  return thr_file
+
+
+def get_mahimahi_cmd(args, run_dir, cmd):
+  """Runs cmd in a mahimahi shell."""
+  return 'mm-delay {delay} mm-link --uplink-queue=droptail --uplink-queue-args="packets={queue_size}" \
+  {uplink_thr} {downlink_thr} --uplink-log={uplink_log} --downlink-log={downlink_log} <<EOF\n{cmd}\nEOF'.format(
+      delay=int(args.rtt / 2),
+      uplink_thr=get_uplink_trace(args),
+      downlink_thr=INF_TRACE,
+      queue_size=args.queue_size,
+      uplink_log=os.path.join(run_dir, 'mm_uplink.log'),
+      downlink_log=os.path.join(run_dir, 'mm_downlink.log'),
+      cmd=cmd)
+
+
+def get_iperf_cmds(args, run_dir, n):
+  ports = [IPERF_PORT + i for i in range(n)]
+  servers = ['exec iperf3 -s -1 -p %d > /dev/null' % port for port in ports]
+  clients = [
+      'iperf3 -c %s -p %d -t %d -C %s -J --logfile %s &' %
+      (MAHIMAHI_BASE, port, args.time, args.cc,
+       os.path.join(run_dir, 'iperf_%d.json' % i))
+      for i, port in enumerate(ports)
+  ]
+  return servers, '\n'.join(clients + ['wait'])
+
+
+def get_game_cmds(args, run_dir, n):
+  servers = []
+  for i in range(n):
+    cmd = 'export PYTHONPATH="$PYTHONPATH:%s";' % os.getcwd()
+    cmd += 'exec python3 rl_app/agent_server.py -- --env_name=%s' % args.env_name
+    cmd += ' --frames_port=%d --action_port=%d --model_fname=%s/%s.npz' % (
+        args.frames_port + 2 * i, args.action_port + 2 * i,
+        args.model_cache_dir, args.env_name)
+    cmd += ' --time=%d' % (args.time + 20)
+    servers.append(cmd)
+  client = 'export PYTHONPATH="$PYTHONPATH:%s";' % os.getcwd()
+  client += 'python3 rl_app/gameplay.py -- --frameskip=3 --sps=%d --env_name=%s' % (
+      args.sps, args.env_name)
+  client += ' --server_ip=%s' % MAHIMAHI_BASE
+  client += ' --frames_port=%d --action_port=%d --results_dir=%s' % (
+      args.frames_port, args.action_port, os.path.join(run_dir,
+                                                       'game_results'))
+  client += ' --time=%d --n_games=%d --n_procs=%d' % (args.time, n,
+                                                      min(n, os.cpu_count()))
+  return servers, client
+
+
+def load_iperf_flows(run_dir, n):
+  """Throughput (Mbps) and rtt samples (ms) of every iperf flow."""
+  tpt, rtts = [], []
+  for i in range(n):
+    with open(os.path.join(run_dir, 'iperf_%d.json' % i)) as f:
+      res = json.load(f)
+    tpt.append(res['end']['sum_received']['bits_per_second'] / 1e6)
+    rtts.append([
+        s['rtt'] / 1e3
+        for interval in res['intervals']
+        for s in interval['streams']
+        if s.get('rtt')
+    ])
+  return tpt, rtts
+
+
+def load_game_flows(run_dir, n):
+  """Throughput (Mbps) and srtt samples (ms) of the frames socket of every
+  game."""
+  tpt, rtts = [], []
+  for i in range(n):
+    tcp_info = analysis.load_tcp_info(
+        os.path.join(run_dir, 'game_results', 'game_%d' % i,
+                     'tcp_info_frames.npy'))
+    if tcp_info is None or len(tcp_info) < 2:
+      tpt.append(0.)
+      rtts.append([])
+      continue
+    elapsed = tcp_info['t'][-1] - tcp_info['t'][0]
+    acked = float(tcp_info['bytes_acked'][-1]) - tcp_info['bytes_acked'][0]
+    tpt.append(acked * 8 / elapsed / 1e6 if elapsed > 0 else 0.)
+    rtts.append(tcp_info['rtt'][tcp_info['rtt'] > 0] / 1e3)
+  return tpt, rtts
+
+
+def summarize_run(args, run_dir, n, ccp_cpu_s):
+  if args.kind == 'iperf':
+    tpt, rtts = load_iperf_flows(run_dir, n)
+  else:
+    tpt, rtts = load_game_flows(run_dir, n)
+  _, delays = load_mahimahi_delays(os.path.join(run_dir, 'mm_uplink.log'))
+  summary = dict(n_flows=n,
+                 throughput_mbps=tpt,
+                 total_throughput_mbps=float(np.sum(tpt)),
+                 jain_index=jain_index(tpt),
+                 ccp_cpu_s=ccp_cpu_s,
+                 ccp_cpu_ms_per_flow_s=None
+                 if ccp_cpu_s is None else ccp_cpu_s * 1e3 / n / args.time)
+  summary.update(_percentiles('rtt_ms', np.concatenate(rtts)))
+  summary.update(_percentiles('queueing_delay_ms', delays))
+  return summary
+
+
+def subprocess_cmd(command, dry_run=False):
+  if dry_run:
+    print(command)
+    return None
+  return subprocess.Popen(command,
+                          stdout=sys.stdout,
+                          stderr=sys.stderr,
+                          shell=True)
+
+
+def stop(process):
+  if process is not None and process.poll() is None:
+    process.terminate()
+    try:
+      process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+      process.kill()
+
+
+def run(args, n):
+  run_dir = os.path.join(args.results_dir, args.name, 'n_%d' % n)
+  if not args.dry_run:
+    os.makedirs(run_dir, exist_ok=True)
+  if args.kind == 'iperf':
+    server_cmds, client_cmd = get_iperf_cmds(args, run_dir, n)
+  else:
+    server_cmds, client_cmd = get_game_cmds(args, run_dir, n)
+  link_cmd = get_mahimahi_cmd(args, run_dir, client_cmd)
+
+  agent = None
+  if args.ccp_cmd:
+    agent = subprocess_cmd('exec ' + args.ccp_cmd, dry_run=args.dry_run)
+    # let the agent register with the datapath before the flows start
+    time.sleep(0 if args.dry_run else 1)
+  servers = [subprocess_cmd(cmd, dry_run=args.dry_run) for cmd in server_cmds]
+  client = subprocess_cmd(link_cmd, dry_run=args.dry_run)
+  ret = client.wait() if client is not None else 0
+
+  ccp_cpu_s = None
+  if agent is not None:
+    ccp_cpu_s = process_tree_cpu_s(agent.pid)
+  for process in servers + [agent]:
+    stop(process)
+  if ret != 0:
+    raise Exception('Failure executing command %s' % link_cmd)
+  if args.dry_run:
+    return None
+  return summarize_run(args, run_dir, n, ccp_cpu_s)
+
+
+def print_summary(summaries):
+  keys = [
+      'n_flows', 'total_throughput_mbps', 'jain_index', 'rtt_ms_p95',
+      'queueing_delay_ms_p50', 'queueing_delay_ms_p95',
+      'queueing_delay_ms_p99', 'ccp_cpu_ms_per_flow_s'
+  ]
+  print(''.join(['%24s' % k for k in keys]))
+  for s in summaries:
+    print(''.join([
+        '%24s' % ('-' if s[k] is None else '%.3f' % s[k]) for k in keys
+    ]))
+
+
+def main():
+  args = parser.parse_args()
+  if args.rtt is None or args.rtt % 2 != 0:
+    raise Exception('Specify an even number for --rtt')
+  summaries = [run(args, n) for n in args.n_flows]
+  if args.dry_run:
+    return
+  with open(os.path.join(args.results_dir, args.name, 'multiflow.json'),
+            'w') as f:
+    json.dump(summaries, f, indent=4, sort_keys=True)
+  print_summary(summaries)
+
+
+if __name__ == '__main__':
+  main()
@@ -9,6 +9,7 @@ import subprocess
 import sys
 import threading
 
+from rl_app.analysis import plot_results
 from rl_app.plt_util import parse_mahimahi_out, parse_ping, get_q_size_mahimahi
 import matplotlib.pyplot as plt
 import matplotlib as mpl
@@ -17,6 +18,8 @@ mpl.use('Agg')
 INF_TRACE = 'mm_traces/100mbps.log'
 MAHIMAHI_BASE = '100.64.0.4'
 MTU_BYTES = 1500
+# scripts/link_emulator.py listens on the game ports + this offset
+LINK_EMULATOR_PORT_OFFSET = 100
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--render', dest='render', action='store_true')
@@ -56,12 +59,31 @@ parser.add_argument('--model_cache_dir',
 parser.add_argument('--disable_mahimahi',
                     dest='disable_mahimahi',
                     action='store_true')
+parser.add_argument(
+    '--userspace_link',
+    dest='userspace_link',
+    action='store_true',
+    help='Emulate the link with scripts/link_emulator.py instead of mahimahi')
 parser.add_argument('--dry_run', dest='dry_run', action='store_true')
 parser.add_argument('--action_port', type=int, default=10000)
 parser.add_argument('--frames_port', type=int, default=10001)
 parser.add_argument('--use_iperf', dest='use_iperf', action='store_true')
+parser.add_argument(
+    '--reuse_agent',
+    dest='reuse_agent',
+    action='store_true',
+    help='Connect to an already running `agent_server.py --daemon` on the '
+    'action/frames ports instead of starting a new agent. The agent flags '
+    '(--plan_len, --max_frame_age) are then those of the daemon')
+parser.add_argument('--plan_len',
+                    type=int,
+                    default=1,
+                    help='Number of actions the agent plans per frame')
+parser.add_argument('--max_frame_age',
+                    type=float,
+                    default=None,
+                    help='Agent drops frames this many ms older than usual')
 parser.add_argument('remaining_args', nargs='*')
-args = parser.parse_args()
 
 
 def run_cmd(cmd, blocking=True, dry_run=False):
@@ -94,7 +116,7 @@ def subprocess_cmd(command, dry_run=False):
     return process
 
 
-def get_mahimahi_stub(args):
+def get_uplink_trace(args):
   if args.rtt % 2 != 0:
     raise Exception('Specify even number for rtt value')
   if args.queue_size_factor is not None:
@@ -114,7 +136,11 @@ def get_mahimahi_stub(args):
     raise Exception(
         'Throughput file not found at %s. Check mm_traces/generate_const_mahimahi_traces.sh'
         % thr_file)
+  return thr_file
 
+
+def get_mahimahi_stub(args):
+  thr_file = get_uplink_trace(args)
   uplink_log = os.path.join(args.results_dir, args.name, 'mm_uplink.log')
   downlink_log = os.path.join(args.results_dir, args.name, 'mm_downlink.log')
 
@@ -130,12 +156,39 @@ def get_mahimahi_stub(args):
   return cmd
 
 
-def get_server_cmd(args):
+def get_link_emulator_cmd(args):
+  thr_file = get_uplink_trace(args)
+  cmd = 'exec python3 scripts/link_emulator.py {delay} {uplink_thr} {downlink_thr} \
+  --uplink-queue=droptail --uplink-queue-args="packets={queue_size}" \
+  --uplink-log={uplink_log} --downlink-log={downlink_log}'.format(
+      delay=int(args.rtt / 2),
+      uplink_thr=thr_file,
+      downlink_thr=INF_TRACE,
+      uplink_log=os.path.join(args.results_dir, args.name, 'mm_uplink.log'),
+      downlink_log=os.path.join(args.results_dir, args.name,
+                                'mm_downlink.log'),
+      queue_size=args.queue_size)
+  for port in [args.frames_port, args.action_port]:
+    cmd += ' --forward %d:127.0.0.1:%d' % (port + LINK_EMULATOR_PORT_OFFSET,
+                                           port)
+  return cmd
+
+
+def get_server_cmd(args, daemon=False):
+  """Command of the agent of the experiment, or with `daemon` of an agent
+  that serves the experiments run with --reuse_agent and the same ports."""
   cmd = 'export PYTHONPATH="$PYTHONPATH:%s";' % os.getcwd()
-  cmd += 'exec python3 rl_app/agent_server.py -- --env_name=%s' % args.env_name
+  cmd += 'exec python3 rl_app/agent_server.py --'
+  if daemon:
+    cmd += ' --daemon'
+  cmd += ' --env_name=%s' % args.env_name
   cmd += ' --frames_port=%d --action_port=%d --model_fname=%s/%s.npz' % (
       args.frames_port, args.action_port, args.model_cache_dir, args.env_name)
   cmd += ' --time=%d' % (args.time + 20)
+  if args.plan_len > 1:
+    cmd += ' --plan_len=%d' % args.plan_len
+  if args.max_frame_age is not None:
+    cmd += ' --max_frame_age=%f' % args.max_frame_age
   return cmd
 
 
@@ -144,12 +197,17 @@ def get_client_cmd(args, disable_mahimahi):
   cmd = 'export PYTHONPATH="$PYTHONPATH:%s";' % os.getcwd()
   cmd += 'python3 rl_app/gameplay.py -- --frameskip=3 --sps=%d --env_name=%s' % (
       args.sps, args.env_name)
-  if disable_mahimahi:
+  frames_port, action_port = args.frames_port, args.action_port
+  if args.userspace_link:
+    cmd += ' --server_ip=127.0.0.1'
+    frames_port += LINK_EMULATOR_PORT_OFFSET
+    action_port += LINK_EMULATOR_PORT_OFFSET
+  elif disable_mahimahi:
     cmd += ' --server_ip=127.0.0.1'
   else:
     cmd += " --server_ip=`echo '$MAHIMAHI_BASE'`"
   cmd += ' --frames_port=%d --action_port=%d --results_dir=%s ' % (
-      args.frames_port, args.action_port, dump_dir)
+      frames_port, action_port, dump_dir)
   cmd += ' --time=%d' % args.time
   if args.render:
     cmd += ' --render'
@@ -190,6 +248,12 @@ def plot_mahimahi(args):
 
 
 def main():
+  args = parser.parse_args()
+  if args.reuse_agent and (args.plan_len > 1 or
+                           args.max_frame_age is not None):
+    # they are flags of the agent, which the daemon was started with
+    raise Exception('--plan_len and --max_frame_age do not apply to a '
+                    'reused agent, pass them to `agent_server.py --daemon`')
   if args.disable_mahimahi:
     print('****************')
     print('WARNING: Disabling mahimahi')
@@ -205,17 +269,31 @@ def main():
 
   stub = get_mahimahi_stub(args)
   cli_cmd = get_client_cmd(args, args.disable_mahimahi)
-  if not args.disable_mahimahi:
+  link_process = None
+  if args.userspace_link:
+    link_process = subprocess_cmd(get_link_emulator_cmd(args),
+                                  dry_run=args.dry_run)
+  elif not args.disable_mahimahi:
     cli_cmd = stub.format(cmd=cli_cmd)
   server_cmd = get_server_cmd(args)
-  process = subprocess_cmd(server_cmd, dry_run=args.dry_run)
+  if args.reuse_agent:
+    print('Reusing the agent daemon on ports %d/%d' %
+          (args.frames_port, args.action_port))
+    process = None
+  else:
+    process = subprocess_cmd(server_cmd, dry_run=args.dry_run)
   ret = run_cmd(cli_cmd, blocking=True, dry_run=args.dry_run)
+  if link_process is not None:
+    # the emulator flushes its logs on SIGTERM
+    link_process.terminate()
+    link_process.wait()
   if ret == 0 and not args.dry_run:
     plot_mahimahi(args)
     # plot_qsize(args)
+    plot_results(os.path.join(args.results_dir, args.name, 'game_results'))
 
   ret2 = 0
-  if not args.dry_run:
+  if process is not None:
     ret2 = process.poll()
     if ret2 is None:
       process.kill()
@@ -1,46 +1,33 @@
-import cgi
-import pickle
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from io import BytesIO
+import argparse
+import concurrent.futures
+import hashlib
 import json
 import os
+import pickle
+import sqlite3
 import tarfile
+import threading
 import time
-
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-    def error(self, err):
-        ''' Send the given error message as response'''
-        self.send_response(400)
-        self.end_headers()
-        self.wfile.write(b'Error: ' + err.encode())
-        print(b"Error: %s" % err.encode())
-
-    def do_GET(self):
-        if self.path == '/leaderboard' or self.path == '/':
-            self.leaderboard()
-        else:
-            self.error('Unknown Path')
-
-    def do_POST(self):
-        if self.path == '/upload_file':
-            self.upload_file()
-        elif self.path == '/register_team':
-            self.register_team()
-        else:
-            self.error('Unknown Path')
-
-    def leaderboard(self):
-        # Sort the scores
-        sorted = [(scores[x][0], x) for x in scores]
-        sorted.sort(key=lambda x: x[0])
-
-        # Prepare HTML for the list
-        html_list = ""
-        for id, (avgscore, team) in enumerate(sorted):
-            # Prepare HTML for sublist of scores of individual experiments
-            html_sublist = ""
-            for expt, dat in scores[team][1]:
-                html_sublist += '''
+import urllib.parse
+import uuid
+from email.message import Message
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', default='localhost', type=str)
+parser.add_argument('--port', default=8888, type=int)
+parser.add_argument('--data_dir', default='server_data/', type=str)
+parser.add_argument('--workers', default=4, type=int, help='Number of processes used to read uploaded tarballs')
+parser.add_argument('--max_upload_mb', default=1024, type=int, help='Reject uploads larger than this')
+
+# Uploads are read and written in pieces of this size
+CHUNK_SIZE = 1 << 16
+# Limits for the small parts of an upload
+MAX_FIELD_BYTES = 1 << 12
+MAX_HEADER_BYTES = 1 << 14
+MAX_RESULTS_JSON_BYTES = 1 << 20
+
+EXPT_TEMPLATE = '''
                 <tr>
                     <th scope="row">{expt}</th>
                     <td>{d[score]}</td>
@@ -50,12 +37,9 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
                     <td>{d[n_steps]}</td>
                     <td>{d[total_games]}</td>
                 </tr>
-                '''.format(
-                    expt=expt,
-                    d=dat
-                )
+                '''
 
-            html_list += '''
+TEAM_TEMPLATE = '''
 <li class="list-group-item">
         <div class="row">
             <div class="col-4"><a class="btn btn-link" data-toggle="collapse" href="#coll{id}" role="button" aria-expanded="false" aria-controls="coll{id}">{avgscore}</a></div>
@@ -79,10 +63,9 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         </table>
     </div>
 </li>
-        '''.format(id=id, team=team, avgscore=avgscore, html_sublist=html_sublist)
+        '''
 
-        # Prepare full string
-        html_full = '''
+PAGE_TEMPLATE = '''
 <html>
 <head>
   <title>6.829 Pset2 Leaderboard</title>
@@ -107,81 +90,381 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
   </div>
 </body>
 </html>
-        '''.format(list=html_list)
+        '''
+
+def extract_results(fname):
+    ''' Reads `<dir>/<expt>/game_results/results.json` of every experiment in
+    the tarball `fname`, and the optional `<dir>/manifest.json` written by
+    `eval.py --upload`. Returns a list of (expt_name, result) and the
+    manifest, None if there is none. Runs on the worker pool, so that large
+    uploads do not hold up the request threads.
+
+    The tarball is read in a single streaming pass, so other members (videos,
+    mahimahi logs) are skipped over without being extracted.'''
+    results = []
+    manifest = None
+    with tarfile.open(fname, mode='r|gz') as tar:
+        for member in tar:
+            name = os.path.normpath(member.name).split('/')
+            is_manifest = len(name) == 2 and name[1] == 'manifest.json'
+            is_result = len(name) == 4 and name[2:] == ['game_results', 'results.json']
+            if not (is_manifest or is_result) or not member.isfile():
+                continue
+            if member.size > MAX_RESULTS_JSON_BYTES:
+                raise ValueError('%s is too large' % member.name)
+            data = json.load(tar.extractfile(member))
+            if is_manifest:
+                manifest = data['experiments']
+            else:
+                results.append((name[1], data))
+    return results, manifest
+
+class MultipartPart:
+    ''' One field of a multipart/form-data body. Its data has to be consumed
+    before moving on to the next part '''
+
+    def __init__(self, name, filename, chunks):
+        self.name = name
+        self.filename = filename
+        self.chunks = chunks
+
+    def read(self, max_bytes):
+        ''' Returns the whole field, which must be at most max_bytes long '''
+        data = bytearray()
+        for chunk in self.chunks:
+            data += chunk
+            if len(data) > max_bytes:
+                raise ValueError('Field "%s" is too large' % self.name)
+        return bytes(data)
+
+    def save(self, fname, max_bytes):
+        ''' Writes the field to fname chunk by chunk. Returns its sha256 '''
+        sha = hashlib.sha256()
+        n_bytes = 0
+        with open(fname, 'wb') as f:
+            for chunk in self.chunks:
+                n_bytes += len(chunk)
+                if n_bytes > max_bytes:
+                    raise ValueError('Field "%s" is too large' % self.name)
+                sha.update(chunk)
+                f.write(chunk)
+        return sha.hexdigest()
+
+class MultipartReader:
+    ''' Streaming parser of a multipart/form-data request body. Never holds
+    more than about CHUNK_SIZE bytes of the body in memory '''
+
+    def __init__(self, rfile, headers):
+        msg = Message()
+        msg['content-type'] = headers.get('Content-Type', '')
+        boundary = msg.get_param('boundary')
+        if msg.get_content_type() != 'multipart/form-data' or not boundary:
+            raise ValueError('Expected a multipart/form-data body')
+        self.rfile = rfile
+        self.remaining = int(headers.get('Content-Length', 0))
+        self.delim = b'\r\n--' + boundary.encode()
+        # The body starts with a delimiter without the leading CRLF
+        self.buf = bytearray(b'\r\n')
+
+    def _read_more(self):
+        data = b''
+        if self.remaining > 0:
+            data = self.rfile.read(min(CHUNK_SIZE, self.remaining))
+        if not data:
+            raise ValueError('Multipart body ended unexpectedly')
+        self.remaining -= len(data)
+        self.buf += data
+
+    def _until_delim(self):
+        ''' Yields the body up to the next delimiter, and consumes it '''
+        while True:
+            idx = self.buf.find(self.delim)
+            if idx >= 0:
+                if idx > 0:
+                    yield bytes(self.buf[:idx])
+                del self.buf[:idx + len(self.delim)]
+                return
+            # Keep enough to match a delimiter split across two reads
+            keep = len(self.delim) - 1
+            if len(self.buf) > keep:
+                yield bytes(self.buf[:-keep])
+                del self.buf[:-keep]
+            self._read_more()
+
+    def parts(self):
+        ''' Yields a MultipartPart per field, in the order they were sent '''
+        # Skip the preamble
+        for _ in self._until_delim():
+            pass
+        while True:
+            while len(self.buf) < 2:
+                self._read_more()
+            if self.buf[:2] == b'--':
+                return
+            while self.buf.find(b'\r\n\r\n') < 0:
+                if len(self.buf) > MAX_HEADER_BYTES:
+                    raise ValueError('Multipart headers too large')
+                self._read_more()
+            end = self.buf.find(b'\r\n\r\n')
+            msg = Message()
+            for line in bytes(self.buf[2:end]).decode('utf-8', 'replace').split('\r\n'):
+                key, _, value = line.partition(':')
+                msg[key.strip()] = value.strip()
+            del self.buf[:end + 4]
+
+            chunks = self._until_delim()
+            yield MultipartPart(msg.get_param('name', header='content-disposition'),
+                                msg.get_param('filename', header='content-disposition'),
+                                chunks)
+            # Skip whatever the caller did not consume
+            for _ in chunks:
+                pass
+
+class ScoreStore:
+    ''' SQLite backed store of the registered teams and of the results of
+    their latest upload. Safe to use from several threads. '''
+
+    def __init__(self, db_fname):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_fname, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS teams (team TEXT PRIMARY KEY, members TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (team TEXT, idx INTEGER, expt TEXT, score REAL, result TEXT, PRIMARY KEY (team, idx))')
+            # Databases created before uploads carried a manifest lack the hashes
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(results)')]
+            if 'sha256' not in columns:
+                self.db.execute('ALTER TABLE results ADD COLUMN sha256 TEXT')
+
+    def import_pickles(self, data_dir):
+        ''' One-time import of the `teams` and `scores` pickles written by
+        earlier versions of this server '''
+        with self.lock:
+            if self.db.execute('SELECT COUNT(*) FROM teams').fetchone()[0] > 0:
+                return
+        try:
+            with open(os.path.join(data_dir, 'teams'), 'rb') as f:
+                teams = pickle.load(f)
+        except:
+            return
+        try:
+            with open(os.path.join(data_dir, 'scores'), 'rb') as f:
+                scores = pickle.load(f)
+        except:
+            scores = {}
+        for team, members in teams.items():
+            self.register(team, members)
+        for team, (_, results) in scores.items():
+            self.set_results(team, results)
+        print('Imported %d teams and %d scores from pickles' % (len(teams), len(scores)))
+
+    def members(self, team):
+        ''' Returns the members of the team, None if it is not registered '''
+        with self.lock:
+            row = self.db.execute('SELECT members FROM teams WHERE team = ?', (team,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def register(self, team, members):
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO teams VALUES (?, ?)', (team, json.dumps(members)))
+
+    def set_results(self, team, results, manifest=None):
+        ''' Replaces the results of the team by `results`, a list of
+        (expt_name, result).
+
+        If `manifest` (expt_name -> sha256) is given, the new results are
+        exactly the experiments it lists. Those missing from `results` were
+        left out of the upload because they did not change, and are kept from
+        the previous upload if their hash matches. '''
+        with self.lock, self.db:
+            if manifest is None:
+                rows = [(team, idx, expt, result['score'], json.dumps(result), None)
+                        for idx, (expt, result) in enumerate(results)]
+            else:
+                new = dict(results)
+                old = {expt: (score, result, sha256) for expt, score, result, sha256 in self.db.execute(
+                    'SELECT expt, score, result, sha256 FROM results WHERE team = ?', (team,))}
+                rows = []
+                for idx, expt in enumerate(sorted(manifest)):
+                    if expt in new:
+                        rows.append((team, idx, expt, new[expt]['score'], json.dumps(new[expt]), manifest[expt]))
+                    elif expt in old and old[expt][2] == manifest[expt]:
+                        rows.append((team, idx, expt) + old[expt])
+                    else:
+                        raise ValueError('Experiment "%s" is neither in the upload nor on the server. '
+                                         'Upload again with --force_upload' % expt)
+            self.db.execute('DELETE FROM results WHERE team = ?', (team,))
+            self.db.executemany('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def scores(self):
+        ''' Returns [(avg_score, team, [(expt_name, result)])] sorted by score '''
+        with self.lock:
+            rows = self.db.execute('SELECT team, expt, result FROM results ORDER BY team, idx').fetchall()
+        by_team = {}
+        for team, expt, result in rows:
+            by_team.setdefault(team, []).append((expt, json.loads(result)))
+        ret = []
+        for team, results in by_team.items():
+            avg_score = sum([x[1]['score'] for x in results]) / len(results)
+            ret.append((avg_score, team, results))
+        ret.sort(key=lambda x: x[0])
+        return ret
+
+class Leaderboard:
+    ''' Renders the leaderboard page once and serves it from memory until
+    new results are stored '''
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.page = None
+
+    def invalidate(self):
+        with self.lock:
+            self.page = None
+
+    def get(self):
+        with self.lock:
+            if self.page is None:
+                self.page = self.render().encode()
+            return self.page
+
+    def render(self):
+        html_list = []
+        for id, (avgscore, team, results) in enumerate(self.store.scores()):
+            # Prepare HTML for sublist of scores of individual experiments
+            html_sublist = ''.join([EXPT_TEMPLATE.format(expt=expt, d=dat)
+                                    for expt, dat in results])
+            html_list.append(TEAM_TEMPLATE.format(id=id, team=team, avgscore=avgscore, html_sublist=html_sublist))
+        return PAGE_TEMPLATE.format(list=''.join(html_list))
+
+class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+    def error(self, err):
+        ''' Send the given error message as response'''
+        self.send_response(400)
+        self.end_headers()
+        self.wfile.write(b'Error: ' + err.encode())
+        print(b"Error: %s" % err.encode())
+
+    def do_GET(self):
+        if self.path == '/leaderboard' or self.path == '/':
+            self.leaderboard()
+        else:
+            self.error('Unknown Path')
+
+    def do_POST(self):
+        if self.path == '/upload_file':
+            self.upload_file()
+        elif self.path == '/register_team':
+            self.register_team()
+        else:
+            self.error('Unknown Path')
 
-        # Send the generated page
+    def leaderboard(self):
+        page = leaderboard.get()
         self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(page)))
         self.end_headers()
-        self.wfile.write(html_full.encode())
+        self.wfile.write(page)
 
     def upload_file(self):
-        # Get form data
-        form = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={'REQUEST_METHOD': 'POST'}
-        )
-
-        team = form.getvalue('team')
-        # If team is not registered, send error
-        if team not in teams:
-            self.error('Team "%s" not registered' % team)
+        # Reject uploads that are too large before reading any of it
+        max_bytes = max_upload_mb << 20
+        if int(self.headers.get('Content-Length', 0)) > max_bytes:
+            self.close_connection = True
+            self.error('Upload larger than %d MB' % max_upload_mb)
             return
 
-        # Save the file
-        fname = os.path.join(data_dir, team, str(int(time.time())) + '.tar.gz')
-        with open(fname, 'wb') as f:
-            f.write(form.getvalue('results'))
-
-        tar = tarfile.open(fname, mode='r')
+        # Stream the form data. The tarball goes to disk chunk by chunk, under
+        # a temporary name until we know which team it belongs to
+        team = None
+        digest = None
+        tmp_fname = os.path.join(data_dir, 'incoming', uuid.uuid4().hex)
+        try:
+            for part in MultipartReader(self.rfile, self.headers).parts():
+                if part.name == 'team':
+                    team = part.read(MAX_FIELD_BYTES).decode()
+                    # If team is not registered, send error without reading
+                    # the tarball
+                    if store.members(team) is None:
+                        self.close_connection = True
+                        self.error('Team "%s" not registered' % team)
+                        return
+                elif part.name == 'results':
+                    digest = part.save(tmp_fname, max_bytes)
+        except ValueError as e:
+            self.close_connection = True
+            self.error('Error reading upload: %s' % e)
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            return
 
-        # Determine which experiments are present in this
-        expts = []
-        for member in tar:
-            name = os.path.normpath(member.name)
-            name = name.split('/')
-            if len(name) != 2:
-                continue
-            expts.append(name[0] + '/' + name[1])
+        if team is None or store.members(team) is None or digest is None:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            if digest is None:
+                self.error('No results uploaded')
+            else:
+                self.error('Team "%s" not registered' % team)
+            return
 
-        if len(expts) == 0:
-            if len(name) == 1:
-                self.error('Error reading tarfile. No subdirectories found')
-                return
+        # Save the file. Uploads of a team can run concurrently, so make the
+        # name unique
+        fname = os.path.join(data_dir, team, '%d-%s.tar.gz' % (int(time.time()), digest[:16]))
+        os.replace(tmp_fname, fname)
 
         # Extract results from the experiments
-        results = []
-        for expt in expts:
-            rfname = os.path.join(expt, 'game_results/results.json')
-            rfile = tar.extractfile(rfname)
-            result = json.load(rfile)
-            expt_name = expt.split('/')[1]
-            results.append((expt_name, result))
+        try:
+            results, manifest = pool.submit(extract_results, fname).result()
+        except (tarfile.TarError, EOFError, OSError, ValueError, KeyError) as e:
+            self.error('Error reading tarfile: %s' % e)
+            return
+        if len(results) == 0 and not manifest:
+            self.error('Error reading tarfile. No experiments found')
+            return
         print(json.dumps(results))
 
-        avg_score = sum([x[1]['score'] for x in results]) / len(results)
-
         # Save the results
-        scores[team] = (avg_score, results)
-        with open(os.path.join(data_dir, 'scores'), 'wb') as f:
-            pickle.dump(scores, f)
+        try:
+            store.set_results(team, results, manifest)
+        except KeyError:
+            self.error('results.json is missing the score')
+            return
+        except ValueError as e:
+            self.error(str(e))
+            return
+        leaderboard.invalidate()
 
         self.send_response(200)
         self.end_headers()
 
         self.wfile.write(b'Received results')
 
+    def read_form(self):
+        ''' Reads a small urlencoded or multipart form. Returns a dict from
+        field name to the list of its values '''
+        if self.headers.get_content_type() == 'multipart/form-data':
+            form = {}
+            for part in MultipartReader(self.rfile, self.headers).parts():
+                form.setdefault(part.name, []).append(part.read(MAX_FIELD_BYTES).decode())
+            return form
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_HEADER_BYTES:
+            raise ValueError('Form too large')
+        return urllib.parse.parse_qs(self.rfile.read(length).decode())
+
     def register_team(self):
         # Get form data
-        form = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={'REQUEST_METHOD': 'POST'}
-        )
+        try:
+            form = self.read_form()
+        except ValueError as e:
+            self.close_connection = True
+            self.error('Error reading form: %s' % e)
+            return
 
         # Team name
-        team = form.getvalue('team')
-        members = form.getlist('members')
+        team = form.get('team', [None])[0]
+        members = form.get('members', [])
 
         if team is None:
             self.error('Team name not specified')
@@ -190,36 +473,28 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
             self.error('Team must have at least one member')
             return
 
-        if team in teams:
-            self.error('Team "%s" already registered. Members are %s' % (team, json.dumps(teams[team])))
+        try:
+            store.register(team, members)
+        except sqlite3.IntegrityError:
+            self.error('Team "%s" already registered. Members are %s' % (team, json.dumps(store.members(team))))
             return
-
-        teams[team] = members
-        os.mkdir(os.path.join(data_dir, team))
-
-        with open(os.path.join(data_dir, 'teams'), 'wb') as f:
-            pickle.dump(teams, f)
+        os.makedirs(os.path.join(data_dir, team), exist_ok=True)
 
         self.send_response(200)
         self.end_headers()
         self.wfile.write(('Registered: ' + team + ' ' + json.dumps(members)).encode())
 
-# Load data from files
-data_dir = 'server_data/'
-
-# Dictionary of team names registered. Contains list of team members
-try:
-    with open(os.path.join(data_dir, 'teams'), 'rb') as f:
-        teams = pickle.load(f)
-except:
-    teams = {}
-
-# Dictionary of scores indexed by team
-try:
-    with open(os.path.join(data_dir, 'scores'), 'rb') as f:
-        scores = pickle.load(f)
-except:
-    scores = {}
-
-httpd = HTTPServer(('localhost', 8888), SimpleHTTPRequestHandler)
-httpd.serve_forever()
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    # Load data from files
+    data_dir = args.data_dir
+    max_upload_mb = args.max_upload_mb
+    os.makedirs(os.path.join(data_dir, 'incoming'), exist_ok=True)
+    store = ScoreStore(os.path.join(data_dir, 'scores.db'))
+    store.import_pickles(data_dir)
+    leaderboard = Leaderboard(store)
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+
+    httpd = ThreadingHTTPServer((args.host, args.port), SimpleHTTPRequestHandler)
+    httpd.serve_forever()
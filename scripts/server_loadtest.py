@@ -0,0 +1,106 @@
+''' Load test for scripts/server.py. Registers a few teams on a local
+instance and then fires concurrent uploads and leaderboard requests at it,
+like a deadline-night burst.
+
+Example:
+python3 scripts/server.py --data_dir=/tmp/server_data &
+python3 scripts/server_loadtest.py --url=http://localhost:8888 --uploads=50 --gets=500 --concurrency=16 --padding_mb=5
+'''
+import argparse
+import concurrent.futures
+import io
+import json
+import os
+import random
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+import requests
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--url', default='http://localhost:8888', type=str)
+parser.add_argument('--teams', default=10, type=int)
+parser.add_argument('--uploads', default=50, type=int, help='Total number of uploads')
+parser.add_argument('--gets', default=500, type=int, help='Total number of leaderboard requests')
+parser.add_argument('--concurrency', default=16, type=int)
+parser.add_argument('--expts', default=5, type=int, help='Experiments per uploaded tarball')
+parser.add_argument('--padding_mb', default=0., type=float, help='Incompressible bytes added to every experiment, standing in for videos and mahimahi logs')
+args = parser.parse_args()
+
+def make_tarball(fname, n_expts, padding_bytes):
+    ''' Writes a tarball laid out like the one produced by eval.py --upload '''
+    with tarfile.open(fname, 'w:gz') as tar:
+        for i in range(n_expts):
+            expt = 'eval_results/expt-%d' % i
+            result = dict(score=random.uniform(0, 100), sum_reward=0, lives_remaining=0, n_skipped_actions=0, n_steps=0, total_games=1)
+            members = [('results.json', json.dumps(result).encode())]
+            if padding_bytes:
+                members.append(('video.mp4', os.urandom(padding_bytes)))
+            for name, data in members:
+                info = tarfile.TarInfo('%s/game_results/%s' % (expt, name))
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+def register(team):
+    data = {'team': team, 'members': ['load test']}
+    requests.post(args.url + '/register_team', data=data)
+
+def upload(team, fname):
+    with open(fname, 'rb') as f:
+        r = requests.post(args.url + '/upload_file', data={'team': team}, files={'results': f})
+    if r.status_code != 200:
+        raise Exception(r.content.decode())
+
+def get_leaderboard():
+    r = requests.get(args.url + '/leaderboard')
+    if r.status_code != 200:
+        raise Exception(r.content.decode())
+
+def timed(f, *fargs):
+    start = time.time()
+    f(*fargs)
+    return time.time() - start
+
+def report(kind, latencies, elapsed):
+    latencies = np.array(latencies) * 1e3
+    print('%-12s n=%-5d %7.1f req/s  p50=%7.1fms  p95=%7.1fms  p99=%7.1fms  max=%7.1fms' % (
+        kind, len(latencies), len(latencies) / elapsed,
+        np.percentile(latencies, 50), np.percentile(latencies, 95),
+        np.percentile(latencies, 99), latencies.max()))
+
+def main():
+    teams = ['loadtest-%d' % i for i in range(args.teams)]
+    for team in teams:
+        register(team)
+
+    tmp_dir = tempfile.mkdtemp()
+    tfname = os.path.join(tmp_dir, 'results.tar.gz')
+    make_tarball(tfname, args.expts, int(args.padding_mb * 1e6))
+    print('Tarball size: %.2f MB' % (os.path.getsize(tfname) / 1e6))
+
+    jobs = [('upload', upload, (random.choice(teams), tfname)) for _ in range(args.uploads)]
+    jobs += [('leaderboard', get_leaderboard, ()) for _ in range(args.gets)]
+    random.shuffle(jobs)
+
+    latencies = {'upload': [], 'leaderboard': []}
+    n_errors = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(timed, f, *fargs): kind for kind, f, fargs in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                latencies[futures[future]].append(future.result())
+            except Exception as e:
+                n_errors += 1
+                print('Error: %s' % e)
+    elapsed = time.time() - start
+
+    for kind in sorted(latencies):
+        if latencies[kind]:
+            report(kind, latencies[kind], elapsed)
+    print('%d requests in %.2f s, %d errors' % (len(jobs), elapsed, n_errors))
+
+if __name__ == '__main__':
+    main()
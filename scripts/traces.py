@@ -0,0 +1,60 @@
+"""
+  The cellular mahimahi traces the evaluation draws from, and their
+  renormalization to a given average throughput. Shared by scripts/eval.py
+  and scripts/cc_sweep.py, so that the simulated sweep covers the same links
+  as the evaluation.
+"""
+import os
+
+import numpy as np
+
+TRACE_DIR = '/usr/share/mahimahi/traces'
+# List of all the trace files (without the .up)
+TRACEFILES = [
+    'ATT-LTE-driving-2016', 'ATT-LTE-driving', 'TMobile-LTE-driving',
+    'TMobile-LTE-short', 'TMobile-UMTS-driving', 'Verizon-EVDO-driving',
+    'Verizon-LTE-driving', 'Verizon-LTE-short'
+]
+# Gaps between packets longer than this (in ms) are cut short
+GAP_THRESH_MS = 2000
+
+
+def trace_path(name):
+  return os.path.join(TRACE_DIR, name)
+
+
+def renormalize_trace(trace, tpt):
+  """Delivery opportunities (in ms) of `trace` scaled to an average of `tpt`
+  Mbit/s, with gaps longer than GAP_THRESH_MS cut short."""
+  trace = np.asarray(trace, dtype=np.float64)
+
+  # Average throughput of the input trace (in bits/s)
+  in_tpt = 1500 * 8 * len(trace) / (1e-3 * trace[-1])
+
+  # Renormalize
+  trace *= in_tpt / (tpt * 1e6)
+
+  # Remove any gaps greater than the threshold. Previous timestamp, and how
+  # much is subtracted off the following samples to remove the gaps
+  prev = 0
+  cur_offset = 0
+  ret = []
+  for t in trace:
+    t -= cur_offset
+    diff = t - prev
+    if diff > GAP_THRESH_MS:
+      cur_offset += diff - GAP_THRESH_MS
+      t -= diff - GAP_THRESH_MS
+    prev = t
+    ret.append(int(t))
+  return ret
+
+
+def renormalize_trace_file(ifname, ofname, tpt):
+  """Read trace file `ifname` and output to `ofname` a trace file with an
+  average of `tpt` Mbit/s."""
+  with open(ifname, 'r') as f:
+    trace = [int(line) for line in f if line.strip()]
+  with open(ofname, 'w') as f:
+    for t in renormalize_trace(trace, tpt):
+      f.write(str(t) + '\n')
@@ -1,23 +1,189 @@
+import argparse
+import collections
+import os
+import socket
+import struct
 import sys
+import threading
+import time
 import portus
 
+# Datapath programs: "half_rtt" reports every half base RTT, "on_change"
+# reports once per RTT, or sooner when the rtt moved by more than 1/8
+# (but not more often than every min_report_interval_us), or on loss
+PROGRAMS = ["half_rtt", "on_change"]
+DEFAULT_MIN_REPORT_INTERVAL_US = 1000
+
+# Telemetry ring file, see rl_app/cc_telemetry.py for the format and a loader
+TELEMETRY_MAGIC = b"CCTL"
+TELEMETRY_HEADER = struct.Struct("<4sIIIQ")
+TELEMETRY_RECORD = struct.Struct("<dQ8I")
+TELEMETRY_CAPACITY = 1 << 20
+U32_MAX = (1 << 32) - 1
+
+# Signals of the game, see rl_app/app_signal.py for the format and a publisher
+APP_SIGNAL_MAGIC = b"APPS"
+APP_SIGNAL_MESSAGE = struct.Struct("<4sIdIfffff")
+APP_SIGNAL_STALE_S = 1.
+# cwnd is capped to what the game sends when it is app limited this often
+APP_LIMITED_THRESHOLD = .5
+# with --pacing, pace this much faster than the max delivery rate over the
+# last BW_WINDOW_US
+PACING_GAIN = 1.25
+BW_WINDOW_US = 200000
+
+
+class TelemetryLog():
+  """Logs one record per report into a ring file. Records are packed on the
+  report path and written by a background thread every `flush_interval`
+  seconds."""
+
+  def __init__(self, fname, capacity=TELEMETRY_CAPACITY, flush_interval=.1):
+    self.capacity = capacity
+    self.flush_interval = flush_interval
+    self.n_written = 0
+    self._pending = collections.deque()
+    self._stop = threading.Event()
+    self._f = open(fname, "w+b")
+    self._f.truncate(TELEMETRY_HEADER.size +
+                     capacity * TELEMETRY_RECORD.size)
+    self._write_header()
+    self._thread = threading.Thread(target=self._loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def log(self, sock_id, r, cwnd, rate):
+    self._pending.append(
+        TELEMETRY_RECORD.pack(time.time(), r.now, sock_id,
+                              min(int(cwnd), U32_MAX), min(int(rate), U32_MAX),
+                              min(r.rtt, U32_MAX), min(r.minrtt, U32_MAX),
+                              min(r.acked, U32_MAX), r.loss, r.inflight))
+
+  def close(self):
+    self._stop.set()
+    self._thread.join()
+    self._f.close()
+
+  def _write_header(self):
+    self._f.seek(0)
+    self._f.write(
+        TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, 1, TELEMETRY_RECORD.size,
+                              self.capacity, self.n_written))
+
+  def _loop(self):
+    while not self._stop.wait(self.flush_interval):
+      self._flush()
+    self._flush()
+
+  def _flush(self):
+    records = []
+    while self._pending:
+      records.append(self._pending.popleft())
+    # at most two contiguous writes, before and after wrapping around
+    while records:
+      slot = self.n_written % self.capacity
+      chunk = records[:self.capacity - slot]
+      records = records[len(chunk):]
+      self._f.seek(TELEMETRY_HEADER.size + slot * TELEMETRY_RECORD.size)
+      self._f.write(b"".join(chunk))
+      self.n_written += len(chunk)
+    self._write_header()
+    self._f.flush()
+
+
+class AppSignalReader():
+  """Latest (t, sps, frame_bytes, lag_ms, app_limited, demand) of every game,
+  by the local port of its frames socket."""
+
+  def __init__(self, path):
+    self.path = path
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      pass
+    self._sock.bind(path)
+    self._sock.setblocking(False)
+    self._latest = {}
+
+  def get(self, port):
+    while True:
+      try:
+        msg = self._sock.recv(APP_SIGNAL_MESSAGE.size)
+      except BlockingIOError:
+        break
+      if len(msg) != APP_SIGNAL_MESSAGE.size:
+        continue
+      magic, version, t, src_port, *fields = APP_SIGNAL_MESSAGE.unpack(msg)
+      if magic == APP_SIGNAL_MAGIC and version == 1:
+        self._latest[src_port] = (t, *fields)
+    # the datapath may give the port in network byte order
+    signal = self._latest.get(port) or self._latest.get(
+        struct.unpack("<H", struct.pack(">H", port & 0xffff))[0])
+    if signal is None or time.time() - signal[0] > APP_SIGNAL_STALE_S:
+      return None
+    return signal
+
+  def close(self):
+    self._sock.close()
+    os.unlink(self.path)
+
+
+class WindowedMax():
+  """Max of the samples of the last `window` (in the unit of the sample
+  times). Only keeps the samples that can still become the max."""
+
+  def __init__(self, window):
+    self.window = window
+    self._samples = collections.deque()  # (time, value), values decreasing
+
+  def update(self, t, value):
+    while self._samples and self._samples[-1][1] <= value:
+      self._samples.pop()
+    self._samples.append((t, value))
+    while self._samples[0][0] + self.window < t:
+      self._samples.popleft()
+
+  def get(self):
+    """0 before the first sample."""
+    return self._samples[0][1] if self._samples else 0
+
+
 class NewCCFlow():
 
-  def __init__(self, datapath, datapath_info):
-    sys.stdout.write("new flow\n")
+  def __init__(self,
+               datapath,
+               datapath_info,
+               program="half_rtt",
+               telemetry=None,
+               app_signal=None,
+               pacing=False):
+    if telemetry is None:
+      sys.stdout.write("new flow\n")
     self.datapath = datapath
     self.datapath_info = datapath_info
+    self.telemetry = telemetry
+    self.app_signal = app_signal
+    self.pacing = pacing
     self.cwnd = 1200
     self.rate = 0
+    # latest rtt sample, reports of a loss may have none
+    self.rtt = 0
+    # delivery rate in bytes/s, measured over the bytes acked since the last
+    # report without loss
+    self.max_bw = WindowedMax(BW_WINDOW_US)
+    self._last_report_us = 0
+    self._acked = 0
 
     l = [("Cwnd", int(self.cwnd)), ("Rate", int(self.rate))]
-    self.datapath.set_program("default", l)
+    self.datapath.set_program(program, l)
 
   def on_report(self, r):
-    sys.stdout.write(
-        "[report] cwnd={:02d}p rtt={:03d}ms acked={:03d}p loss={:02d}p\n".
-        format(int(self.cwnd / self.datapath_info.mss), int(r.rtt / 1000.0),
-               int(r.acked / self.datapath_info.mss), r.loss))
+    if self.telemetry is None:
+      sys.stdout.write(
+          "[report] cwnd={:02d}p rtt={:03d}ms acked={:03d}p loss={:02d}p\n".
+          format(int(self.cwnd / self.datapath_info.mss), int(r.rtt / 1000.0),
+                 int(r.acked / self.datapath_info.mss), r.loss))
 
     # TODO: Implement your congestion control algorithm here. As an example, we
     # have implemented AIMD
@@ -26,18 +192,72 @@ class NewCCFlow():
     else:
       self.cwnd += 1448 * r.acked / self.cwnd
     self.cwnd = max(self.cwnd, 3000)
+    if r.rtt > 0:
+      self.rtt = r.rtt
+    self._update_max_bw(r)
+    if self.pacing and self.max_bw.get() > 0:
+      # spread the window over the rtt instead of sending frames in one
+      # burst. The windowed max outlasts loss reports, which carry no rate
+      self.rate = PACING_GAIN * self.max_bw.get()
+
+    if self.app_signal is not None and self.rtt > 0:
+      signal = self.app_signal.get(self.datapath_info.src_port)
+      if signal is not None:
+        _, _, frame_bytes, _, app_limited, demand = signal
+        if app_limited >= APP_LIMITED_THRESHOLD:
+          # the game will not use more than its demand, do not grow a
+          # window it cannot fill and then dump it into the queue
+          cap = max(2 * frame_bytes, 2 * demand * self.rtt / 1e6, 3000)
+          self.cwnd = min(self.cwnd, cap)
+          if self.rate > 0:
+            self.rate = min(self.rate, max(4 * demand, 30000))
+
+    self.datapath.update_fields([("Cwnd", int(self.cwnd)),
+                                 ("Rate", int(self.rate))])
+    if self.telemetry is not None:
+      self.telemetry.log(self.datapath_info.sock_id, r, self.cwnd, self.rate)
 
-    self.datapath.update_field("Cwnd", int(self.cwnd))
+  def _update_max_bw(self, r):
+    """Adds the delivery rate since the last report, or the one the
+    "on_change" program measured, like newcc/src/agg_measurement.rs."""
+    self._acked += r.acked
+    if r.loss > 0 or r.timeout:
+      return
+    rate = getattr(r, "rin", 0)
+    if not rate and self._last_report_us and r.now > self._last_report_us:
+      rate = self._acked * 1e6 / (r.now - self._last_report_us)
+    self._last_report_us = r.now
+    self._acked = 0
+    if rate:
+      self.max_bw.update(r.now, rate)
 
 
 class NewCC(portus.AlgBase):
 
+  def __init__(self,
+               program="half_rtt",
+               min_report_interval_us=DEFAULT_MIN_REPORT_INTERVAL_US,
+               telemetry=None,
+               app_signal=None,
+               pacing=False):
+    """With `telemetry`, reports are logged to this ring file instead of
+    being printed. With `app_signal`, cwnd follows the demand the game
+    publishes on this unix socket. With `pacing`, packets are paced at a bit
+    more than the max delivery rate."""
+    if program not in PROGRAMS:
+      raise Exception("Unknown datapath program %s" % program)
+    self.program = program
+    self.min_report_interval_us = min_report_interval_us
+    self.telemetry = TelemetryLog(telemetry) if telemetry else None
+    self.app_signal = AppSignalReader(app_signal) if app_signal else None
+    self.pacing = pacing
+
   def datapath_programs(self):
     # This 'datapath program' instructs CCP on what variables to return to the
     # userspace program, and at what intervals. See CCP documentation for
     # details.
     return {
-        "default":
+        "half_rtt":
         """\
             (def
                 (Report
@@ -73,16 +293,93 @@ class NewCC(portus.AlgBase):
                 (:= Micros 0)
                 (report)
             )
-            """
+            """,
+        # Same fields, plus the ack rate computed by the datapath (rin) and
+        # the send rate (rout), in bytes/s
+        "on_change":
+        """\
+            (def
+                (Report
+                    (volatile acked 0)
+                    (volatile sacked 0)
+                    (volatile loss 0)
+                    (volatile inflight 0)
+                    (volatile timeout 0)
+                    (volatile rtt 0)
+                    (volatile minrtt +infinity)
+                    (volatile numpkts 0)
+                    (volatile now 0)
+                    (volatile rin 0)
+                    (volatile rout 0)
+               )
+                (basertt +infinity)
+                (lastrtt 0)
+            )
+            (when true
+                (:= Report.acked (+ Report.acked Ack.bytes_acked))
+                (:= Report.inflight Flow.packets_in_flight)
+                (:= Report.rtt Flow.rtt_sample_us)
+                (:= Report.minrtt (min Report.minrtt Flow.rtt_sample_us))
+                (:= basertt (min basertt Flow.rtt_sample_us))
+                (:= Report.sacked (+ Report.sacked Ack.packets_misordered))
+                (:= Report.loss Ack.lost_pkts_sample)
+                (:= Report.timeout Flow.was_timeout)
+                (:= Report.now Ack.now)
+                (:= Report.rin Flow.rate_incoming)
+                (:= Report.rout Flow.rate_outgoing)
+                (fallthrough)
+            )
+            (when (|| Flow.was_timeout (> Report.loss 0))
+                (:= Micros 0)
+                (report)
+            )
+            (when (&& (> Micros %d)
+                      (|| (> Report.rtt (+ lastrtt (/ lastrtt 8)))
+                          (< Report.rtt (- lastrtt (/ lastrtt 8)))))
+                (:= lastrtt Report.rtt)
+                (:= Micros 0)
+                (report)
+            )
+            (when (> Micros basertt)
+                (:= lastrtt Report.rtt)
+                (:= Micros 0)
+                (report)
+            )
+            """ % self.min_report_interval_us
     }
 
   def new_flow(self, datapath, datapath_info):
-    return NewCCFlow(datapath, datapath_info)
+    return NewCCFlow(datapath, datapath_info, self.program, self.telemetry,
+                     self.app_signal, self.pacing)
 
 
 def main():
-  alg = NewCC()
-  portus.start("netlink", alg, debug=True)
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--program", choices=PROGRAMS, default="half_rtt")
+  parser.add_argument("--min_report_interval_us",
+                      type=int,
+                      default=DEFAULT_MIN_REPORT_INTERVAL_US)
+  parser.add_argument("--telemetry",
+                      type=str,
+                      default=None,
+                      help="Log every report to this ring file instead of "
+                      "printing it, see rl_app/cc_telemetry.py")
+  parser.add_argument("--app_signal",
+                      type=str,
+                      default=None,
+                      help="Read the signals of the game on this unix socket, "
+                      "see rl_app/app_signal.py")
+  parser.add_argument("--pacing", action="store_true")
+  args = parser.parse_args()
+  alg = NewCC(args.program, args.min_report_interval_us, args.telemetry,
+              args.app_signal, args.pacing)
+  try:
+    portus.start("netlink", alg, debug=True)
+  finally:
+    if alg.telemetry is not None:
+      alg.telemetry.close()
+    if alg.app_signal is not None:
+      alg.app_signal.close()
 
 
 if __name__ == '__main__':
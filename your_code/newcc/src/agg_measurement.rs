@@ -1,4 +1,5 @@
 use std;
+use std::collections::VecDeque;
 
 use portus::lang::Scope;
 use portus::Report;
@@ -10,44 +11,75 @@ pub enum ReportStatus {
     UrgentReport,
 }
 
-// CCP may return before the specified time. This struct will aggregate relevant
-// values till the time is right
-pub struct AggMeasurement {
-    // In fraction of a (smoothed) RTT
-    reporting_interval: f32,
-    // For determining when to report
-    srtt: f32,
-    // EWMA variable
-    srtt_alpha: f32,
-    // Last time we reported
-    last_report_time: u64,
-    // Aggregate variables that are reset every measurement interval
-    acked: u32,
-    sacked: u32,
-    rtt: u32,
-    min_rtt: u32,
+/// Max (or min) of the samples taken in the last `window` microseconds. The deque only keeps the
+/// samples that can still become the max, i.e. those larger than every later sample, so an update
+/// is O(1) amortized.
+pub struct WindowedFilter {
+    window: u64,
+    is_max: bool,
+    // (time, value), values decreasing (increasing for a min filter) from front to back
+    samples: VecDeque<(u64, f64)>,
 }
 
-impl AggMeasurement {
-    /// Will report a measurement at-most once per (reporting_interval * rtt) seconds
-    pub fn new(reporting_interval: f32) -> Self {
+impl WindowedFilter {
+    pub fn new_max(window: u64) -> Self {
         Self {
-            reporting_interval: reporting_interval,
-            srtt: 0.,
-            srtt_alpha: 1. / 16.,
-            last_report_time: 0,
-            acked: 0,
-            sacked: 0,
-            rtt: 0,
-            min_rtt: std::u32::MAX,
+            window: window,
+            is_max: true,
+            samples: VecDeque::new(),
         }
     }
 
-    pub fn report(
-        &mut self,
-        m: Report,
-        sc: &Scope,
-    ) -> (ReportStatus, bool, u32, u32, u32, u32, u32, u32, u64) {
+    pub fn new_min(window: u64) -> Self {
+        Self {
+            window: window,
+            is_max: false,
+            samples: VecDeque::new(),
+        }
+    }
+
+    pub fn update(&mut self, now: u64, value: f64) {
+        while let Some(&(_, v)) = self.samples.back() {
+            if (self.is_max && v <= value) || (!self.is_max && v >= value) {
+                self.samples.pop_back();
+            } else {
+                break;
+            }
+        }
+        self.samples.push_back((now, value));
+        while let Some(&(t, _)) = self.samples.front() {
+            if t + self.window < now {
+                self.samples.pop_front();
+            } else {
+                break;
+            }
+        }
+    }
+
+    /// The max (or min) over the window ending at the last update. None before the first sample
+    pub fn get(&self) -> Option<f64> {
+        self.samples.front().map(|&(_, v)| v)
+    }
+}
+
+/// The fields of a report sent by the datapath program
+#[derive(Clone, Copy, Debug, Default)]
+pub struct Measurement {
+    pub acked: u32,
+    pub sacked: u32,
+    pub was_timeout: bool,
+    pub inflight: u32,
+    pub loss: u32,
+    pub rtt: u32,
+    pub min_rtt: u32,
+    pub now: u64,
+    /// Ack rate measured by the datapath, in bytes/sec. 0 if the program does not report it
+    pub rate_incoming: u64,
+}
+
+impl Measurement {
+    /// Reads the fields of a report of the datapath programs of `NewCCConfig`
+    pub fn from_report(m: &Report, sc: &Scope) -> Self {
         let acked = m
             .get_field("Report.acked", sc)
             .expect("expected acked field in returned measurement") as u32;
@@ -80,14 +112,113 @@ impl AggMeasurement {
             .get_field("Report.minrtt", sc)
             .expect("expected minrtt field in returned measurement") as u32;
 
+        // only in the on_change program
+        let rate_incoming = m.get_field("Report.rin", sc).unwrap_or(0);
+
+        Measurement {
+            acked,
+            sacked,
+            was_timeout: was_timeout == 1,
+            inflight,
+            loss,
+            rtt,
+            min_rtt,
+            now,
+            rate_incoming,
+        }
+    }
+}
+
+/// Path estimates kept by `AggMeasurement` across reports
+#[derive(Clone, Copy, Debug, Default, PartialEq)]
+pub struct Estimates {
+    /// Bytes acked per second over the last reporting interval
+    pub delivery_rate: f64,
+    /// Max of delivery_rate over the bandwidth window, in bytes per second
+    pub max_bw: f64,
+    /// Min rtt over the min rtt window, in microseconds. 0 before the first rtt sample
+    pub min_rtt: u32,
+}
+
+// CCP may return before the specified time. This struct will aggregate relevant
+// values till the time is right
+pub struct AggMeasurement {
+    // In fraction of a (smoothed) RTT
+    reporting_interval: f32,
+    // For determining when to report
+    srtt: f32,
+    // EWMA variable
+    srtt_alpha: f32,
+    // Last time we reported
+    last_report_time: u64,
+    // Aggregate variables that are reset every measurement interval
+    acked: u32,
+    sacked: u32,
+    rtt: u32,
+    min_rtt: u32,
+    // Estimates that outlive a measurement interval
+    delivery_rate: f64,
+    max_bw: WindowedFilter,
+    windowed_min_rtt: WindowedFilter,
+}
+
+impl AggMeasurement {
+    /// Will report a measurement at-most once per (reporting_interval * rtt) seconds. The max
+    /// bandwidth and the min rtt are taken over the last `bw_window` and `min_rtt_window`
+    /// microseconds
+    pub fn new(reporting_interval: f32, bw_window: u64, min_rtt_window: u64) -> Self {
+        Self {
+            reporting_interval: reporting_interval,
+            srtt: 0.,
+            srtt_alpha: 1. / 16.,
+            last_report_time: 0,
+            acked: 0,
+            sacked: 0,
+            rtt: 0,
+            min_rtt: std::u32::MAX,
+            delivery_rate: 0.,
+            max_bw: WindowedFilter::new_max(bw_window),
+            windowed_min_rtt: WindowedFilter::new_min(min_rtt_window),
+        }
+    }
+
+    pub fn estimates(&self) -> Estimates {
+        Estimates {
+            delivery_rate: self.delivery_rate,
+            max_bw: self.max_bw.get().unwrap_or(0.),
+            min_rtt: self.windowed_min_rtt.get().map_or(0, |v| v as u32),
+        }
+    }
+
+    /// Adds a report to the aggregate, and returns the aggregate when it is time to report it
+    pub fn aggregate(
+        &mut self,
+        m: Measurement,
+    ) -> (ReportStatus, bool, u32, u32, u32, u32, u32, u32, u64) {
+        let Measurement {
+            acked,
+            sacked,
+            was_timeout,
+            inflight,
+            loss,
+            rtt,
+            min_rtt,
+            now,
+            rate_incoming,
+        } = m;
+
         self.acked += acked;
         self.sacked = sacked;
         self.min_rtt = std::cmp::min(self.min_rtt, min_rtt);
+        // minrtt is +infinity (truncated) when nothing was acked with an rtt sample
+        if min_rtt != 0 && min_rtt != std::u32::MAX {
+            self.windowed_min_rtt.update(now, min_rtt as f64);
+        }
 
-        if was_timeout == 1 || loss > 0 {
+        if was_timeout || loss > 0 {
             return (
                 ReportStatus::UrgentReport,
-                (was_timeout == 1),
+                was_timeout,
                 0,
                 0,
                 loss,
@@ -104,6 +235,13 @@ impl AggMeasurement {
         }
 
         if now > 0 && self.last_report_time < now - (self.srtt * self.reporting_interval) as u64 {
+            if rate_incoming != 0 {
+                self.delivery_rate = rate_incoming as f64;
+                self.max_bw.update(now, self.delivery_rate);
+            } else if self.last_report_time != 0 {
+                self.delivery_rate = self.acked as f64 * 1e6 / (now - self.last_report_time) as f64;
+                self.max_bw.update(now, self.delivery_rate);
+            }
             let res = (
                 ReportStatus::Report,
                 false,
@@ -126,3 +264,130 @@ impl AggMeasurement {
         }
     }
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// An ack of `acked` bytes every `gap` us with the given rtt
+    fn acks(start: u64, n: u64, gap: u64, acked: u32, rtt: u32) -> Vec<Measurement> {
+        (1..=n)
+            .map(|i| Measurement {
+                acked,
+                rtt,
+                min_rtt: rtt,
+                now: start + i * gap,
+                ..Default::default()
+            })
+            .collect()
+    }
+
+    #[test]
+    fn windowed_max() {
+        let mut f = WindowedFilter::new_max(100);
+        assert_eq!(f.get(), None);
+        f.update(0, 5.);
+        f.update(10, 3.);
+        f.update(20, 4.);
+        assert_eq!(f.get(), Some(5.));
+        // 5 and then 3 expire, 4 is still the max
+        f.update(105, 1.);
+        assert_eq!(f.get(), Some(4.));
+        f.update(121, 2.);
+        assert_eq!(f.get(), Some(2.));
+        // only the samples that can still become the max are kept
+        assert_eq!(f.samples.len(), 1);
+    }
+
+    #[test]
+    fn windowed_min() {
+        let mut f = WindowedFilter::new_min(100);
+        f.update(0, 10.);
+        f.update(50, 20.);
+        assert_eq!(f.get(), Some(10.));
+        f.update(101, 30.);
+        assert_eq!(f.get(), Some(20.));
+        f.update(90 + 101, 5.);
+        assert_eq!(f.get(), Some(5.));
+    }
+
+    #[test]
+    fn windowed_filter_is_linear() {
+        let mut f = WindowedFilter::new_max(1000);
+        // decreasing samples are all kept, but each is popped at most once
+        for i in 0..100000u64 {
+            f.update(i, (100000 - i) as f64);
+            assert!(f.samples.len() <= 1001);
+        }
+        assert_eq!(f.get(), Some((100000 - 98999) as f64));
+    }
+
+    #[test]
+    fn delivery_rate_and_max_bw() {
+        let mut agg = AggMeasurement::new(0.5, 1_000_000, 10_000_000);
+        // 1448 bytes every 1 ms for a second, then every 2 ms
+        for m in acks(0, 1000, 1000, 1448, 20_000) {
+            agg.aggregate(m);
+        }
+        let est = agg.estimates();
+        assert!((est.delivery_rate - 1.448e6).abs() < 1e3, "{:?}", est);
+        assert!((est.max_bw - 1.448e6).abs() < 1e3, "{:?}", est);
+        assert_eq!(est.min_rtt, 20_000);
+
+        for m in acks(1_000_000, 1000, 2000, 1448, 20_000) {
+            agg.aggregate(m);
+        }
+        let est = agg.estimates();
+        assert!((est.delivery_rate - 0.724e6).abs() < 1e3, "{:?}", est);
+        // the faster second has left the window
+        assert!((est.max_bw - 0.724e6).abs() < 1e3, "{:?}", est);
+    }
+
+    #[test]
+    fn min_rtt_window() {
+        let mut agg = AggMeasurement::new(0.5, 1_000_000, 2_000_000);
+        for m in acks(0, 100, 10_000, 1448, 10_000) {
+            agg.aggregate(m);
+        }
+        assert_eq!(agg.estimates().min_rtt, 10_000);
+        // the path got longer, the old min rtt is forgotten after the window
+        for m in acks(1_000_000, 300, 10_000, 1448, 30_000) {
+            agg.aggregate(m);
+        }
+        assert_eq!(agg.estimates().min_rtt, 30_000);
+    }
+
+    #[test]
+    fn datapath_rate_is_used() {
+        // every report is passed on, as with the on_change program
+        let mut agg = AggMeasurement::new(0., 1_000_000, 10_000_000);
+        for m in acks(0, 10, 20_000, 14480, 20_000) {
+            let res = agg.aggregate(Measurement {
+                rate_incoming: 500_000,
+                ..m
+            });
+            assert_eq!(res.0, ReportStatus::Report);
+        }
+        assert_eq!(agg.estimates().delivery_rate, 500_000.);
+        assert_eq!(agg.estimates().max_bw, 500_000.);
+    }
+
+    #[test]
+    fn loss_is_urgent_and_keeps_acked() {
+        let mut agg = AggMeasurement::new(0.5, 1_000_000, 10_000_000);
+        let ms = acks(0, 10, 1000, 1448, 20_000);
+        for m in &ms {
+            agg.aggregate(*m);
+        }
+        let res = agg.aggregate(Measurement {
+            loss: 2,
+            now: 11_000,
+            min_rtt: std::u32::MAX,
+            ..Default::default()
+        });
+        assert_eq!(res.0, ReportStatus::UrgentReport);
+        assert_eq!(res.4, 2);
+        // no rtt sample, the min rtt is unchanged
+        assert_eq!(agg.estimates().min_rtt, 20_000);
+    }
+}
@@ -0,0 +1,173 @@
+use std::collections::HashMap;
+use std::convert::TryInto;
+use std::io;
+use std::os::unix::net::UnixDatagram;
+use std::sync::{Arc, Mutex};
+
+// Datagrams the game publishes, see rl_app/app_signal.py for the format and a publisher
+const MAGIC: &[u8; 4] = b"APPS";
+const VERSION: u32 = 1;
+const MESSAGE_SIZE: usize = 40;
+/// Signals older than this are ignored, in seconds
+const STALE_S: f64 = 1.;
+
+/// What the game sent over the last publishing interval
+#[derive(Clone, Copy, Debug, Default, PartialEq)]
+pub struct AppSignal {
+    /// Unix time in seconds
+    pub t: f64,
+    /// Local port of the frames socket of the game
+    pub src_port: u32,
+    /// Frames sent per second
+    pub sps: f32,
+    /// Mean frame size in bytes
+    pub frame_bytes: f32,
+    /// Mean action lag in milliseconds
+    pub lag_ms: f32,
+    /// Fraction of the times the socket could take more data but no frame was ready
+    pub app_limited: f32,
+    /// Bytes/sec the game sends
+    pub demand: f32,
+}
+
+impl AppSignal {
+    fn decode(msg: &[u8]) -> Option<Self> {
+        if msg.len() != MESSAGE_SIZE || &msg[..4] != MAGIC {
+            return None;
+        }
+        let u32_at = |i: usize| u32::from_le_bytes(msg[i..i + 4].try_into().unwrap());
+        let f32_at = |i: usize| f32::from_le_bytes(msg[i..i + 4].try_into().unwrap());
+        if u32_at(4) != VERSION {
+            return None;
+        }
+        Some(AppSignal {
+            t: f64::from_le_bytes(msg[8..16].try_into().unwrap()),
+            src_port: u32_at(16),
+            sps: f32_at(20),
+            frame_bytes: f32_at(24),
+            lag_ms: f32_at(28),
+            app_limited: f32_at(32),
+            demand: f32_at(36),
+        })
+    }
+
+    /// The datagram of this signal, as rl_app/app_signal.py sends it
+    #[cfg(test)]
+    pub fn encode(&self) -> Vec<u8> {
+        let mut buf = vec![];
+        buf.extend_from_slice(MAGIC);
+        buf.extend_from_slice(&VERSION.to_le_bytes());
+        buf.extend_from_slice(&self.t.to_le_bytes());
+        buf.extend_from_slice(&self.src_port.to_le_bytes());
+        for v in &[
+            self.sps,
+            self.frame_bytes,
+            self.lag_ms,
+            self.app_limited,
+            self.demand,
+        ] {
+            buf.extend_from_slice(&v.to_le_bytes());
+        }
+        buf
+    }
+}
+
+struct Reader {
+    sock: UnixDatagram,
+    latest: HashMap<u32, AppSignal>,
+}
+
+/// Latest signal of every game, read from a unix datagram socket without blocking. Clones share
+/// the socket, so all flows see the signals of all games.
+#[derive(Clone)]
+pub struct AppSignals {
+    reader: Arc<Mutex<Reader>>,
+}
+
+impl AppSignals {
+    pub fn bind(path: &str) -> io::Result<Self> {
+        match std::fs::remove_file(path) {
+            Err(e) if e.kind() != io::ErrorKind::NotFound => return Err(e),
+            _ => (),
+        }
+        let sock = UnixDatagram::bind(path)?;
+        sock.set_nonblocking(true)?;
+        Ok(Self {
+            reader: Arc::new(Mutex::new(Reader {
+                sock,
+                latest: HashMap::new(),
+            })),
+        })
+    }
+
+    /// Latest signal of the game sending from `port`, None if there is no recent one. The
+    /// datapath may give the port in network byte order, so both orders are looked up.
+    pub fn get(&self, port: u32, now_unix: f64) -> Option<AppSignal> {
+        let mut reader = self.reader.lock().unwrap();
+        let mut buf = [0u8; MESSAGE_SIZE + 1];
+        while let Ok(n) = reader.sock.recv(&mut buf) {
+            if let Some(s) = AppSignal::decode(&buf[..n]) {
+                reader.latest.insert(s.src_port, s);
+            }
+        }
+        let swapped = (port as u16).swap_bytes() as u32;
+        reader
+            .latest
+            .get(&port)
+            .or_else(|| reader.latest.get(&swapped))
+            .filter(|s| now_unix - s.t <= STALE_S)
+            .copied()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn decode_roundtrip() {
+        let s = AppSignal {
+            t: 1.5,
+            src_port: 5555,
+            sps: 30.,
+            frame_bytes: 20000.,
+            lag_ms: 40.,
+            app_limited: 0.75,
+            demand: 600000.,
+        };
+        let msg = s.encode();
+        assert_eq!(msg.len(), MESSAGE_SIZE);
+        assert_eq!(AppSignal::decode(&msg), Some(s));
+        assert_eq!(AppSignal::decode(&msg[1..]), None);
+        let mut bad = msg.clone();
+        bad[0] = b'X';
+        assert_eq!(AppSignal::decode(&bad), None);
+    }
+
+    #[test]
+    fn reads_latest_by_port() {
+        let path = std::env::temp_dir().join(format!("newcc_app_signal_{}", std::process::id()));
+        let path = path.to_str().unwrap();
+        let signals = AppSignals::bind(path).unwrap();
+        let tx = UnixDatagram::unbound().unwrap();
+        for &(t, demand) in &[(10., 1.), (11., 2.)] {
+            let s = AppSignal {
+                t,
+                src_port: 5555,
+                demand,
+                ..Default::default()
+            };
+            tx.send_to(&s.encode(), path).unwrap();
+        }
+        assert_eq!(signals.get(5555, 11.5).map(|s| s.demand), Some(2.));
+        assert_eq!(
+            signals
+                .get(5555u16.swap_bytes() as u32, 11.5)
+                .map(|s| s.demand),
+            Some(2.)
+        );
+        assert_eq!(signals.get(5556, 11.5), None);
+        assert_eq!(signals.get(5555, 13.), None);
+        std::fs::remove_file(path).unwrap();
+    }
+}
@@ -5,10 +5,56 @@ use portus::ipc::Ipc;
 use portus::lang::Scope;
 use portus::{CongAlg, Datapath, DatapathInfo, DatapathTrait, Report};
 
-use crate::agg_measurement::{AggMeasurement, ReportStatus};
+use crate::agg_measurement::{AggMeasurement, Estimates, Measurement, ReportStatus};
+use crate::app_signal::AppSignals;
+use crate::telemetry::{Record, Telemetry};
 
-pub struct NewCC<T: Ipc> {
-    control_channel: Datapath<T>,
+const MSS: f64 = 1448.;
+/// Never go below this many bytes in delay mode
+const MIN_CWND: f64 = 2. * MSS;
+/// Pace this much faster than the window is delivered at (the max bandwidth in `Mode::Aimd`, cwnd
+/// per target RTT in `Mode::Delay`), so that the pacing rate does not limit cwnd
+const PACING_GAIN: f64 = 1.25;
+/// Windows of the max bandwidth and min rtt filters of `AggMeasurement`, in microseconds
+const BW_WINDOW_US: u64 = 200_000;
+const MIN_RTT_WINDOW_US: u64 = 10_000_000;
+/// `Mode::Delay` empties the queue this often. It keeps a standing queue otherwise, and once the
+/// min rtt window passed, the min rtt would include it and the target delay would come on top
+const DRAIN_INTERVAL_US: u64 = MIN_RTT_WINDOW_US / 2;
+/// cwnd follows the demand of the game once it is app limited at least this often
+const APP_LIMITED_THRESHOLD: f32 = 0.5;
+/// Pace at most this many times the demand of an app limited game, so frames still go out quickly
+const APP_RATE_GAIN: f64 = 4.;
+
+/// Which datapath program sends the reports
+#[derive(Clone, Copy, Debug, PartialEq)]
+pub enum Program {
+    /// Every half base RTT
+    HalfRtt,
+    /// Once per base RTT, or as soon as the rtt moved by more than 1/8 since the last report (but
+    /// at most once per `min_report_interval_us`). Also reports the rates measured by the datapath
+    OnChange,
+}
+
+impl Program {
+    fn name(&self) -> &'static str {
+        match self {
+            Program::HalfRtt => "half_rtt",
+            Program::OnChange => "on_change",
+        }
+    }
+}
+
+#[derive(Clone, Copy, Debug, PartialEq)]
+pub enum Mode {
+    /// Additive increase, multiplicative decrease on loss
+    Aimd,
+    /// Keep the queueing delay (rtt - min rtt) under a target
+    Delay,
+}
+
+pub struct NewCC<D: DatapathTrait> {
+    control_channel: D,
     logger: Option<slog::Logger>,
     sc: Scope,
     /// Set this variable to whatever congestion window you want in bytes
@@ -17,9 +63,27 @@ pub struct NewCC<T: Ipc> {
     rate: f64,
     agg_measurement: AggMeasurement,
     prev_report_time: u64,
+    mode: Mode,
+    /// Queueing delay to stay under in `Mode::Delay`, in microseconds
+    target_delay_us: u32,
+    /// Also pace `Mode::Aimd`. `Mode::Delay` always paces
+    pacing: bool,
+    /// `Mode::Delay` keeps cwnd at MIN_CWND until `drain_until`, and starts the next drain at
+    /// `next_drain`. Microseconds in the time of the reports
+    drain_until: u64,
+    next_drain: u64,
+    /// Max bandwidth when the drain started. The drain may outlast BW_WINDOW_US with a long RTT,
+    /// and leave only samples of the drain in the window
+    drain_bw: f64,
+    /// Where reports are logged instead of being printed
+    telemetry: Option<Telemetry>,
+    n_telemetry_dropped: u64,
+    /// Signals of the games, and the local port of this flow to find its game
+    app_signals: Option<AppSignals>,
+    src_port: u32,
 }
 
-impl<T: Ipc> NewCC<T> {
+impl<D: DatapathTrait> NewCC<D> {
     /// Should be called whenever you want self.cwnd or self.rate to be reflected. By default, we
     /// call it for you in `on_report`.
     fn update(&self) {
@@ -40,6 +104,7 @@ impl<T: Ipc> NewCC<T> {
         rtt: u32,
         min_rtt: u32,
         now: u64,
+        est: Estimates,
     ) {
         // Update cwnd (or rate) based on the above signals. Here's what they mean
 
@@ -51,21 +116,148 @@ impl<T: Ipc> NewCC<T> {
         // rtt - round-trip time of the last acked packet
         // minrtt - minimum rtt among all the packets that were acked since the last call
         // now - ack time (in microseconds) of the last acked packet
+        // est - estimates kept across calls: est.delivery_rate (bytes/sec acked since the last
+        //   call), est.max_bw (max delivery rate over the last BW_WINDOW_US) and est.min_rtt (min
+        //   rtt over the last MIN_RTT_WINDOW_US)
 
         // TODO: Set self.cwnd and self.rate as you wish. Skeletal implementations are given below
+        match self.mode {
+            Mode::Aimd => self.aimd(acked, loss),
+            Mode::Delay => self.delay_control(acked, loss, rtt, now, est),
+        }
+        if self.pacing && self.mode == Mode::Aimd && est.max_bw > 0. {
+            // Pacing a bit faster than the bandwidth estimate does not limit the window, but
+            // spreads a frame over the RTT instead of sending it in one burst. The windowed max
+            // outlasts the loss reports, which carry no rate, so the window halved by a loss is
+            // paced too
+            self.rate = PACING_GAIN * est.max_bw;
+        }
+    }
 
+    fn aimd(&mut self, acked: u32, loss: u32) {
         // A default implementation where we do AIMD on self.cwnd
         if loss != 0 {
             self.cwnd = self.cwnd / 2.;
         } else {
-            self.cwnd += acked as f64 * 1448. / self.cwnd;
+            self.cwnd += acked as f64 * MSS / self.cwnd;
         }
 
         // If rate is 0, it will be ignored and only cwnd will be used. If nonzero, units are in
-        // ptks/sec
+        // bytes/sec
         self.rate = 0.;
     }
 
+    /// Grows cwnd by a packet per RTT while the queueing delay is under the target, and shrinks it
+    /// towards the window that would bring the RTT back to min_rtt + target otherwise. cwnd never
+    /// drops below the max bandwidth times the target RTT, so that it follows the link capacity
+    /// when it goes up. Packets are paced at cwnd per target RTT. Every DRAIN_INTERVAL_US, cwnd
+    /// drops to MIN_CWND for long enough to empty the queue and take an rtt sample of the empty
+    /// queue, so that the min rtt stays the base rtt.
+    fn delay_control(&mut self, acked: u32, loss: u32, rtt: u32, now: u64, est: Estimates) {
+        if loss != 0 {
+            self.cwnd = f64::max(self.cwnd / 2., MIN_CWND);
+            return;
+        }
+        if acked == 0 || rtt == 0 || est.min_rtt == 0 {
+            return;
+        }
+
+        let target_rtt = est.min_rtt.saturating_add(self.target_delay_us) as f64;
+        if self.next_drain == 0 {
+            self.next_drain = now + DRAIN_INTERVAL_US;
+        } else if now >= self.next_drain {
+            // The queue empties in at most the target delay, then the acks of an RTT come back
+            self.drain_until = now + self.target_delay_us as u64 + 2 * est.min_rtt as u64;
+            self.next_drain = now + DRAIN_INTERVAL_US;
+            self.drain_bw = est.max_bw;
+        }
+        if now < self.drain_until {
+            self.cwnd = MIN_CWND;
+            self.rate = PACING_GAIN * self.cwnd * 1e6 / target_rtt;
+            return;
+        }
+        if self.drain_bw > 0. {
+            // The max bandwidth of before the drain sets cwnd back when it ends
+            self.cwnd = f64::max(self.cwnd, self.drain_bw * target_rtt / 1e6);
+            self.drain_bw = 0.;
+        }
+
+        let queue_delay = rtt.saturating_sub(est.min_rtt);
+        if queue_delay > self.target_delay_us {
+            // Half-way there, as there are about two reports per RTT
+            self.cwnd -= (self.cwnd - self.cwnd * target_rtt / rtt as f64) / 2.;
+        } else {
+            self.cwnd += acked as f64 * MSS / self.cwnd;
+            self.cwnd = f64::max(self.cwnd, est.max_bw * target_rtt / 1e6);
+        }
+        self.cwnd = f64::max(self.cwnd, MIN_CWND);
+        self.rate = PACING_GAIN * self.cwnd * 1e6 / target_rtt;
+    }
+
+    /// Caps cwnd (and the rate, if pacing) to what the game sends over two `rtt` when it is app
+    /// limited: a window the game never fills only probes for capacity it does not use, and is
+    /// dumped into the queue as soon as a large frame comes
+    fn follow_app_signal(&mut self, rtt: u32) {
+        if rtt == 0 {
+            return;
+        }
+        let signal = match self.app_signals.as_ref() {
+            Some(a) => a.get(self.src_port, Record::now_unix()),
+            None => return,
+        };
+        let signal = match signal {
+            Some(s) if s.app_limited >= APP_LIMITED_THRESHOLD => s,
+            _ => return,
+        };
+        let demand = signal.demand as f64;
+        let cap = f64::max(
+            2. * signal.frame_bytes as f64,
+            2. * demand * rtt as f64 / 1e6,
+        );
+        self.cwnd = f64::min(self.cwnd, f64::max(cap, MIN_CWND));
+        if self.rate > 0. {
+            self.rate = f64::min(self.rate, f64::max(APP_RATE_GAIN * demand, MIN_CWND * 10.));
+        }
+    }
+
+    fn log_telemetry(
+        &mut self,
+        sock_id: u32,
+        acked: u32,
+        loss: u32,
+        inflight: u32,
+        rtt: u32,
+        min_rtt: u32,
+        now: u64,
+    ) {
+        let telemetry = match self.telemetry.as_ref() {
+            Some(t) => t,
+            None => return,
+        };
+        let logged = telemetry.log(Record {
+            t: Record::now_unix(),
+            now,
+            sock_id,
+            cwnd: self.cwnd as u32,
+            rate: self.rate as u32,
+            rtt,
+            min_rtt,
+            acked,
+            loss,
+            inflight,
+        });
+        if !logged {
+            self.n_telemetry_dropped += 1;
+            if self.n_telemetry_dropped.is_power_of_two() {
+                self.logger.as_ref().map(|log| {
+                    warn!(log, "telemetry writer behind, dropped reports";
+                        "n_dropped" => self.n_telemetry_dropped,
+                    );
+                });
+            }
+        }
+    }
+
     fn handle_timeout(&mut self) {
         // A timeout happened. Indicates severe! React accordingly
 
@@ -84,10 +276,19 @@ impl<T: Ipc> NewCC<T> {
 #[derive(Clone)]
 pub struct NewCCConfig {
     pub logger: Option<slog::Logger>,
+    pub mode: Mode,
+    /// Target queueing delay of `Mode::Delay`, in microseconds
+    pub target_delay_us: u32,
+    pub pacing: bool,
+    pub program: Program,
+    /// Least time between two reports of `Program::OnChange` that are due to an rtt change
+    pub min_report_interval_us: u32,
+    pub telemetry: Option<Telemetry>,
+    pub app_signals: Option<AppSignals>,
 }
 
 impl<T: Ipc> CongAlg<T> for NewCCConfig {
-    type Flow = NewCC<T>;
+    type Flow = NewCC<Datapath<T>>;
 
     fn name() -> &'static str {
         "newcc"
@@ -96,9 +297,10 @@ impl<T: Ipc> CongAlg<T> for NewCCConfig {
     fn datapath_programs(&self) -> FnvHashMap<&'static str, String> {
         // This 'datapath program' instructs CCP on what variables to return to the userspace
         // program, and at what intervals. See CCP documentation for details
-        vec![(
-            "newcc",
-            "(def
+        vec![
+            (
+                Program::HalfRtt.name(),
+                "(def
                 (Report
                     (volatile acked 0)
                     (volatile sacked 0)
@@ -132,13 +334,76 @@ impl<T: Ipc> CongAlg<T> for NewCCConfig {
                 (:= Micros 0)
                 (report)
             )"
-            .to_string(),
-        )]
+                .to_string(),
+            ),
+            // Same fields, plus the ack rate (rin) and the send rate (rout) computed by the
+            // datapath, in bytes/sec
+            (
+                Program::OnChange.name(),
+                format!(
+                    "(def
+                (Report
+                    (volatile acked 0)
+                    (volatile sacked 0)
+                    (volatile loss 0)
+                    (volatile inflight 0)
+                    (volatile timeout 0)
+                    (volatile rtt 0)
+                    (volatile minrtt +infinity)
+                    (volatile numpkts 0)
+                    (volatile now 0)
+                    (volatile rin 0)
+                    (volatile rout 0)
+               )
+                (basertt +infinity)
+                (lastrtt 0)
+            )
+            (when true
+                (:= Report.acked (+ Report.acked Ack.bytes_acked))
+                (:= Report.inflight Flow.packets_in_flight)
+                (:= Report.rtt Flow.rtt_sample_us)
+                (:= Report.minrtt (min Report.minrtt Flow.rtt_sample_us))
+                (:= basertt (min basertt Flow.rtt_sample_us))
+                (:= Report.sacked (+ Report.sacked Ack.packets_misordered))
+                (:= Report.loss Ack.lost_pkts_sample)
+                (:= Report.timeout Flow.was_timeout)
+                (:= Report.now Ack.now)
+                (:= Report.rin Flow.rate_incoming)
+                (:= Report.rout Flow.rate_outgoing)
+                (fallthrough)
+            )
+            (when (|| Flow.was_timeout (> Report.loss 0))
+                (:= Micros 0)
+                (report)
+            )
+            (when (&& (> Micros {})
+                      (|| (> Report.rtt (+ lastrtt (/ lastrtt 8)))
+                          (< Report.rtt (- lastrtt (/ lastrtt 8)))))
+                (:= lastrtt Report.rtt)
+                (:= Micros 0)
+                (report)
+            )
+            (when (> Micros basertt)
+                (:= lastrtt Report.rtt)
+                (:= Micros 0)
+                (report)
+            )",
+                    self.min_report_interval_us
+                ),
+            ),
+        ]
         .into_iter()
         .collect()
     }
 
     fn new_flow(&self, control: Datapath<T>, info: DatapathInfo) -> Self::Flow {
+        self.flow(control, info)
+    }
+}
+
+impl NewCCConfig {
+    /// A flow that sends its decisions to `control`
+    pub fn flow<D: DatapathTrait>(&self, control: D, info: DatapathInfo) -> NewCC<D> {
         let mut s = NewCC {
             control_channel: control,
             logger: self.logger.clone(),
@@ -147,52 +412,93 @@ impl<T: Ipc> CongAlg<T> for NewCCConfig {
             sc: Default::default(),
             // TODO: 0.5 says that it will report a measurement once every half RTT. You may
             // increase this. If you want to recrease it, change the 4rth last line in the program
-            // in `datapath_programs`
-            agg_measurement: AggMeasurement::new(0.5),
+            // in `datapath_programs`. The on_change program already decides when to report in the
+            // datapath, so every report is passed on
+            agg_measurement: AggMeasurement::new(
+                match self.program {
+                    Program::HalfRtt => 0.5,
+                    Program::OnChange => 0.,
+                },
+                BW_WINDOW_US,
+                MIN_RTT_WINDOW_US,
+            ),
             prev_report_time: 0,
+            mode: self.mode,
+            target_delay_us: self.target_delay_us,
+            pacing: self.pacing,
+            drain_until: 0,
+            next_drain: 0,
+            drain_bw: 0.,
+            telemetry: self.telemetry.clone(),
+            n_telemetry_dropped: 0,
+            app_signals: self.app_signals.clone(),
+            src_port: info.src_port,
         };
 
         self.logger.as_ref().map(|log| {
-            info!(log, "starting new flow"; "sock_id" => info.sock_id);
+            info!(log, "starting new flow"; "sock_id" => info.sock_id, "mode" => ?self.mode, "program" => ?self.program);
         });
 
-        s.sc = s.control_channel.set_program("newcc", None).unwrap();
+        s.sc = s
+            .control_channel
+            .set_program(self.program.name(), None)
+            .unwrap();
         s.update();
         s
     }
 }
 
-impl<T: Ipc> portus::Flow for NewCC<T> {
-    fn on_report(&mut self, _sock_id: u32, m: Report) {
+impl<D: DatapathTrait> portus::Flow for NewCC<D> {
+    fn on_report(&mut self, sock_id: u32, m: Report) {
+        let m = Measurement::from_report(&m, &self.sc);
+        self.on_measurement(sock_id, m);
+    }
+}
+
+impl<D: DatapathTrait> NewCC<D> {
+    /// Everything `on_report` does once the report is read, so that it can be driven without a
+    /// datapath
+    pub fn on_measurement(&mut self, sock_id: u32, m: Measurement) {
         let (report_status, was_timeout, acked, sacked, loss, inflight, rtt, min_rtt, now) =
-            self.agg_measurement.report(m, &self.sc);
-        println!(
-            "Report {:?}",
-            (
-                &report_status,
-                was_timeout,
-                acked,
-                sacked,
-                loss,
-                inflight,
-                rtt,
-                min_rtt,
-                now
-            )
-        );
+            self.agg_measurement.aggregate(m);
+        let est = self.agg_measurement.estimates();
+        if self.telemetry.is_none() {
+            println!(
+                "Report {:?}",
+                (
+                    &report_status,
+                    was_timeout,
+                    acked,
+                    sacked,
+                    loss,
+                    inflight,
+                    rtt,
+                    min_rtt,
+                    now
+                )
+            );
+        }
         if report_status == ReportStatus::UrgentReport {
             if was_timeout {
                 self.handle_timeout();
             } else {
-                self.congestion_control(acked, sacked, loss, inflight, rtt, min_rtt, now);
+                self.congestion_control(acked, sacked, loss, inflight, rtt, min_rtt, now, est);
             }
         } else if report_status == ReportStatus::Report && acked + loss + sacked != 0 {
-            self.congestion_control(acked, sacked, loss, inflight, rtt, min_rtt, now);
+            self.congestion_control(acked, sacked, loss, inflight, rtt, min_rtt, now, est);
+        }
+        if report_status != ReportStatus::NoReport {
+            // Loss and timeout reports carry no rtt sample
+            self.follow_app_signal(if rtt != 0 { rtt } else { est.min_rtt });
         }
 
         // Send decisions to CCP
         self.update();
 
+        if report_status != ReportStatus::NoReport {
+            self.log_telemetry(sock_id, acked, loss, inflight, rtt, min_rtt, now);
+        }
+
         self.logger.as_ref().map(|log| {
             debug!(log, "got ack";
                    "acked(pkts)" => acked / 1448u32,
@@ -4,7 +4,11 @@ extern crate slog;
 use slog::Drain;
 
 mod agg_measurement;
+mod app_signal;
 mod cc;
+#[cfg(test)]
+mod sim;
+mod telemetry;
 
 fn make_logger() -> slog::Logger {
     let decorator = slog_term::TermDecorator::new().build();
@@ -13,10 +17,69 @@ fn make_logger() -> slog::Logger {
     slog::Logger::root(drain, o!())
 }
 
+const USAGE: &str = "usage: newcc [--mode=aimd|delay] [--target_delay_ms=N] [--pacing] \
+                     [--program=half_rtt|on_change] [--min_report_interval_us=N] \
+                     [--telemetry=FILE] [--app_signal=PATH]";
+const DEFAULT_TARGET_DELAY_MS: u32 = 10;
+const DEFAULT_MIN_REPORT_INTERVAL_US: u32 = 1000;
+/// Records kept in the telemetry ring file, 48 bytes each
+const TELEMETRY_CAPACITY: u32 = 1 << 20;
+
+/// Parses `--mode=aimd|delay`, `--target_delay_ms=N` (only used by the delay mode), `--pacing`
+/// (also pace the aimd mode), `--program=half_rtt|on_change`, `--min_report_interval_us=N` (only
+/// used by on_change), `--telemetry=FILE` (log reports to this ring file instead of printing
+/// them) and `--app_signal=PATH` (follow the demand the game publishes on this unix socket)
+fn parse_args(log: &slog::Logger) -> Result<cc::NewCCConfig, String> {
+    let mut cfg = cc::NewCCConfig {
+        logger: Some(log.clone()),
+        mode: cc::Mode::Aimd,
+        target_delay_us: DEFAULT_TARGET_DELAY_MS * 1000,
+        pacing: false,
+        program: cc::Program::HalfRtt,
+        min_report_interval_us: DEFAULT_MIN_REPORT_INTERVAL_US,
+        telemetry: None,
+        app_signals: None,
+    };
+    for arg in std::env::args().skip(1) {
+        let mut kv = arg.splitn(2, '=');
+        let parse_err = |e| format!("{}: {:?}", arg, e);
+        match (kv.next().unwrap(), kv.next()) {
+            ("--mode", Some("aimd")) => cfg.mode = cc::Mode::Aimd,
+            ("--mode", Some("delay")) => cfg.mode = cc::Mode::Delay,
+            ("--target_delay_ms", Some(v)) => {
+                cfg.target_delay_us = v.parse::<u32>().map_err(parse_err)? * 1000
+            }
+            ("--pacing", None) => cfg.pacing = true,
+            ("--program", Some("half_rtt")) => cfg.program = cc::Program::HalfRtt,
+            ("--program", Some("on_change")) => cfg.program = cc::Program::OnChange,
+            ("--min_report_interval_us", Some(v)) => {
+                cfg.min_report_interval_us = v.parse().map_err(parse_err)?
+            }
+            ("--telemetry", Some(v)) => {
+                cfg.telemetry = Some(
+                    telemetry::Telemetry::open(v, TELEMETRY_CAPACITY)
+                        .map_err(|e| format!("{}: {}", arg, e))?,
+                )
+            }
+            ("--app_signal", Some(v)) => {
+                cfg.app_signals =
+                    Some(app_signal::AppSignals::bind(v).map_err(|e| format!("{}: {}", arg, e))?)
+            }
+            _ => return Err(format!("unknown argument {}", arg)),
+        }
+    }
+    Ok(cfg)
+}
+
 fn main() {
     let log = make_logger();
-    let cfg = cc::NewCCConfig {
-        logger: Some(log.clone()),
+    let cfg = match parse_args(&log) {
+        Ok(cfg) => cfg,
+        Err(e) => {
+            // the async logger would not get to print it before the exit
+            eprintln!("newcc: {}\n{}", e, USAGE);
+            std::process::exit(1);
+        }
     };
 
     info!(log, "Starting Congestion Control");
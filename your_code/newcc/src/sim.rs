@@ -0,0 +1,654 @@
+//! Trace-driven simulation of one `NewCC` flow, with the link model of scripts/cc_sim.py: a fixed
+//! one-way delay in both directions and a droptail queue drained by the delivery opportunities of
+//! a mahimahi trace (1500 bytes each). The sender is backlogged, or writes frames like the game. A stand-in for the datapath runs the report logic of the
+//! datapath program of the flow on every ack, and hands the reports to `NewCC::on_measurement`,
+//! which aggregates them with `AggMeasurement::aggregate` like `on_report` does. Cwnd and Rate set
+//! by the flow limit the sender. Times are in microseconds.
+
+use std::cell::RefCell;
+use std::cmp::Reverse;
+use std::collections::{BinaryHeap, VecDeque};
+use std::rc::Rc;
+
+use portus::lang::Scope;
+use portus::{DatapathInfo, DatapathTrait};
+
+use crate::agg_measurement::Measurement;
+use crate::app_signal::{AppSignal, AppSignals};
+use crate::cc::{Mode, NewCC, NewCCConfig, Program};
+use crate::telemetry::Record;
+
+const MSS: u32 = 1448;
+const MTU_BYTES: u64 = 1500;
+/// Linux does not retransmit on timeout sooner than this
+const MIN_RTO_US: u64 = 200_000;
+
+/// What the flow set through its datapath handle
+struct DatapathState {
+    cwnd: u32,
+    rate: u32,
+    /// Times Rate went back to 0 once set, i.e. pacing stopped
+    n_rate_resets: u32,
+}
+
+/// Stands in for the datapath handle portus gives to a flow
+struct MockDatapath(Rc<RefCell<DatapathState>>);
+
+impl DatapathTrait for MockDatapath {
+    fn get_sock_id(&self) -> u32 {
+        1
+    }
+
+    fn set_program(
+        &mut self,
+        _program_name: &'static str,
+        fields: Option<&[(&str, u32)]>,
+    ) -> portus::Result<Scope> {
+        if let Some(fields) = fields {
+            self.update_field(&Default::default(), fields)?;
+        }
+        Ok(Default::default())
+    }
+
+    fn update_field(&self, _sc: &Scope, update: &[(&str, u32)]) -> portus::Result<()> {
+        let mut state = self.0.borrow_mut();
+        for &(name, value) in update {
+            match name {
+                "Cwnd" => state.cwnd = value,
+                "Rate" => {
+                    if state.rate > 0 && value == 0 {
+                        state.n_rate_resets += 1;
+                    }
+                    state.rate = value;
+                }
+                _ => panic!("unknown field {}", name),
+            }
+        }
+        Ok(())
+    }
+}
+
+/// The report logic of the datapath programs of `NewCCConfig`: accumulate acks into the report
+/// and send it on loss or timeout, or
+/// - `Program::HalfRtt`: once half a base rtt has passed since the last report.
+/// - `Program::OnChange`: once a base rtt has passed, or min_report_interval_us has passed and
+///   the rtt moved by more than 1/8 since the last report.
+struct Reporter {
+    program: Program,
+    min_report_interval_us: u64,
+    basertt: u64,
+    last_report: u64,
+    last_rtt: u32,
+    report: Measurement,
+    n_reports: u64,
+}
+
+impl Reporter {
+    fn new(program: Program, min_report_interval_us: u32) -> Self {
+        Self {
+            program,
+            min_report_interval_us: min_report_interval_us as u64,
+            basertt: std::u64::MAX,
+            last_report: 0,
+            last_rtt: 0,
+            report: Self::empty_report(),
+            n_reports: 0,
+        }
+    }
+
+    fn empty_report() -> Measurement {
+        Measurement {
+            min_rtt: std::u32::MAX,
+            ..Default::default()
+        }
+    }
+
+    /// The report to send after this ack, if any
+    fn on_ack(
+        &mut self,
+        now: u64,
+        acked: u32,
+        inflight: u32,
+        rtt: Option<u32>,
+        loss: u32,
+        was_timeout: bool,
+    ) -> Option<Measurement> {
+        let r = &mut self.report;
+        r.acked += acked;
+        r.inflight = inflight;
+        if let Some(rtt) = rtt {
+            r.rtt = rtt;
+            r.min_rtt = std::cmp::min(r.min_rtt, rtt);
+            self.basertt = std::cmp::min(self.basertt, rtt as u64);
+        }
+        r.loss = loss;
+        r.was_timeout = was_timeout;
+        r.now = now;
+        let micros = now - self.last_report;
+        let send = if was_timeout || loss > 0 {
+            true
+        } else {
+            match self.program {
+                Program::HalfRtt => micros > self.basertt / 2,
+                Program::OnChange => {
+                    let moved =
+                        (r.rtt as i64 - self.last_rtt as i64).abs() > self.last_rtt as i64 / 8;
+                    if micros > self.basertt || (micros > self.min_report_interval_us && moved) {
+                        self.last_rtt = r.rtt;
+                        true
+                    } else {
+                        false
+                    }
+                }
+            }
+        };
+        if !send {
+            return None;
+        }
+        if self.program == Program::OnChange && now > self.last_report {
+            // what Flow.rate_incoming would measure
+            self.report.rate_incoming = self.report.acked as u64 * 1_000_000 / micros;
+        }
+        self.last_report = now;
+        self.n_reports += 1;
+        Some(std::mem::replace(&mut self.report, Self::empty_report()))
+    }
+}
+
+/// An application that writes `bytes_per_s` in a frame every `frame_us`, like the game, and
+/// `--app_mbps` with `--app_fps` in scripts/cc_sim.py
+#[derive(Clone, Copy, Debug)]
+struct App {
+    bytes_per_s: u64,
+    frame_us: u64,
+}
+
+impl App {
+    /// When the frame with the bytes of packet seq is written
+    fn ready(&self, seq: u64) -> u64 {
+        let t = (seq + 1) * MSS as u64 * 1_000_000 / self.bytes_per_s;
+        ((t + self.frame_us - 1) / self.frame_us).saturating_sub(1) * self.frame_us
+    }
+}
+
+#[derive(Clone, Copy, Debug, PartialEq, Eq, PartialOrd, Ord)]
+enum Event {
+    Send,
+    /// Of this sequence number at the bottleneck
+    Arrival(u64),
+    Ack(u64),
+    /// Deadline it was armed for
+    Rto(u64),
+    /// Delivery opportunity of the bottleneck
+    Op,
+}
+
+/// Metrics of the bottleneck, like scripts/cc_sim.py summarize
+#[derive(Debug)]
+struct Summary {
+    utilization: f64,
+    loss_rate: f64,
+    n_timeouts: u64,
+    n_reports: u64,
+    /// Percentiles of the time packets waited in the queue
+    queueing_delay_p50_us: u64,
+    queueing_delay_p95_us: u64,
+}
+
+/// One flow from a sender to a receiver through a trace-driven droptail bottleneck
+struct Simulation {
+    /// Delivery opportunities of a mahimahi trace, in ms, looped
+    trace: Vec<u64>,
+    delay: u64,
+    queue_packets: usize,
+    flow: NewCC<MockDatapath>,
+    datapath: Rc<RefCell<DatapathState>>,
+    reporter: Reporter,
+    /// Backlogged if None
+    app: Option<App>,
+
+    events: BinaryHeap<Reverse<(u64, u64, Event)>>,
+    n_events: u64,
+    // sender
+    next_seq: u64,
+    // (seq, send time)
+    outstanding: VecDeque<(u64, u64)>,
+    next_send: u64,
+    send_scheduled: bool,
+    rto_deadline: Option<u64>,
+    min_rtt: u64,
+    // bottleneck, (seq, arrival time)
+    queue: VecDeque<(u64, u64)>,
+    op_idx: u64,
+    op_scheduled: bool,
+    // what happened, for the metrics
+    queueing_delays: Vec<u64>,
+    n_arrivals: u64,
+    n_drops: u64,
+    n_timeouts: u64,
+}
+
+impl Simulation {
+    fn new(trace: Vec<u64>, rtt_ms: u64, queue_packets: usize, cfg: &NewCCConfig) -> Self {
+        assert!(!trace.is_empty() && *trace.last().unwrap() > 0);
+        let datapath = Rc::new(RefCell::new(DatapathState {
+            cwnd: 10 * MSS,
+            rate: 0,
+            n_rate_resets: 0,
+        }));
+        let info = DatapathInfo {
+            sock_id: 1,
+            init_cwnd: 10 * MSS,
+            mss: MSS,
+            src_ip: 0,
+            src_port: 0,
+            dst_ip: 0,
+            dst_port: 0,
+        };
+        Self {
+            trace,
+            delay: rtt_ms * 1000 / 2,
+            queue_packets,
+            flow: cfg.flow(MockDatapath(datapath.clone()), info),
+            datapath,
+            reporter: Reporter::new(cfg.program, cfg.min_report_interval_us),
+            app: None,
+            events: BinaryHeap::new(),
+            n_events: 0,
+            next_seq: 0,
+            outstanding: VecDeque::new(),
+            next_send: 0,
+            send_scheduled: false,
+            rto_deadline: None,
+            min_rtt: std::u64::MAX,
+            queue: VecDeque::new(),
+            op_idx: 0,
+            op_scheduled: false,
+            queueing_delays: vec![],
+            n_arrivals: 0,
+            n_drops: 0,
+            n_timeouts: 0,
+        }
+    }
+
+    fn with_app(mut self, app: App) -> Self {
+        self.app = Some(app);
+        self
+    }
+
+    fn push(&mut self, t: u64, event: Event) {
+        // the counter keeps events of the same time in insertion order
+        self.n_events += 1;
+        self.events.push(Reverse((t, self.n_events, event)));
+    }
+
+    fn op_time(&self, i: u64) -> u64 {
+        let n = self.trace.len() as u64;
+        (self.trace[(i % n) as usize] + (i / n) * self.trace[n as usize - 1]) * 1000
+    }
+
+    fn run(&mut self, duration_s: u64) -> Summary {
+        let end = duration_s * 1_000_000;
+        self.try_send(0);
+        while let Some(&Reverse((t, _, _))) = self.events.peek() {
+            if t > end {
+                break;
+            }
+            let Reverse((t, _, event)) = self.events.pop().unwrap();
+            match event {
+                Event::Send => {
+                    self.send_scheduled = false;
+                    self.try_send(t);
+                }
+                Event::Arrival(seq) => self.on_arrival(t, seq),
+                Event::Ack(seq) => self.on_ack(t, seq),
+                Event::Rto(deadline) => self.on_rto(t, deadline),
+                Event::Op => self.on_op(t),
+            }
+        }
+        self.summarize(end)
+    }
+
+    fn summarize(&self, end: u64) -> Summary {
+        let n_capacity_ops = (0..).take_while(|&i| self.op_time(i) <= end).count();
+        let mut delays = self.queueing_delays.clone();
+        delays.sort();
+        let percentile = |p: usize| {
+            if delays.is_empty() {
+                0
+            } else {
+                delays[(delays.len() - 1) * p / 100]
+            }
+        };
+        Summary {
+            utilization: delays.len() as f64 / n_capacity_ops as f64,
+            loss_rate: self.n_drops as f64 / std::cmp::max(self.n_arrivals, 1) as f64,
+            n_timeouts: self.n_timeouts,
+            n_reports: self.reporter.n_reports,
+            queueing_delay_p50_us: percentile(50),
+            queueing_delay_p95_us: percentile(95),
+        }
+    }
+
+    fn on_report(&mut self, report: Option<Measurement>) {
+        if let Some(m) = report {
+            self.flow.on_measurement(1, m);
+        }
+    }
+
+    // sender
+    fn window_open(&self) -> bool {
+        let cwnd = std::cmp::max(self.datapath.borrow().cwnd, 2 * MSS);
+        (self.outstanding.len() as u32 + 1) * MSS <= cwnd
+    }
+
+    fn try_send(&mut self, now: u64) {
+        while self.window_open() {
+            let rate = self.datapath.borrow().rate as u64;
+            let mut wait_until = now;
+            if rate > 0 {
+                wait_until = std::cmp::max(wait_until, self.next_send);
+            }
+            if let Some(app) = self.app {
+                wait_until = std::cmp::max(wait_until, app.ready(self.next_seq));
+            }
+            if wait_until > now {
+                if !self.send_scheduled {
+                    self.send_scheduled = true;
+                    self.push(wait_until, Event::Send);
+                }
+                return;
+            }
+            let seq = self.next_seq;
+            self.next_seq += 1;
+            self.outstanding.push_back((seq, now));
+            self.push(now + self.delay, Event::Arrival(seq));
+            if rate > 0 {
+                self.next_send = std::cmp::max(now, self.next_send) + MTU_BYTES * 1_000_000 / rate;
+            }
+            if self.rto_deadline.is_none() {
+                self.arm_rto(now);
+            }
+        }
+    }
+
+    fn arm_rto(&mut self, now: u64) {
+        let rto = if self.min_rtt == std::u64::MAX {
+            1_000_000
+        } else {
+            std::cmp::max(MIN_RTO_US, 3 * self.min_rtt)
+        };
+        self.rto_deadline = Some(now + rto);
+        self.push(now + rto, Event::Rto(now + rto));
+    }
+
+    fn on_rto(&mut self, now: u64, deadline: u64) {
+        if self.rto_deadline != Some(deadline) {
+            // re-armed since
+            return;
+        }
+        self.rto_deadline = None;
+        if self.outstanding.is_empty() {
+            return;
+        }
+        let lost = self.outstanding.len() as u32;
+        self.outstanding.clear();
+        self.n_timeouts += 1;
+        let report = self.reporter.on_ack(now, 0, 0, None, lost, true);
+        self.on_report(report);
+        self.try_send(now);
+    }
+
+    fn on_ack(&mut self, now: u64, seq: u64) {
+        // the bottleneck is fifo, so unacked packets sent before seq were dropped
+        let mut lost = 0;
+        while self.outstanding.front().map_or(false, |&(s, _)| s < seq) {
+            self.outstanding.pop_front();
+            lost += 1;
+        }
+        let sent = match self.outstanding.front() {
+            Some(&(s, sent)) if s == seq => sent,
+            // acks a packet already given up on by a timeout
+            _ => return,
+        };
+        self.outstanding.pop_front();
+        self.min_rtt = std::cmp::min(self.min_rtt, now - sent);
+        let inflight = self.outstanding.len() as u32;
+        let report =
+            self.reporter
+                .on_ack(now, MSS, inflight, Some((now - sent) as u32), lost, false);
+        self.on_report(report);
+        self.rto_deadline = None;
+        if !self.outstanding.is_empty() {
+            self.arm_rto(now);
+        }
+        self.try_send(now);
+    }
+
+    // bottleneck
+    fn on_arrival(&mut self, now: u64, seq: u64) {
+        self.n_arrivals += 1;
+        if self.queue.len() >= self.queue_packets {
+            self.n_drops += 1;
+            return;
+        }
+        self.queue.push_back((seq, now));
+        self.schedule_op(now);
+    }
+
+    fn schedule_op(&mut self, now: u64) {
+        if self.op_scheduled || self.queue.is_empty() {
+            return;
+        }
+        // opportunities while the queue was empty went unused
+        while self.op_time(self.op_idx) < now {
+            self.op_idx += 1;
+        }
+        self.op_scheduled = true;
+        let t = self.op_time(self.op_idx);
+        self.push(t, Event::Op);
+    }
+
+    fn on_op(&mut self, now: u64) {
+        self.op_scheduled = false;
+        self.op_idx += 1;
+        let (seq, arrival) = self.queue.pop_front().unwrap();
+        self.queueing_delays.push(now - arrival);
+        self.push(now + self.delay, Event::Ack(seq));
+        self.schedule_op(now);
+    }
+}
+
+fn config(mode: Mode, program: Program, pacing: bool) -> NewCCConfig {
+    NewCCConfig {
+        logger: None,
+        mode,
+        target_delay_us: 10_000,
+        pacing,
+        program,
+        min_report_interval_us: 1000,
+        telemetry: None,
+        app_signals: None,
+    }
+}
+
+/// mm_traces/12mbps.log, a packet every ms
+fn mbps12() -> Vec<u64> {
+    vec![1]
+}
+
+/// mm_traces/2mbps.log, a packet every 6 ms
+fn mbps2() -> Vec<u64> {
+    vec![6]
+}
+
+/// 12 Mbps on average, but 0 to 2 packets in each ms, so that the rtt varies like on the cellular
+/// traces, and the srtt the reports are aggregated over is above the base rtt
+fn jittery_mbps12() -> Vec<u64> {
+    // xorshift, so that the trace is the same on every run
+    let mut x: u32 = 2463534242;
+    let mut trace = vec![];
+    for ms in 1..=1000 {
+        x ^= x << 13;
+        x ^= x >> 17;
+        x ^= x << 5;
+        for _ in 0..x % 3 {
+            trace.push(ms);
+        }
+    }
+    trace
+}
+
+/// 12 Mbps for 5 s, then 2 Mbps (a packet every 6 ms, mm_traces/2mbps.log) for 5 s
+fn step_down() -> Vec<u64> {
+    (1..=5000).chain((1..=833).map(|i| 5000 + 6 * i)).collect()
+}
+
+fn simulate(trace: Vec<u64>, cfg: &NewCCConfig) -> Summary {
+    Simulation::new(trace, 20, 50, cfg).run(30)
+}
+
+#[test]
+fn aimd_fills_the_link() {
+    let s = simulate(mbps12(), &config(Mode::Aimd, Program::HalfRtt, false));
+    assert!(s.utilization > 0.95, "{:?}", s);
+    assert!(s.loss_rate > 0., "{:?}", s);
+    assert_eq!(s.n_timeouts, 0, "{:?}", s);
+    // loss based, so the queue is never empty, but never longer than 50 packets
+    assert!(s.queueing_delay_p50_us > 0, "{:?}", s);
+    assert!(s.queueing_delay_p95_us <= 50_000, "{:?}", s);
+    // about two reports per 20 ms rtt
+    assert!(s.n_reports > 30 * 50 && s.n_reports < 30 * 200, "{:?}", s);
+}
+
+#[test]
+fn on_change_reports_about_once_per_rtt() {
+    let half_rtt = simulate(mbps12(), &config(Mode::Aimd, Program::HalfRtt, false));
+    let on_change = simulate(mbps12(), &config(Mode::Aimd, Program::OnChange, false));
+    assert!(on_change.utilization > 0.95, "{:?}", on_change);
+    assert!(
+        on_change.n_reports < half_rtt.n_reports,
+        "{:?} {:?}",
+        on_change,
+        half_rtt
+    );
+}
+
+#[test]
+fn delay_mode_keeps_the_queue_under_the_target() {
+    let aimd = simulate(mbps12(), &config(Mode::Aimd, Program::HalfRtt, false));
+    let delay = simulate(mbps12(), &config(Mode::Delay, Program::HalfRtt, false));
+    assert!(delay.utilization > 0.9, "{:?}", delay);
+    // the target of 10 ms, give or take a packet
+    assert!(delay.queueing_delay_p95_us <= 12_000, "{:?}", delay);
+    assert!(
+        delay.queueing_delay_p50_us < aimd.queueing_delay_p50_us,
+        "{:?} {:?}",
+        delay,
+        aimd
+    );
+}
+
+#[test]
+fn delay_mode_follows_the_capacity() {
+    for &program in &[Program::HalfRtt, Program::OnChange] {
+        let s = simulate(step_down(), &config(Mode::Delay, program, false));
+        assert!(s.utilization > 0.85, "{:?} {:?}", program, s);
+        assert_eq!(s.n_timeouts, 0, "{:?} {:?}", program, s);
+        assert!(s.queueing_delay_p50_us <= 12_000, "{:?} {:?}", program, s);
+    }
+}
+
+#[test]
+fn delay_mode_keeps_up_with_a_long_rtt() {
+    // the drains last longer than the bandwidth window
+    let s = Simulation::new(
+        mbps12(),
+        150,
+        200,
+        &config(Mode::Delay, Program::HalfRtt, false),
+    )
+    .run(60);
+    assert!(s.utilization > 0.8, "{:?}", s);
+    assert!(s.queueing_delay_p95_us <= 12_000, "{:?}", s);
+}
+
+#[test]
+fn pacing_spreads_aimd() {
+    let cfg = config(Mode::Aimd, Program::HalfRtt, true);
+    let mut sim = Simulation::new(mbps12(), 20, 50, &cfg);
+    let s = sim.run(30);
+    assert!(s.utilization > 0.95, "{:?}", s);
+    assert!(sim.datapath.borrow().rate > 0);
+    // still paced after the losses
+    assert!(s.loss_rate > 0., "{:?}", s);
+    assert_eq!(sim.datapath.borrow().n_rate_resets, 0);
+}
+
+/// On a jittery link, part of the reports of the datapath only feed the aggregate (NoReport),
+/// and have no rtt to cap cwnd with
+#[test]
+fn app_limited_cwnd_follows_the_demand() {
+    let path = std::env::temp_dir().join(format!("newcc_sim_app_signal_{}", std::process::id()));
+    let path = path.to_str().unwrap();
+    let mut cfg = config(Mode::Aimd, Program::HalfRtt, false);
+    cfg.app_signals = Some(AppSignals::bind(path).unwrap());
+    // 4 Mbps of 4 KB frames, 20 KB over two 20 ms RTTs
+    let signal = AppSignal {
+        // stays recent however long the simulation takes
+        t: Record::now_unix() + 3600.,
+        src_port: 0,
+        sps: 125.,
+        frame_bytes: 4000.,
+        lag_ms: 0.,
+        app_limited: 1.,
+        demand: 500_000.,
+    };
+    std::os::unix::net::UnixDatagram::unbound()
+        .unwrap()
+        .send_to(&signal.encode(), path)
+        .unwrap();
+    let mut sim = Simulation::new(jittery_mbps12(), 20, 50, &cfg);
+    let s = sim.run(10);
+    std::fs::remove_file(path).unwrap();
+    let cwnd = sim.datapath.borrow().cwnd as f64;
+    let target = 2. * 500_000. * 0.02;
+    assert!(
+        cwnd > 0.8 * target && cwnd < 1.5 * target,
+        "cwnd {} {:?}",
+        cwnd,
+        s
+    );
+    // the capped window does not fill the 12 Mbps link
+    assert!(s.loss_rate == 0., "{:?}", s);
+}
+
+#[test]
+fn pacing_spreads_frames() {
+    // The frames of the game on a slow link: 1 Mbps at 30 fps, about three packets each
+    let app = App {
+        bytes_per_s: 125_000,
+        frame_us: 33_333,
+    };
+    let run = |pacing| {
+        let cfg = config(Mode::Aimd, Program::HalfRtt, pacing);
+        Simulation::new(mbps2(), 100, 100, &cfg)
+            .with_app(app)
+            .run(60)
+    };
+    let unpaced = run(false);
+    let paced = run(true);
+    assert!(
+        (paced.utilization - unpaced.utilization).abs() < 0.01,
+        "{:?} {:?}",
+        paced,
+        unpaced
+    );
+    // a frame waits behind its own packets when it goes out in one burst
+    assert!(
+        paced.queueing_delay_p95_us * 2 <= unpaced.queueing_delay_p95_us,
+        "{:?} {:?}",
+        paced,
+        unpaced
+    );
+}
@@ -0,0 +1,192 @@
+use std::fs::{File, OpenOptions};
+use std::io::{self, Seek, SeekFrom, Write};
+use std::sync::mpsc::{self, Receiver, SyncSender, TrySendError};
+use std::thread;
+use std::time::{SystemTime, UNIX_EPOCH};
+
+// Ring file of fixed size records, see rl_app/cc_telemetry.py for the format and a loader
+const MAGIC: &[u8; 4] = b"CCTL";
+const VERSION: u32 = 1;
+const HEADER_SIZE: u64 = 24;
+const RECORD_SIZE: u64 = 48;
+/// Reports queued for the writer thread before new ones are dropped
+const QUEUE_LEN: usize = 1 << 16;
+
+/// One report and the decision taken on it
+#[derive(Clone, Copy, Debug, Default, PartialEq)]
+pub struct Record {
+    /// Unix time in seconds
+    pub t: f64,
+    /// Datapath time of the report, in microseconds
+    pub now: u64,
+    pub sock_id: u32,
+    /// Bytes
+    pub cwnd: u32,
+    /// Bytes/sec
+    pub rate: u32,
+    /// Microseconds
+    pub rtt: u32,
+    pub min_rtt: u32,
+    /// Bytes
+    pub acked: u32,
+    /// Packets
+    pub loss: u32,
+    pub inflight: u32,
+}
+
+impl Record {
+    pub fn now_unix() -> f64 {
+        SystemTime::now()
+            .duration_since(UNIX_EPOCH)
+            .map(|d| d.as_secs_f64())
+            .unwrap_or(0.)
+    }
+
+    fn encode(&self, buf: &mut Vec<u8>) {
+        buf.extend_from_slice(&self.t.to_le_bytes());
+        buf.extend_from_slice(&self.now.to_le_bytes());
+        for v in &[
+            self.sock_id,
+            self.cwnd,
+            self.rate,
+            self.rtt,
+            self.min_rtt,
+            self.acked,
+            self.loss,
+            self.inflight,
+        ] {
+            buf.extend_from_slice(&v.to_le_bytes());
+        }
+    }
+}
+
+/// Logs records into a ring file of `capacity` records. `log` only queues the record, a
+/// background thread writes them, so the report path never waits on the disk. Clones log into the
+/// same file.
+#[derive(Clone)]
+pub struct Telemetry {
+    tx: SyncSender<Record>,
+}
+
+impl Telemetry {
+    pub fn open(fname: &str, capacity: u32) -> io::Result<Self> {
+        let mut f = OpenOptions::new()
+            .read(true)
+            .write(true)
+            .create(true)
+            .truncate(true)
+            .open(fname)?;
+        f.set_len(HEADER_SIZE + capacity as u64 * RECORD_SIZE)?;
+        write_header(&mut f, capacity, 0)?;
+        let (tx, rx) = mpsc::sync_channel(QUEUE_LEN);
+        thread::spawn(move || {
+            // The file is left as is if writing fails, there is no one to report it to
+            let _ = write_loop(f, capacity, rx);
+        });
+        Ok(Self { tx })
+    }
+
+    /// Returns false if the record was dropped because the writer thread fell behind
+    pub fn log(&self, r: Record) -> bool {
+        match self.tx.try_send(r) {
+            Err(TrySendError::Full(_)) => false,
+            _ => true,
+        }
+    }
+}
+
+fn write_header(f: &mut File, capacity: u32, n_written: u64) -> io::Result<()> {
+    let mut buf = Vec::with_capacity(HEADER_SIZE as usize);
+    buf.extend_from_slice(MAGIC);
+    buf.extend_from_slice(&VERSION.to_le_bytes());
+    buf.extend_from_slice(&(RECORD_SIZE as u32).to_le_bytes());
+    buf.extend_from_slice(&capacity.to_le_bytes());
+    buf.extend_from_slice(&n_written.to_le_bytes());
+    f.seek(SeekFrom::Start(0))?;
+    f.write_all(&buf)
+}
+
+/// Writes whatever is queued in one go, until the sender is dropped
+fn write_loop(mut f: File, capacity: u32, rx: Receiver<Record>) -> io::Result<()> {
+    let capacity = capacity as u64;
+    let mut n_written = 0u64;
+    let mut batch = vec![];
+    let mut buf = vec![];
+    while let Ok(r) = rx.recv() {
+        batch.push(r);
+        batch.extend(rx.try_iter());
+        let mut records = &batch[..];
+        // at most two contiguous writes, before and after wrapping around
+        while !records.is_empty() {
+            let slot = n_written % capacity;
+            let n = std::cmp::min(records.len() as u64, capacity - slot) as usize;
+            buf.clear();
+            for r in &records[..n] {
+                r.encode(&mut buf);
+            }
+            f.seek(SeekFrom::Start(HEADER_SIZE + slot * RECORD_SIZE))?;
+            f.write_all(&buf)?;
+            n_written += n as u64;
+            records = &records[n..];
+        }
+        batch.clear();
+        write_header(&mut f, capacity as u32, n_written)?;
+    }
+    Ok(())
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::io::Read;
+
+    fn read_records(fname: &str) -> (u64, Vec<u64>) {
+        let mut data = vec![];
+        File::open(fname).unwrap().read_to_end(&mut data).unwrap();
+        assert_eq!(&data[..4], MAGIC);
+        let mut n = [0u8; 8];
+        n.copy_from_slice(&data[16..24]);
+        let nows = data[HEADER_SIZE as usize..]
+            .chunks(RECORD_SIZE as usize)
+            .map(|r| {
+                let mut now = [0u8; 8];
+                now.copy_from_slice(&r[8..16]);
+                u64::from_le_bytes(now)
+            })
+            .collect();
+        (u64::from_le_bytes(n), nows)
+    }
+
+    #[test]
+    fn record_size() {
+        let mut buf = vec![];
+        Record::default().encode(&mut buf);
+        assert_eq!(buf.len() as u64, RECORD_SIZE);
+    }
+
+    #[test]
+    fn ring_wraps_around() {
+        let fname = std::env::temp_dir().join(format!("newcc_telemetry_{}", std::process::id()));
+        let fname = fname.to_str().unwrap();
+        let t = Telemetry::open(fname, 10).unwrap();
+        for now in 0..25 {
+            assert!(t.log(Record {
+                now,
+                ..Default::default()
+            }));
+        }
+        // wait for the writer thread to drain the queue
+        let mut n_written = 0;
+        for _ in 0..100 {
+            n_written = read_records(fname).0;
+            if n_written == 25 {
+                break;
+            }
+            thread::sleep(std::time::Duration::from_millis(10));
+        }
+        assert_eq!(n_written, 25);
+        let (_, nows) = read_records(fname);
+        assert_eq!(nows, vec![20, 21, 22, 23, 24, 15, 16, 17, 18, 19]);
+        std::fs::remove_file(fname).unwrap();
+    }
+}